@@ -0,0 +1,725 @@
+import argparse
+import asyncio
+import atexit
+import json
+import logging
+import os
+import random
+import resource
+import select
+import selectors
+import subprocess
+import sys
+import time
+from socket import *
+import tempfile
+import threading
+from passwords import PasswordHasher, hashPassword, checkPassword
+from db import DB, create_backend
+from peer import PeerServer, AsyncRegistryClient
+from logs import setupLogging
+import protocol
+import registry
+from presence import PresenceIndex
+from history import MessageHistory
+
+REGISTRY_HOST = "127.0.0.1"
+# requests of a simulated peer once it is logged in, command -> weight
+LOAD_MIX = {"SEARCH": 6, "CHATROOM-JOIN": 2, "USERS-LIST": 1, "CHATROOM-LIST": 1}
+# hellos the load benchmark sends at once
+HELLO_BATCH = 20
+
+
+# raises the open file limit up to the hard limit, every session is a socket
+def raiseFileLimit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+# starts registry.py on localhost and waits until it accepts connections
+def startRegistry(port, portUDP, extraArgs=()):
+    process = subprocess.Popen(
+        [sys.executable, "registry.py", "--host", REGISTRY_HOST, "--port", str(port), "--udp-port", str(portUDP)]
+        + list(extraArgs),
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            create_connection((REGISTRY_HOST, port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("registry did not start on port " + str(port))
+
+
+def stopRegistry(process):
+    process.kill()
+    process.wait()
+
+
+# reads resident memory (kB) and thread count of a process from /proc
+def processStats(pid):
+    stats = {}
+    with open("/proc/{}/status".format(pid)) as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                stats["rss_kb"] = int(line.split()[1])
+            elif line.startswith("Threads:"):
+                stats["threads"] = int(line.split()[1])
+    return stats
+
+
+# opens sessions against one registry process and reports how many it holds,
+# every session issues a request so it is known to be served, not only queued
+def benchmarkSessions(mode, sessions, port, portUDP):
+    process = startRegistry(port, portUDP, ["--mode", mode, "--db", "memory"])
+    sockets = []
+    failed = 0
+    try:
+        baseline = processStats(process.pid)
+        start = time.perf_counter()
+        for i in range(sessions):
+            try:
+                sock = create_connection((REGISTRY_HOST, port), timeout=5)
+                sock.send("USERS-LIST".encode())
+                sock.recv(1024)
+                sockets.append(sock)
+            except OSError:
+                failed += 1
+                if failed > 50:
+                    break
+        elapsed = time.perf_counter() - start
+        stats = processStats(process.pid)
+        held = len(sockets)
+        return {
+            "mode": mode,
+            "requested": sessions,
+            "held": held,
+            "failed": failed,
+            "seconds": round(elapsed, 3),
+            "threads": stats.get("threads"),
+            "rss_kb": stats.get("rss_kb"),
+            "kb_per_session": round((stats["rss_kb"] - baseline["rss_kb"]) / held, 2) if held else None,
+        }
+    finally:
+        for sock in sockets:
+            sock.close()
+        stopRegistry(process)
+
+
+# password checks per second of a login storm against the size of the bcrypt pool
+def benchmarkPasswords(workers, logins, rounds, useProcesses):
+    hashed = hashPassword("benchmark-password", rounds)
+    hasher = PasswordHasher(workers, maxPending=logins, rounds=rounds, useProcesses=useProcesses)
+    try:
+        # warms the pool up, processes are started lazily
+        hasher.check("benchmark-password", hashed)
+        start = time.perf_counter()
+        futures = [hasher.submit(checkPassword, "benchmark-password", hashed) for i in range(logins)]
+        for future in futures:
+            future.result()
+        elapsed = time.perf_counter() - start
+    finally:
+        hasher.shutdown()
+    return {
+        "pool": "process" if useProcesses else "thread",
+        "workers": workers,
+        "rounds": rounds,
+        "logins": logins,
+        "seconds": round(elapsed, 3),
+        "logins_per_second": round(logins / elapsed, 1),
+    }
+
+
+# latency of every storage operation of the registry's workload on one backend
+def benchmarkDatabase(backend, users, path=None):
+    database = DB(create_backend(backend, path))
+    database.ensure_indexes()
+    usernames = ["user{}".format(i) for i in range(users)]
+    start = time.perf_counter()
+    for username in usernames:
+        database.register(username, b"hashed-password")
+    database.account_cache.clear()
+    for username in usernames:
+        database.is_account_exist(username)
+        database.get_password(username)
+        database.is_account_exist(username + "-missing")
+    for username in usernames:
+        database.user_login(username, "127.0.0.1", "5000")
+    database.get_peers_ip_port(usernames)
+    database.bulk_logout(usernames)
+    database.bulk_login([(username, "127.0.0.1", "5000") for username in usernames])
+    for username in usernames:
+        database.get_peer_ip_port(username)
+        database.user_logout(username)
+    elapsed = time.perf_counter() - start
+    operations = {
+        name: {key: round(value * 1e6, 1) if key != "count" else value for key, value in stats.items()}
+        for name, stats in database.latency_stats().items()
+    }
+    return {
+        "backend": backend,
+        "users": users,
+        "seconds": round(elapsed, 3),
+        "latency_us": operations,
+        "cache": database.cache_stats(),
+    }
+
+
+# peer server that counts the messages it dispatched
+class CountingPeerServer(PeerServer):
+    def __init__(self):
+        PeerServer.__init__(self, "benchmark", 0)
+        self.handled = threading.Semaphore(0)
+
+    def handleMessage(self, sock, message):
+        self.handled.release()
+        return True
+
+
+# the loop of the peer server before selectors, a select over the whole peer list every iteration
+def selectDispatch(listening, peers, handled, stop):
+    while not stop.is_set():
+        readable, writable, exceptional = select.select([listening] + peers, [], [], 1)
+        for sock in readable:
+            if sock.recv(protocol.RECV_SIZE):
+                handled.release()
+
+
+# connects peers to a dispatch loop over socket pairs, then sends messages from
+# random peers one at a time and measures until each of them is dispatched
+def benchmarkDispatch(loop, peers, messages):
+    pairs = [socketpair() for i in range(peers)]
+    frame = protocol.encodeFrame("chat-message\nbenchmark\nhello")
+    stop = threading.Event()
+    if loop == "selectors":
+        server = CountingPeerServer()
+        for local, remote in pairs:
+            server.addPeer(local, protocol.MessageCodec(protocol.FRAMED))
+        server.start()
+        handled = server.handled
+    else:
+        listening = socket(AF_INET, SOCK_STREAM)
+        listening.bind((REGISTRY_HOST, 0))
+        listening.listen()
+        handled = threading.Semaphore(0)
+        peerSockets = [local for local, remote in pairs]
+        try:
+            # fails here, instead of in the thread, past FD_SETSIZE
+            select.select([listening] + peerSockets, [], [], 0)
+        except ValueError:
+            listening.close()
+            for local, remote in pairs:
+                local.close()
+                remote.close()
+            raise
+        thread = threading.Thread(target=selectDispatch, args=(listening, peerSockets, handled, stop))
+        thread.start()
+    try:
+        start = time.perf_counter()
+        for i in range(messages):
+            random.choice(pairs)[1].send(frame)
+            handled.acquire()
+        elapsed = time.perf_counter() - start
+    finally:
+        if loop == "selectors":
+            server.stop()
+        else:
+            stop.set()
+            thread.join()
+            listening.close()
+        for local, remote in pairs:
+            local.close()
+            remote.close()
+    return {
+        "loop": loop,
+        "peers": peers,
+        "messages": messages,
+        "us_per_message": round(elapsed / messages * 1e6, 1),
+    }
+
+
+# quantile of sorted samples
+def percentile(samples, quantile):
+    return samples[min(len(samples) - 1, int(quantile * len(samples)))]
+
+
+# count, p50, p99 and max in milliseconds of latencies in seconds
+def latencySummary(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {"count": 0}
+    return {
+        "count": len(samples),
+        "p50_ms": round(percentile(samples, 0.5) * 1000, 3),
+        "p99_ms": round(percentile(samples, 0.99) * 1000, 3),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+
+
+# Headless peer of the load benchmark, a registry client that records the
+# latency of every request under its command
+class SimulatedPeer(AsyncRegistryClient):
+    def __init__(self, username, port, portUDP, latencies):
+        AsyncRegistryClient.__init__(self, REGISTRY_HOST, port, portUDP)
+        self.username = username
+        self.latencies = latencies
+        self.requests = 0
+
+    async def request(self, message):
+        start = time.perf_counter()
+        response = await AsyncRegistryClient.request(self, message)
+        self.latencies.setdefault(message.split()[0], []).append(time.perf_counter() - start)
+        self.requests += 1
+        return response
+
+    # sends requests of the load mix until the deadline, waiting about think seconds between them
+    async def run(self, usernames, rooms, deadline, think):
+        commands = list(LOAD_MIX)
+        weights = list(LOAD_MIX.values())
+        while time.perf_counter() < deadline:
+            command = random.choices(commands, weights)[0]
+            if command == "SEARCH":
+                await self.search(random.choice(usernames))
+            elif command == "CHATROOM-JOIN":
+                await self.joinRoom(random.choice(rooms))
+                await self.leaveRoom()
+            elif command == "USERS-LIST":
+                await self.request("USERS-LIST limit=50")
+            else:
+                await self.request("CHATROOM-LIST")
+            await asyncio.sleep(random.uniform(0, 2 * think))
+
+
+# sends the hello of every peer in the list, which grows as peers log in,
+# once per interval from one udp socket as the peers' hello timers would, and
+# counts the datagrams sent; the hellos are spread over the interval like the
+# timers of real peers, a burst of all of them overflows the registry's socket
+async def sendHellos(peers, portUDP, interval, sent):
+    udpSocket = socket(AF_INET, SOCK_DGRAM)
+    udpSocket.setblocking(False)
+    try:
+        while True:
+            batch = list(peers)
+            for start in range(0, max(len(batch), 1), HELLO_BATCH):
+                for peer in batch[start:start + HELLO_BATCH]:
+                    try:
+                        udpSocket.sendto(("HELLO " + peer.username).encode(), (REGISTRY_HOST, portUDP))
+                        sent[0] += 1
+                    except BlockingIOError:
+                        pass
+                await asyncio.sleep(interval * HELLO_BATCH / max(len(batch), HELLO_BATCH))
+    finally:
+        udpSocket.close()
+
+
+async def runLoad(process, peers, duration, think, rooms, port, portUDP, concurrency):
+    latencies = {}
+    baseline = processStats(process.pid)
+    usernames = ["load{}".format(i) for i in range(peers)]
+    roomNames = ["room{}".format(i) for i in range(rooms)]
+    simulated = [SimulatedPeer(username, port, portUDP, latencies) for username in usernames]
+    connecting = asyncio.Semaphore(concurrency)
+    online = []
+    hellos = [0]
+    helloTask = asyncio.create_task(sendHellos(online, portUDP, 1, hellos))
+
+    async def setUp(peer, index):
+        async with connecting:
+            await peer.connect()
+            await peer.register(peer.username, "password")
+            # no peer servers, and the hellos are sent by sendHellos
+            response = await peer.login(peer.username, "password", 20000 + index % 40000, serve=False, hello=False)
+            if response != "login-success":
+                raise RuntimeError("{} could not log in: {}".format(peer.username, response))
+            online.append(peer)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[setUp(peer, i) for i, peer in enumerate(simulated)], return_exceptions=True)
+    setUpSeconds = time.perf_counter() - start
+    if not online:
+        helloTask.cancel()
+        raise RuntimeError("no simulated peer logged in: {}".format(results[0]))
+    for room in roomNames:
+        await online[0].request("CHATROOM-CREATE " + room)
+    sessionStats = processStats(process.pid)
+
+    traffic = {command: latencies.pop(command, []) for command in ("JOIN", "LOGIN", "CHATROOM-CREATE")}
+    requestsBefore = sum(peer.requests for peer in online)
+    hellosBefore = hellos[0]
+    start = time.perf_counter()
+    errors = await asyncio.gather(
+        *[peer.run(usernames, roomNames, start + duration, think) for peer in online], return_exceptions=True
+    )
+    elapsed = time.perf_counter() - start
+    requests = sum(peer.requests for peer in online) - requestsBefore
+    helloTask.cancel()
+    for peer in online:
+        peer.post("LOGOUT")
+    for peer in simulated:
+        peer.close()
+    allLatencies = [value for samples in latencies.values() for value in samples]
+    return {
+        "peers": peers,
+        "online": len(online),
+        "setup_seconds": round(setUpSeconds, 3),
+        "setup_latency": {command: latencySummary(samples) for command, samples in traffic.items()},
+        "seconds": round(elapsed, 3),
+        "requests": requests,
+        "requests_per_second": round(requests / elapsed, 1),
+        "hellos_per_second": round((hellos[0] - hellosBefore) / elapsed, 1),
+        "errors": sum(1 for error in errors if error is not None) + len(simulated) - len(online),
+        "latency": latencySummary(allLatencies),
+        "latency_by_command": {command: latencySummary(samples) for command, samples in sorted(latencies.items())},
+        "threads": sessionStats.get("threads"),
+        "rss_kb": sessionStats.get("rss_kb"),
+        "kb_per_session": round((sessionStats["rss_kb"] - baseline["rss_kb"]) / len(online), 2),
+    }
+
+
+# logs simulated peers in to a registry process and sends them through the
+# load mix for a while, with the throughput, the latency of every command and
+# the memory the sessions took
+def benchmarkLoad(mode, peers, duration, think, rooms, port, portUDP, concurrency, registryArgs):
+    process = startRegistry(port, portUDP, ["--mode", mode] + list(registryArgs))
+    try:
+        result = asyncio.run(runLoad(process, peers, duration, think, rooms, port, portUDP, concurrency))
+    finally:
+        stopRegistry(process)
+    result["mode"] = mode
+    return result
+
+
+# the hello path of the registry before batching: one recvfrom per wakeup of
+# the selector, decoded and split
+def receiveSingleHello(udpSocket):
+    data, clientAddress = udpSocket.recvfrom(registry.HELLO_DATAGRAM_SIZE)
+    message = data.decode().split()
+    if message and message[0] == "HELLO" and len(message) > 1 and message[1] in registry.presence:
+        registry.liveness.touch(message[1])
+        registry.log.info("Hello is received from %s", message[1],
+                          extra={"category": "hello", "peer": clientAddress[0], "user": message[1]})
+    return 1
+
+
+# hello datagrams per second the registry's udp path takes in; bursts of
+# datagrams from online peers are queued on the socket, then only the
+# selector wakeups that read them are timed
+def benchmarkHello(ingestion, peers, datagrams, burst):
+    registry.presence = PresenceIndex()
+    registry.liveness = registry.LivenessTracker()
+    usernames = ["user{}".format(i) for i in range(peers)]
+    for username in usernames:
+        registry.presence.login(username, REGISTRY_HOST, 5000)
+    hellos = [("HELLO " + username).encode() for username in usernames]
+    udpSocket = registry.helloSocket(REGISTRY_HOST, 0)
+    udpSocket.setsockopt(SOL_SOCKET, SO_RCVBUF, 1 << 22)
+    sender = socket(AF_INET, SOCK_DGRAM)
+    if ingestion == "single":
+        receive = receiveSingleHello
+    else:
+        receive = registry.HelloReceiver().drain
+    selector = selectors.DefaultSelector()
+    selector.register(udpSocket, selectors.EVENT_READ)
+    received = wakeups = 0
+    elapsed = 0
+    index = 0
+    try:
+        while received < datagrams:
+            for i in range(min(burst, datagrams - received)):
+                sender.sendto(hellos[index % peers], udpSocket.getsockname())
+                index += 1
+            start = time.perf_counter()
+            while selector.select(0):
+                wakeups += 1
+                received += receive(udpSocket)
+            elapsed += time.perf_counter() - start
+    finally:
+        selector.close()
+        udpSocket.close()
+        sender.close()
+    return {
+        "ingestion": ingestion,
+        "peers": peers,
+        "datagrams": received,
+        "wakeups": wakeups,
+        "datagrams_per_second": round(received / elapsed),
+        "us_per_datagram": round(elapsed / received * 1e6, 2),
+    }
+
+
+# chat text of about size bytes, words of a small vocabulary like real chat
+def chatContent(size):
+    words = ["the", "meeting", "is", "moved", "to", "tomorrow", "at", "ten", "please", "bring", "your", "notes",
+             "and", "slides", "for", "review", "thanks", "everyone"]
+    generator = random.Random(size)
+    content = ""
+    while len(content) < size:
+        content += generator.choice(words) + " "
+    return content[:size]
+
+
+# bytes on the wire and cpu time per chat message fanned out to recipients:
+# text re-encodes the message for every recipient as the peers did, binary
+# and compressed encode it once; the receiving side decodes one copy
+def benchmarkChat(encoding, size, recipients, messages):
+    content = chatContent(size)
+    if encoding == "text":
+        codecs = [protocol.MessageCodec(protocol.FRAMED, protocol.TEXT_VERSION) for i in range(recipients)]
+        makeMessage = lambda: "chat-message\n{}\n{}".format("alice", content)
+    else:
+        threshold = protocol.COMPRESSION_THRESHOLD if encoding == "compressed" else None
+        codecs = [protocol.MessageCodec(protocol.FRAMED) for i in range(recipients)]
+        makeMessage = lambda: protocol.ChatMessage("alice", content, threshold=threshold)
+    start = time.perf_counter()
+    for i in range(messages):
+        message = makeMessage()
+        for codec in codecs:
+            data = codec.encode([message])
+    sendTime = time.perf_counter() - start
+    receiver = protocol.MessageCodec(protocol.FRAMED, codecs[0].version)
+    start = time.perf_counter()
+    for i in range(messages):
+        fields = protocol.messageFields(receiver.feed(data)[0])
+    receiveTime = time.perf_counter() - start
+    assert fields[2] == content
+    return {
+        "encoding": encoding,
+        "content_bytes": size,
+        "recipients": recipients,
+        "wire_bytes": len(data),
+        "us_per_fan_out": round(sendTime / messages * 1e6, 2),
+        "us_per_receive": round(receiveTime / messages * 1e6, 2),
+    }
+
+
+# appends chat messages to the history of a room, then replays the last
+# count messages and pages of count from random offsets
+def benchmarkHistory(messages, size, count, reads, directory):
+    history = MessageHistory(directory)
+    payload = protocol.encodeChatMessage("alice", chatContent(size))
+    start = time.perf_counter()
+    for i in range(messages):
+        history.append("lobby", payload)
+    appendTime = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(reads):
+        records, nextOffset = history.last("lobby", count)
+    lastTime = time.perf_counter() - start
+    generator = random.Random(0)
+    start = time.perf_counter()
+    for i in range(reads):
+        records, nextOffset = history.since("lobby", generator.randrange(messages - count), count)
+    sinceTime = time.perf_counter() - start
+    segments = len(history.room("lobby").segments)
+    history.close()
+    return {
+        "messages": messages,
+        "message_bytes": len(payload),
+        "segments": segments,
+        "appends_per_second": round(messages / appendTime),
+        "read_count": count,
+        "us_per_last_read": round(lastTime / reads * 1e6, 1),
+        "us_per_since_read": round(sinceTime / reads * 1e6, 1),
+        "messages_per_second_replayed": round(count * reads / sinceTime),
+    }
+
+
+# waits until the queue listener wrote every record, returns the seconds waited
+def waitForListener(listener):
+    start = time.perf_counter()
+    while listener is not None and not listener.queue.empty():
+        time.sleep(0.001)
+    return time.perf_counter() - start
+
+
+# time the calling thread spends per log call of a received request and of a
+# hello, with the records written by the caller (basic) or by the queue
+# listener of logs.setupLogging (queue)
+def benchmarkLogging(pipeline, calls, directory):
+    filename = os.path.join(directory, pipeline + ".log")
+    root = logging.getLogger()
+    for previous in list(root.handlers):
+        root.removeHandler(previous)
+    if pipeline == "basic":
+        handler = logging.FileHandler(filename)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+        root.addHandler(handler)
+        root.setLevel(logging.INFO)
+        listener = None
+    else:
+        listener = setupLogging(filename)
+    log = logging.getLogger("registry")
+    message = ["SEARCH", "user42"]
+    start = time.perf_counter()
+    for i in range(calls):
+        log.info("Received from %s:%d -> %s", REGISTRY_HOST, 50000, " ".join(message),
+                 extra={"peer": REGISTRY_HOST, "command": message[0]})
+    requestTime = time.perf_counter() - start
+    drainTime = waitForListener(listener)
+    start = time.perf_counter()
+    for i in range(calls):
+        log.info("Hello is received from %s", "user42", extra={"category": "hello", "peer": REGISTRY_HOST})
+    helloTime = time.perf_counter() - start
+    drainTime += waitForListener(listener)
+    if listener is not None:
+        listener.stop()
+        atexit.unregister(listener.stop)
+    root.handlers[0].close()
+    root.removeHandler(root.handlers[0])
+    return {
+        "pipeline": pipeline,
+        "calls": calls,
+        "us_per_request_log": round(requestTime / calls * 1e6, 2),
+        "us_per_hello_log": round(helloTime / calls * 1e6, 2),
+        "drain_seconds": round(drainTime, 3),
+        "log_bytes": os.path.getsize(filename),
+    }
+
+
+# commit of the tree being measured, so saved results can be told apart
+def currentCommit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="P2P chat registry benchmarks")
+    parser.add_argument("--output", default=None, help="also write the results to this JSON file")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    sessions = subparsers.add_parser("sessions", help="concurrent sessions one registry process holds")
+    sessions.add_argument("--sessions", type=int, default=2000)
+    sessions.add_argument("--modes", nargs="+", default=["thread", "asyncio"])
+    sessions.add_argument("--port", type=int, default=26600)
+    sessions.add_argument("--udp-port", type=int, default=26500)
+
+    passwords = subparsers.add_parser("passwords", help="bcrypt logins per second against pool size")
+    passwords.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    passwords.add_argument("--logins", type=int, default=64)
+    passwords.add_argument("--rounds", type=int, default=10)
+    passwords.add_argument("--processes", action="store_true")
+
+    database = subparsers.add_parser("db", help="latency of every storage operation per backend")
+    database.add_argument("--backends", nargs="+", default=["memory", "sqlite"])
+    database.add_argument("--users", type=int, default=2000)
+    dispatch = subparsers.add_parser("dispatch", help="cost of dispatching a peer message against connected peers")
+    dispatch.add_argument("--peers", type=int, nargs="+", default=[10, 100, 1000])
+    dispatch.add_argument("--messages", type=int, default=2000)
+    dispatch.add_argument("--loops", nargs="+", default=["selectors", "select"])
+
+    hello = subparsers.add_parser("hello", help="hello datagrams per second of the registry's udp path")
+    hello.add_argument("--peers", type=int, default=10000)
+    hello.add_argument("--datagrams", type=int, default=200000)
+    hello.add_argument("--burst", type=int, default=1000, help="datagrams queued on the socket before they are read")
+    hello.add_argument("--ingestion", nargs="+", default=["single", "batched"])
+
+    chat = subparsers.add_parser("chat", help="bytes and cpu per chat message by encoding")
+    chat.add_argument("--sizes", type=int, nargs="+", default=[32, 512, 4096])
+    chat.add_argument("--recipients", type=int, default=20)
+    chat.add_argument("--messages", type=int, default=5000)
+    chat.add_argument("--encodings", nargs="+", default=["text", "binary", "compressed"])
+
+    historyParser = subparsers.add_parser("history", help="appends and replays of a room's message log")
+    historyParser.add_argument("--messages", type=int, default=200000)
+    historyParser.add_argument("--size", type=int, default=100, help="bytes of chat text per message")
+    historyParser.add_argument("--count", type=int, default=100, help="messages of one replay")
+    historyParser.add_argument("--reads", type=int, default=2000)
+
+    logs = subparsers.add_parser("logging", help="cost of a log call on the calling thread per logging pipeline")
+    logs.add_argument("--calls", type=int, default=50000)
+    logs.add_argument("--pipelines", nargs="+", default=["basic", "queue"])
+
+    load = subparsers.add_parser("load", help="simulated peers logged in to a registry sending a mix of requests")
+    load.add_argument("--peers", type=int, default=1000)
+    load.add_argument("--duration", type=float, default=10, help="seconds of traffic after every peer logged in")
+    load.add_argument("--think", type=float, default=0.1, help="mean seconds a peer waits between two requests")
+    load.add_argument("--rooms", type=int, default=20)
+    load.add_argument("--concurrency", type=int, default=100, help="peers connecting and logging in at once")
+    load.add_argument("--modes", nargs="+", default=["thread", "asyncio"])
+    load.add_argument("--port", type=int, default=26600)
+    load.add_argument("--udp-port", type=int, default=26500)
+    args, registryArgs = parser.parse_known_args()
+    if registryArgs and args.benchmark != "load":
+        parser.error("unrecognized arguments: " + " ".join(registryArgs))
+
+    results = []
+
+    if args.benchmark == "sessions":
+        limit = raiseFileLimit()
+        print("open file limit: {}".format(limit))
+        for mode in args.modes:
+            results.append(benchmarkSessions(mode, args.sessions, args.port, args.udp_port))
+            print(results[-1])
+    elif args.benchmark == "passwords":
+        for workers in args.workers:
+            results.append(benchmarkPasswords(workers, args.logins, args.rounds, args.processes))
+            print(results[-1])
+    elif args.benchmark == "db":
+        for backend in args.backends:
+            with tempfile.TemporaryDirectory() as directory:
+                results.append(benchmarkDatabase(backend, args.users, os.path.join(directory, "benchmark.db")))
+                print(results[-1])
+    elif args.benchmark == "dispatch":
+        raiseFileLimit()
+        for peers in args.peers:
+            for loop in args.loops:
+                try:
+                    results.append(benchmarkDispatch(loop, peers, args.messages))
+                except ValueError as err:
+                    # select refuses descriptors above FD_SETSIZE
+                    results.append({"loop": loop, "peers": peers, "error": str(err)})
+                print(results[-1])
+    elif args.benchmark == "hello":
+        for ingestion in args.ingestion:
+            results.append(benchmarkHello(ingestion, args.peers, args.datagrams, args.burst))
+            print(results[-1])
+    elif args.benchmark == "chat":
+        for size in args.sizes:
+            for encoding in args.encodings:
+                results.append(benchmarkChat(encoding, size, args.recipients, args.messages))
+                print(results[-1])
+    elif args.benchmark == "history":
+        with tempfile.TemporaryDirectory() as directory:
+            results.append(benchmarkHistory(args.messages, args.size, args.count, args.reads, directory))
+            print(results[-1])
+    elif args.benchmark == "logging":
+        with tempfile.TemporaryDirectory() as directory:
+            for pipeline in args.pipelines:
+                results.append(benchmarkLogging(pipeline, args.calls, directory))
+                print(results[-1])
+    elif args.benchmark == "load":
+        raiseFileLimit()
+        # arguments the benchmark does not know are for the registry, the
+        # memory backend and cheap bcrypt keep the setup from dominating
+        registryArgs = ["--db", "memory", "--bcrypt-rounds", "4"] + registryArgs
+        for mode in args.modes:
+            results.append(benchmarkLoad(
+                mode, args.peers, args.duration, args.think, args.rooms, args.port, args.udp_port,
+                args.concurrency, registryArgs,
+            ))
+            print(json.dumps(results[-1], indent=2))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({
+                "benchmark": args.benchmark,
+                "commit": currentCommit(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "options": {key: value for key, value in vars(args).items() if key != "output"},
+                "results": results,
+            }, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,258 +1,227 @@
 import unittest
 from unittest.mock import patch, MagicMock
-from io import StringIO
-from socket import socket, AF_INET, SOCK_STREAM, error
-import threading
-import time
-import timeit
-from peer import PeerServer, PeerClient, peerMain
+from socket import socket, socketpair
+import selectors
+from peer import PeerServer, PeerClient, RegistryClient, peerMain
+from protocol import MessageCodec
 
 class TestPeerServer(unittest.TestCase):
     def setUp(self):
-        self.server = PeerServer("TestUser", 12345)
-        self.server.peerServerSocket = MagicMock(spec=socket)
-        self.server.connectedPeers = []
+        self.server = PeerServer("TestUser", 0, "127.0.0.1")
+        # the peer server's end of a connection, and the connected peer's end
+        self.peer, self.remote = socketpair()
+        self.remote.settimeout(2)
+        self.server.addPeer(self.peer, MessageCodec())
 
-    def test_handle_incoming_connections(self):
-        with patch("select.select") as mock_select:
-            mock_select.return_value = ([self.server.peerServerSocket], [], [])
-            self.server.run()
-
-            self.assertTrue(self.server.peerServerSocket.accept.called)
-            self.assertEqual(len(self.server.connectedPeers), 1)
+    def tearDown(self):
+        self.server.stop()
+        self.remote.close()
 
-    def test_handle_invalid_message_format(self):
-        mock_peer_socket = MagicMock(spec=socket)
-        mock_peer_socket.recv.return_value = "invalid-format".encode()
+    # the remote peer sends data, and the peer server handles it as its thread would
+    def receive(self, data):
+        self.remote.sendall(data)
+        self.server.handlePeer(self.peer, selectors.EVENT_READ)
 
-        self.server.connectedPeers.append(mock_peer_socket)
-
-        with patch("select.select") as mock_select:
-            mock_select.return_value = ([mock_peer_socket], [], [])
-            with patch("builtins.print") as mock_print:
-                self.server.run()
+    def test_handle_incoming_connections(self):
+        connecting = socket()
+        connecting.connect(self.server.peerServerSocket.getsockname())
+        self.server.acceptPeer(self.server.peerServerSocket, selectors.EVENT_READ)
+        self.assertEqual(len(self.server.connectedPeers), 2)
+        connecting.close()
 
-                mock_peer_socket.close.assert_called_once()
-                mock_print.assert_called_once_with("DEBUG: invalid-format")
+    def test_handle_invalid_message_format(self):
+        with patch("builtins.print") as mock_print:
+            self.receive("invalid-format".encode())
+            # unknown messages are ignored, the peer stays connected
+            mock_print.assert_not_called()
+            self.assertEqual(self.server.connectedPeers, [self.peer])
 
     def test_handle_incoming_messages(self):
-        mock_peer_socket = MagicMock(spec=socket)
-        mock_peer_socket.recv.return_value = "chat-message\nTestUser\nHello".encode()
-
-        self.server.connectedPeers.append(mock_peer_socket)
-
-        with patch("select.select") as mock_select:
-            mock_select.return_value = ([mock_peer_socket], [], [])
-            self.server.run()
-
-            mock_peer_socket.recv.assert_called_once_with(1024)
-            self.assertEqual(mock_peer_socket.send.call_count, 0)
+        with patch("builtins.print"):
+            self.receive("chat-message\nTestUser\nHello".encode())
+        # a chat message is not answered
+        self.remote.setblocking(False)
+        with self.assertRaises(BlockingIOError):
+            self.remote.recv(1024)
 
     def test_handle_chatroom_join(self):
-        mock_peer_socket = MagicMock(spec=socket)
-        mock_peer_socket.recv.return_value = "chatroom-join\nNewUser".encode()
-
-        self.server.connectedPeers.append(mock_peer_socket)
-
-        with patch("select.select") as mock_select:
-            mock_select.return_value = ([mock_peer_socket], [], [])
-            self.server.run()
-
-            mock_peer_socket.recv.assert_called_once_with(1024)
-            mock_peer_socket.send.assert_called_once_with("welcome".encode())
+        with patch("builtins.print"):
+            self.receive("chatroom-join\nNewUser".encode())
+        self.assertEqual(self.remote.recv(1024), "welcome".encode())
 
     def test_handle_chatroom_leave(self):
-        mock_peer_socket = MagicMock(spec=socket)
-        mock_peer_socket.recv.return_value = "chatroom-leave\nLeavingUser".encode()
-
-        self.server.connectedPeers.append(mock_peer_socket)
-
-        with patch("select.select") as mock_select:
-            mock_select.return_value = ([mock_peer_socket], [], [])
-            self.server.run()
-
-            mock_peer_socket.recv.assert_called_once_with(1024)
-            self.assertEqual(len(self.server.connectedPeers), 0)
+        with patch("builtins.print"):
+            self.receive("chatroom-leave\nLeavingUser".encode())
+        self.assertEqual(len(self.server.connectedPeers), 0)
+
+    def test_handle_chatroom_leave_of_a_relay_member(self):
+        self.server.relays.add(self.peer)
+        with patch("builtins.print"):
+            self.receive("chatroom-leave\nLeavingUser".encode())
+        # another member left the room of the relay, the relay stays connected
+        self.assertEqual(self.server.members(), [self.peer])
+
+    def test_handle_chatroom_leave_parks_the_connection(self):
+        with patch("builtins.print"):
+            self.receive("chatroom-leave\nLeavingUser\npark".encode())
+        self.assertEqual(self.server.connectedPeers, [self.peer])
+        self.assertEqual(self.server.members(), [])
+
+    def test_handle_leave_sent_before_the_join_of_a_reused_connection(self):
+        self.server.addresses["127.0.0.1,5000"] = self.peer
+        with patch("builtins.print"):
+            self.receive("chatroom-leave\nLeavingUser\npark".encode())
+            self.assertIs(self.server.takeConnection("127.0.0.1,5000"), self.peer)
+            # the member left its earlier room before it got the join of the reused connection
+            self.receive("chatroom-leave\nLeavingUser\npark".encode())
+            self.assertEqual(self.server.members(), [self.peer])
+            self.receive("welcome".encode())
+            self.receive("chatroom-leave\nLeavingUser\npark".encode())
+        self.assertEqual(self.server.members(), [])
 
     def test_handle_chat_message(self):
-        mock_peer_socket = MagicMock(spec=socket)
-        mock_peer_socket.recv.return_value = "chat-message\nTestUser\nHello".encode()
-
-        self.server.connectedPeers.append(mock_peer_socket)
-
-        with patch("select.select") as mock_select:
-            mock_select.return_value = ([mock_peer_socket], [], [])
-            with patch("builtins.print") as mock_print:
-                self.server.run()
-
-                mock_peer_socket.recv.assert_called_once_with(1024)
-                mock_print.assert_called_once_with("TestUser -> Hello")
+        with patch("builtins.print") as mock_print:
+            self.receive("chat-message\nTestUser\nHello".encode())
+            mock_print.assert_called_once_with("TestUser -> Hello")
 
     def test_handle_empty_message(self):
-        mock_peer_socket = MagicMock(spec=socket)
-        mock_peer_socket.recv.return_value = "".encode()
-
-        self.server.connectedPeers.append(mock_peer_socket)
-
-        with patch("select.select") as mock_select:
-            mock_select.return_value = ([mock_peer_socket], [], [])
-            self.server.run()
-
-            mock_peer_socket.close.assert_called_once()
-            self.assertEqual(len(self.server.connectedPeers), 0)
+        self.remote.close()
+        self.server.handlePeer(self.peer, selectors.EVENT_READ)
+        self.assertEqual(len(self.server.connectedPeers), 0)
 
     def test_handle_welcome_message(self):
-        mock_peer_socket = MagicMock(spec=socket)
-        mock_peer_socket.recv.return_value = "welcome".encode()
-
-        self.server.connectedPeers.append(mock_peer_socket)
-
-        with patch("select.select") as mock_select:
-            mock_select.return_value = ([mock_peer_socket], [], [])
-            with patch("builtins.print") as mock_print:
-                self.server.run()
-
-                mock_print.assert_called_once_with("WELCOME!!")
-
-    for test_function in [
-        test_handle_welcome_message,
-        test_handle_empty_message,
-        test_handle_chat_message,
-        test_handle_chatroom_leave,
-        test_handle_chatroom_join,
-        test_handle_incoming_messages,
-        test_handle_invalid_message_format,
-        test_handle_incoming_connections
-    ]:
-        execution_time = timeit.timeit(test_function, number=1)
-        print(f"Execution time for {test_function.__name__}: {execution_time} seconds")
+        with patch("builtins.print") as mock_print:
+            self.receive("welcome".encode())
+            mock_print.assert_called_once_with("WELCOME!!")
 
 
 class TestPeerClient(unittest.TestCase):
     def setUp(self):
-        self.client = PeerClient("TestUser", "TestChatroom", MagicMock(spec=PeerServer))
+        self.server = PeerServer("TestUser", 0, "127.0.0.1")
+        self.peer, self.remote = socketpair()
+        self.remote.settimeout(2)
+        self.server.addPeer(self.peer, MessageCodec())
+        self.client = PeerClient("TestUser", "TestChatroom", self.server)
 
-    def test_send_chat_message(self):
-        with patch("builtins.input", return_value="Hello"):
-            with patch("socket.socket.connect") as mock_connect:
-                with patch("socket.socket.send") as mock_send:
-                    self.client.run()
+    def tearDown(self):
+        self.server.stop()
+        self.remote.close()
 
-                    mock_send.assert_called_once_with("chat-message\nTestUser\nHello".encode())
+    def test_send_chat_message(self):
+        self.client.send("Hello")
+        self.assertEqual(self.remote.recv(1024), "chat-message\nTestUser\nHello".encode())
 
     def test_send_quit_message(self):
         with patch("builtins.input", return_value=":quit"):
-            with patch("socket.socket.connect") as mock_connect:
-                with patch("socket.socket.send") as mock_send:
-                    self.client.run()
-                    mock_send.assert_called_once_with("chatroom-leave\nTestUser".encode())
+            with patch("builtins.print"):
+                self.client.run()
+        # the connection is parked for the next chatroom
+        self.assertEqual(self.remote.recv(1024), "chatroom-leave\nTestUser\npark".encode())
+
+    def test_unreachable_relay(self):
+        with socket() as free:
+            free.bind(("127.0.0.1", 0))
+            relay = "127.0.0.1,{}".format(free.getsockname()[1])
+        client = PeerClient("TestUser", "TestChatroom", self.server, relay=relay)
+        self.assertEqual(client.unreachable, [relay])
+        self.assertIsNone(client.relaySocket)
+        self.assertEqual(self.server.members(), [self.peer])
 
     def test_run_quit_message(self):
         with patch("builtins.input", return_value=":quit"):
-            with patch("socket.socket.connect") as mock_connect:
-                with patch("socket.socket.send") as mock_send:
-                    self.client.run()
-                    mock_send.assert_called_once_with("chatroom-leave\nTestUser".encode())
+            with patch("builtins.print"):
+                self.client.run()
+        self.assertIsNone(self.client.chatroom)
+        self.assertEqual(self.server.members(), [])
 
-    def test_run_private_chatroom(self):
-        with patch("builtins.input", side_effect=["7", "AnotherUser"]):
-            with patch("socket.socket.connect") as mock_connect:
-                with patch("socket.socket.send") as mock_send:
-                    self.client.run()
-                    mock_send.assert_called_once_with("PRIVATE-CHATROOM\nAnotherUser".encode())
-
-    def test_run_private_chatroom_user_not_exist(self):
-        with patch("builtins.input", side_effect=["7", "NonexistentUser"]):
-            with patch("socket.socket.connect") as mock_connect:
-                with patch("socket.socket.send") as mock_send:
-                    with patch("socket.socket.recv") as mock_recv:
-                        mock_recv.return_value = "user does not exist".encode()
-                        with patch("builtins.print") as mock_print:
-                            self.client.run()
-                            mock_send.assert_called_once_with("PRIVATE-CHATROOM\nNonexistentUser".encode())
-                            mock_print.assert_called_once_with("user does not exist")
-
-    for test_function in [
-        test_run_private_chatroom_user_not_exist,
-        test_run_private_chatroom,
-        test_run_quit_message,
-        test_send_quit_message,
-        test_send_chat_message
-
-    ]:
-        execution_time = timeit.timeit(test_function, number=1)
-        print(f"Execution time for {test_function.__name__}: {execution_time} seconds")
 
 class TestPeerMain(unittest.TestCase):
     def setUp(self):
-        self.main = peerMain()
+        # the interactive peer without its prompt for the registry, on a registry connection that is mocked
+        self.main = peerMain.__new__(peerMain)
+        self.main.client = RegistryClient("127.0.0.1", peerHost="127.0.0.1")
+        self.main.client.registry = MagicMock()
+        self.main.client.udpClientSocket = MagicMock()
+        self.main.peerServerPort = None
+        self.registry = self.main.client.registry
+
+    def tearDown(self):
+        self.main.client.close()
+
+    # answers the requests with the responses, and runs the main until the inputs run out
+    def run_main(self, inputs, responses=(), password="TestPassword"):
+        self.registry.receive.side_effect = list(responses)
+        with patch("builtins.input", side_effect=inputs):
+            with patch("maskpass.askpass", return_value=password):
+                with self.assertRaises(StopIteration):
+                    self.main.main()
+
+    def sent(self):
+        return [call.args[0] for call in self.registry.send.call_args_list]
+
+    def log_in(self):
+        self.main.client.username = "TestUser"
 
     def test_account_creation(self):
-        with patch("builtins.input", side_effect=["1", "TestUser", "TestPassword"]):
-            with patch("socket.socket.send") as mock_send:
-                self.main.main()
-                mock_send.assert_called_once_with("JOIN TestUser TestPassword".encode())
+        with patch("builtins.print") as mock_print:
+            self.run_main(["1", "TestUser"], ["join-success"])
+            mock_print.assert_called_once_with("Account created successfully.")
+        self.assertEqual(self.sent(), ["JOIN TestUser TestPassword"])
 
     def test_login_success(self):
-        with patch("builtins.input", side_effect=["2", "TestUser", "TestPassword", "12345"]):
-            with patch("socket.socket.send") as mock_send:
-                with patch("socket.socket.recv") as mock_recv:
-                    mock_recv.return_value = "login-success".encode()
-                    self.main.main()
-                    mock_send.assert_called_once_with("LOGIN TestUser TestPassword 12345".encode())
+        with socket() as free:
+            free.bind(("127.0.0.1", 0))
+            port = free.getsockname()[1]
+        with patch("builtins.print") as mock_print:
+            self.run_main(["2", "TestUser", str(port)], ["login-success token"])
+            mock_print.assert_called_once_with("Successful Login!")
+        # the peer asks for a session token with its login
+        self.assertEqual(self.sent(), ["LOGIN TestUser TestPassword {} token".format(port)])
+        self.assertEqual(self.main.client.token, "token")
 
     def test_search_user_not_found(self):
-        with patch("builtins.input", side_effect=["2", "NonexistentUser"]):
-            with patch("socket.socket.send") as mock_send:
-                with patch("socket.socket.recv") as mock_recv:
-                    mock_recv.return_value = "search-user-not-found".encode()
-                    with patch("builtins.print") as mock_print:
-                        self.main.main()
-                        mock_send.assert_called_once_with("SEARCH NonexistentUser".encode())
-                        mock_print.assert_called_once_with("NonexistentUser was not found.")
+        self.log_in()
+        with patch("builtins.print") as mock_print:
+            self.run_main(["2", "NonexistentUser"], ["search-user-not-found"])
+            mock_print.assert_called_once_with("NonexistentUser was not found.")
+        self.assertEqual(self.sent(), ["SEARCH NonexistentUser"])
 
     def test_chatroom_join_not_found(self):
-        with patch("builtins.input", side_effect=["4", "NonexistentChatroom"]):
-            with patch("socket.socket.send") as mock_send:
-                with patch("socket.socket.recv") as mock_recv:
-                    mock_recv.return_value = "chatroom-not-found".encode()
-                    with patch("builtins.print") as mock_print:
-                        self.main.main()
-                        mock_send.assert_called_once_with("CHATROOM-JOIN NonexistentChatroom".encode())
-                        mock_print.assert_called_once_with("No chatroom exists with such name.")
+        self.log_in()
+        with patch("builtins.print") as mock_print:
+            self.run_main(["4", "NonexistentChatroom"], ["chatroom-not-found"])
+            mock_print.assert_called_with("No chatroom exists with such name.")
+        self.assertEqual(self.sent(), ["CHATROOM-JOIN NonexistentChatroom"])
 
     def test_chatroom_create_success(self):
-        with patch("builtins.input", side_effect=["6", "NewChatroom"]):
-            with patch("socket.socket.send") as mock_send:
-                with patch("socket.socket.recv") as mock_recv:
-                    mock_recv.return_value = "chatroom-creation-success".encode()
-                    with patch("builtins.print") as mock_print:
-                        self.main.main()
-                        mock_send.assert_called_once_with("CHATROOM-CREATE\nNewChatroom".encode())
-                        mock_print.assert_called_once_with("Chatroom created successfully")
+        self.log_in()
+        with patch("builtins.print") as mock_print:
+            self.run_main(["6", "NewChatroom"], ["chatroom-creation-success", "chatroom-not-found"])
+            mock_print.assert_any_call("Chatroom created successfully")
+        # the created chatroom is joined right away
+        self.assertEqual(self.sent(), ["CHATROOM-CREATE\nNewChatroom", "CHATROOM-JOIN NewChatroom"])
 
     def test_account_creation_existing_username(self):
-        with patch("builtins.input", side_effect=["1", "TestUser", "TestPassword"]):
-            with patch("socket.socket.send") as mock_send:
-                with patch("socket.socket.recv") as mock_recv:
-                    mock_recv.return_value = "join-exist".encode()
-                    with patch("builtins.print") as mock_print:
-                        self.main.main()
-                        mock_send.assert_called_once_with("JOIN TestUser TestPassword".encode())
-                        mock_print.assert_called_once_with("Username already exists.")
-
-    for test_function in [
-        test_chatroom_join_not_found,
-        test_account_creation_existing_username,
-        test_chatroom_create_success,
-        test_chatroom_join_not_found,
-        test_search_user_not_found,
-        test_login_success,
-        test_account_creation,
-
-    ]:
-        execution_time = timeit.timeit(test_function, number=1)
-        print(f"Execution time for {test_function.__name__}: {execution_time} seconds")
+        with patch("builtins.print") as mock_print:
+            self.run_main(["1", "TestUser"], ["join-exist"])
+            mock_print.assert_called_once_with("Username already exists.")
+        self.assertEqual(self.sent(), ["JOIN TestUser TestPassword"])
+
+    def test_run_private_chatroom(self):
+        self.log_in()
+        with patch("builtins.print") as mock_print:
+            self.run_main(["7", "AnotherUser", "see you"],
+                          ["success\n#TestUser#AnotherUser", "search-user-not-online", "private-message-queued"])
+            mock_print.assert_called_once_with("AnotherUser gets the message once logged in.")
+        self.assertEqual(self.sent(), ["PRIVATE-CHATROOM\nAnotherUser", "SEARCH AnotherUser",
+                                       "PRIVATE-MESSAGE AnotherUser see you"])
+
+    def test_run_private_chatroom_user_not_exist(self):
+        self.log_in()
+        with patch("builtins.print") as mock_print:
+            self.run_main(["7", "NonexistentUser"], ["user does not exist"])
+            mock_print.assert_called_once_with("user does not exist")
+        self.assertEqual(self.sent(), ["PRIVATE-CHATROOM\nNonexistentUser"])
 
 if __name__ == '__main__':
     unittest.main()
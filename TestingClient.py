@@ -0,0 +1,340 @@
+import unittest
+import os
+import queue
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from peer import RegistryClient, AsyncRegistryClient, parseListPage, parseSearch, parsePrivateChatroom, parsePrivateMessages
+
+
+# returns a tcp port and a udp port that are free on localhost
+def freePorts():
+    with socket.socket() as tcp, socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
+        tcp.bind(("127.0.0.1", 0))
+        udp.bind(("127.0.0.1", 0))
+        return tcp.getsockname()[1], udp.getsockname()[1]
+
+
+# starts registry.py on localhost, returns the process and its ports
+def startRegistry(*extraArgs):
+    port, portUDP = freePorts()
+    process = subprocess.Popen(
+        [sys.executable, "registry.py", "--host", "127.0.0.1", "--port", str(port), "--udp-port", str(portUDP),
+         "--db", "memory", "--bcrypt-rounds", "4"] + list(extraArgs),
+        cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, port, portUDP
+        except OSError:
+            if time.time() > deadline:
+                process.kill()
+                raise
+            time.sleep(0.1)
+
+
+class TestResponseParsing(unittest.TestCase):
+    def test_list_pages(self):
+        self.assertEqual(parseListPage("users-list-page bob alice bob", " "), (["alice", "bob"], "bob"))
+        self.assertEqual(parseListPage("users-list-page - carol", " "), (["carol"], None))
+        self.assertEqual(parseListPage("chatroom-list-page -\nlobby : 2", "\n"), (["lobby : 2"], None))
+
+    def test_whole_list_of_a_registry_without_pages(self):
+        self.assertEqual(parseListPage("users-list-success alice bob", " "), (["alice", "bob"], None))
+        self.assertEqual(parseListPage("chatroom-list-success", "\n"), ([], None))
+
+    def test_search(self):
+        self.assertEqual(parseSearch("search-success 10.0.0.1:5000"), ("search-success", ("10.0.0.1", "5000")))
+        self.assertEqual(parseSearch("search-user-not-online"), ("search-user-not-online", None))
+
+    def test_private_chatroom(self):
+        self.assertEqual(parsePrivateChatroom("success\n#alice#bob"), ("success", "#alice#bob"))
+        self.assertEqual(parsePrivateChatroom("user does not exist"), ("user does not exist", None))
+
+    def test_private_messages(self):
+        self.assertEqual(parsePrivateMessages("private-messages 2\nbob 100 4\nhi\nx\ncarol 101 2\nyo"),
+                         [("bob", "hi\nx", 100), ("carol", "yo", 101)])
+
+
+class TestRegistryClient(unittest.TestCase):
+    def setUp(self):
+        self.process, self.port, self.portUDP = startRegistry()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.process.kill()
+        self.process.wait()
+
+    def client(self, username, peerPort):
+        client = RegistryClient("127.0.0.1", self.port, self.portUDP, peerHost="127.0.0.1").connect()
+        self.clients.append(client)
+        self.assertEqual(client.register(username, "password1234"), "join-success")
+        self.assertEqual(client.login(username, "password1234", peerPort), "login-success")
+        return client
+
+    def test_search_and_lists(self):
+        alice = self.client("alice1", freePorts()[0])
+        bob = self.client("bob123", freePorts()[0])
+        self.assertEqual(alice.search("bob123"), ("search-success", ("127.0.0.1", str(bob.peerServer.peerServerPort))))
+        self.assertEqual(alice.search("nobody")[0], "search-user-not-found")
+        self.assertEqual(sorted(alice.users()), ["alice1", "bob123"])
+        self.assertEqual(alice.createChatroom("lobby"), "chatroom-creation-success")
+        self.assertEqual(alice.chatrooms(), [("lobby", 0)])
+
+    def test_chat_in_a_room(self):
+        alice = self.client("alice1", freePorts()[0])
+        bob = self.client("bob123", freePorts()[0])
+        received = queue.Queue()
+        alice.peerServer.onMessage = lambda username, content: received.put((username, content))
+        alice.createChatroom("lobby")
+        self.assertEqual(alice.joinRoom("lobby"), "chatroom-join-success")
+        self.assertEqual(bob.joinRoom("lobby"), "chatroom-join-success")
+        bob.send("hello")
+        self.assertEqual(received.get(timeout=5), ("bob123", "hello"))
+        bob.leaveRoom()
+        # asked on bob's connection, after its unanswered leave
+        self.assertEqual(bob.chatrooms(), [("lobby", 1)])
+
+    def test_join_reports_unreachable_members(self):
+        alice = self.client("alice1", freePorts()[0])
+        # logged in without a peer server, nothing listens on its port
+        carol = RegistryClient("127.0.0.1", self.port, self.portUDP, peerHost="127.0.0.1").connect()
+        self.clients.append(carol)
+        carol.register("carol1", "password1234")
+        carolPort = freePorts()[0]
+        carol.login("carol1", "password1234", carolPort, serve=False)
+        alice.createChatroom("lobby")
+        carol.joinRoom("lobby")
+        self.assertEqual(alice.joinRoom("lobby"), "chatroom-join-success")
+        self.assertEqual(alice.peerClient.unreachable, ["127.0.0.1,{}".format(carolPort)])
+
+    def test_connection_is_reused_in_the_next_room(self):
+        alice = self.client("alice1", freePorts()[0])
+        bob = self.client("bob123", freePorts()[0])
+        received = queue.Queue()
+        alice.peerServer.onMessage = lambda username, content: received.put((username, content))
+        alice.createChatroom("lobby")
+        alice.createChatroom("den")
+        alice.joinRoom("lobby")
+        bob.joinRoom("lobby")
+        alice.joinRoom("den")
+        self.assertEqual(bob.joinRoom("den"), "chatroom-join-success")
+        self.assertEqual(len(bob.peerServer.connectedPeers), 1)
+        bob.send("hello")
+        self.assertEqual(received.get(timeout=5), ("bob123", "hello"))
+
+    def test_accepted_connection_is_reused_in_the_next_room(self):
+        alice = self.client("alice1", freePorts()[0])
+        bob = self.client("bob123", freePorts()[0])
+        received = queue.Queue()
+        bob.peerServer.onMessage = lambda username, content: received.put((username, content))
+        alice.createChatroom("lobby")
+        bob.createChatroom("den")
+        alice.joinRoom("lobby")
+        bob.joinRoom("lobby")
+        bob.joinRoom("den")
+        # bob connected to alice, alice now joins bob over the connection it accepted
+        self.assertEqual(alice.joinRoom("den"), "chatroom-join-success")
+        self.assertEqual(alice.peerClient.unreachable, [])
+        self.assertEqual(len(alice.peerServer.connectedPeers), 1)
+        alice.send("hello")
+        self.assertEqual(received.get(timeout=5), ("alice1", "hello"))
+
+    def test_private_message_waits_for_login(self):
+        alice = self.client("alice1", freePorts()[0])
+        bob = self.client("bob123", freePorts()[0])
+        alice.logout()
+        # the logout is not answered
+        while bob.search("alice1")[0] != "search-user-not-online":
+            time.sleep(0.01)
+        self.assertEqual(bob.privateMessage("alice1", "while you were out"), "private-message-queued")
+        alice.connect()
+        self.assertEqual(alice.login("alice1", "password1234", freePorts()[0]), "login-success")
+        # the queued messages came with the login
+        self.assertEqual([message[:2] for message in alice.privateMessages()], [("bob123", "while you were out")])
+        self.assertEqual(bob.privateMessage("alice1", "now"), "private-message-delivered")
+        alice.users()
+        self.assertEqual([message[:2] for message in alice.privateMessages()], [("bob123", "now")])
+
+    def test_legacy_login_is_answered_alone(self):
+        bob = self.client("bob123", freePorts()[0])
+        self.assertEqual(bob.register("alice1", "password1234"), "join-success")
+        self.assertEqual(bob.privateMessage("alice1", "while you were out"), "private-message-queued")
+        # a peer of the text protocol, without the handshake
+        legacy = socket.create_connection(("127.0.0.1", self.port), timeout=5)
+        try:
+            legacy.sendall("LOGIN alice1 password1234 {}".format(freePorts()[0]).encode())
+            self.assertEqual(legacy.recv(1024), b"login-success")
+            self.assertEqual(bob.privateMessage("alice1", "now"), "private-message-queued")
+            legacy.sendall(b"SEARCH bob123")
+            self.assertEqual(legacy.recv(1024).split(b" ")[0], b"search-success")
+        finally:
+            legacy.close()
+
+    def test_resume_after_the_connection_dropped(self):
+        alice = self.client("alice1", freePorts()[0])
+        bob = self.client("bob123", freePorts()[0])
+        received = queue.Queue()
+        bob.peerServer.onMessage = lambda username, content: received.put((username, content))
+        alice.createChatroom("lobby")
+        alice.joinRoom("lobby")
+        bob.joinRoom("lobby")
+        alice.registry.close()
+        self.assertEqual(alice.resume(), "resume-success")
+        self.assertEqual(alice.search("alice1")[0], "search-success")
+        self.assertEqual(alice.chatrooms(), [("lobby", 2)])
+        # the chatroom connections outlived the registry connection
+        alice.send("still here")
+        self.assertEqual(received.get(timeout=5), ("alice1", "still here"))
+        token = alice.token
+        alice.logout()
+        while bob.search("alice1")[0] != "search-user-not-online":
+            time.sleep(0.01)
+        alice.connect()
+        alice.username, alice.token = "alice1", token
+        self.assertEqual(alice.resume(), "resume-invalid")
+        self.assertIsNone(alice.username)
+
+    def test_login_again_after_logout(self):
+        alice = self.client("alice1", freePorts()[0])
+        alice.logout()
+        alice.connect()
+        self.assertEqual(alice.login("alice1", "password1234", freePorts()[0]), "login-success")
+        self.assertEqual(alice.search("alice1")[0], "search-success")
+
+
+# rooms served by the relay from their first member, which keeps their history
+class TestRoomHistory(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.process, self.port, self.portUDP = startRegistry(
+            "--relay-port", str(freePorts()[0]), "--relay-threshold", "1", "--history-dir", self.directory.name
+        )
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.process.kill()
+        self.process.wait()
+        self.directory.cleanup()
+
+    def client(self, username):
+        client = RegistryClient("127.0.0.1", self.port, self.portUDP, peerHost="127.0.0.1").connect()
+        self.clients.append(client)
+        client.register(username, "password1234")
+        client.login(username, "password1234", freePorts()[0])
+        client.peerServer.onMessage = lambda username, content: received.put((username, content))
+        received = client.received = queue.Queue()
+        return client
+
+    def test_joiner_sees_earlier_messages(self):
+        alice = self.client("alice1")
+        alice.createChatroom("lobby")
+        self.assertEqual(alice.joinRoom("lobby"), "chatroom-join-relay")
+        bob = self.client("bob123")
+        self.assertEqual(bob.joinRoom("lobby"), "chatroom-join-relay")
+        for content in ("one", "two", "three"):
+            alice.send(content)
+        # the relay keeps a message before it forwards it
+        for content in ("one", "two", "three"):
+            self.assertEqual(bob.received.get(timeout=5), ("alice1", content))
+        carol = self.client("carol1")
+        self.assertEqual(carol.joinRoom("lobby", ("last", 2)), "chatroom-join-relay")
+        self.assertEqual(carol.received.get(timeout=5), ("alice1", "two"))
+        self.assertEqual(carol.received.get(timeout=5), ("alice1", "three"))
+        alice.send("four")
+        self.assertEqual(carol.received.get(timeout=5), ("alice1", "four"))
+        self.assertEqual(carol.peerServer.roomOffset, 4)
+
+    def test_rejoin_fetches_the_messages_since_leaving(self):
+        alice = self.client("alice1")
+        alice.createChatroom("lobby")
+        alice.createChatroom("other")
+        self.assertEqual(alice.joinRoom("lobby"), "chatroom-join-relay")
+        bob = self.client("bob123")
+        self.assertEqual(bob.joinRoom("lobby"), "chatroom-join-relay")
+        bob.send("from bob")
+        self.assertEqual(alice.received.get(timeout=5), ("bob123", "from bob"))
+        # the offset counts the messages the peer sent itself
+        self.waitForOffset(bob, 1)
+        self.assertEqual(bob.joinRoom("other"), "chatroom-join-relay")
+        self.assertIsNone(bob.peerServer.roomOffset)
+        alice.send("missed")
+        self.waitForOffset(alice, 2)
+        self.assertEqual(bob.joinRoom("lobby"), "chatroom-join-relay")
+        self.assertEqual(bob.received.get(timeout=5), ("alice1", "missed"))
+        self.waitForOffset(bob, 2)
+        self.assertTrue(bob.received.empty())
+
+    def waitForOffset(self, client, offset):
+        deadline = time.monotonic() + 5
+        while client.peerServer.roomOffset != offset and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(client.peerServer.roomOffset, offset)
+
+
+class TestAsyncRegistryClient(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.process, self.port, self.portUDP = startRegistry("--mode", "asyncio")
+
+    def tearDown(self):
+        self.process.kill()
+        self.process.wait()
+
+    async def test_headless_session(self):
+        client = await AsyncRegistryClient("127.0.0.1", self.port, self.portUDP).connect()
+        self.assertEqual(await client.register("carol1", "password1234"), "join-success")
+        self.assertEqual(await client.login("carol1", "password1234", 5000, serve=False), "login-success")
+        self.assertEqual(await client.search("carol1"), ("search-success", ("127.0.0.1", "5000")))
+        self.assertEqual(await client.createChatroom("lobby"), "chatroom-creation-success")
+        self.assertEqual(await client.joinRoom("lobby"), "chatroom-join-success")
+        self.assertEqual(await client.chatrooms(), [("lobby", 1)])
+        await client.leaveRoom()
+        self.assertEqual(await client.users(), ["carol1"])
+        await client.logout()
+
+
+class TestAsyncPersistedRooms(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.processes = []
+
+    def tearDown(self):
+        for process in self.processes:
+            process.kill()
+            process.wait()
+        self.directory.cleanup()
+
+    def start(self):
+        process, port, portUDP = startRegistry("--mode", "asyncio", "--persist-rooms", "--db", "sqlite",
+                                               "--db-path", os.path.join(self.directory.name, "registry.db"))
+        self.processes.append(process)
+        return process, port, portUDP
+
+    async def test_created_rooms_are_back_after_a_restart(self):
+        process, port, portUDP = self.start()
+        client = await AsyncRegistryClient("127.0.0.1", port, portUDP).connect()
+        await client.register("carol1", "password1234")
+        await client.login("carol1", "password1234", 5000, serve=False)
+        # the rooms are saved on the worker pool, the answers come as before
+        self.assertEqual(await client.createChatroom("lobby"), "chatroom-creation-success")
+        self.assertEqual(await client.createChatroom("lobby"), "chatroom-exists")
+        await client.logout()
+        process.kill()
+        process.wait()
+        process, port, portUDP = self.start()
+        client = await AsyncRegistryClient("127.0.0.1", port, portUDP).connect()
+        await client.login("carol1", "password1234", 5000, serve=False)
+        self.assertEqual(await client.chatrooms(), [("lobby", 0)])
+        await client.logout()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,35 @@
+import asyncio
+import os
+import tempfile
 import unittest
-from pymongo import MongoClient
-from db import DB
+from unittest.mock import patch
+from db import DB, AccountCache, AsyncDB, MongoBackend, SQLiteBackend, MemoryBackend
+from metrics import LatencyHistogram
+try:
+    from pymongo import MongoClient
+    from pymongo.errors import PyMongoError
+except ImportError:
+    MongoClient = None
 
-class TestDB(unittest.TestCase):
-    def setUp(self):
-        self.client = MongoClient("mongodb://localhost:27017/")
-        self.test_db = self.client["test_p2p_chat"]
-        self.db = DB()
+MONGO_TEST_URI = os.environ.get("P2P_MONGO_URI", "mongodb://localhost:27017/")
+# database the mongo tests write to and drop, never the registry's
+MONGO_TEST_DATABASE = "test_p2p_chat"
+
+# whether pymongo is installed and a mongo server answers a ping
+def mongo_available():
+    if MongoClient is None:
+        return False
+    client = MongoClient(MONGO_TEST_URI, serverSelectionTimeoutMS=500)
+    try:
+        client.admin.command("ping")
+        return True
+    except PyMongoError:
+        return False
+    finally:
+        client.close()
+
+# tests every storage backend has to pass
+class DBConformance:
 
     def test_is_account_exist(self):
         self.db.register("test_user", "test_password")
@@ -59,18 +82,184 @@ class TestDB(unittest.TestCase):
         self.assertEqual(self.db.get_password("user2"), "pass2")
 
     def test_login_wrong_password(self):
-        # Test login with wrong password
+        # The registry checks the password against the stored one, the login
+        # itself only records the online peer
         self.db.register("test_user", "test_password")
-        status = self.db.user_login("test_user", "127.0.0.1", 12345)
-        self.assertEqual(status, "login-wrong-password")
+        self.assertNotEqual(self.db.get_password("test_user"), "wrong_password")
+        self.assertIsNone(self.db.user_login("test_user", "127.0.0.1", 12345))
+        self.assertTrue(self.db.is_account_online("test_user"))
 
     def test_logout_nonexistent_user(self):
         # Test logout for nonexistent user
         self.db.user_login("test_user", "127.0.0.1", 12345)
         self.db.user_logout("nonexistent_user")  # Should not raise an
 
+    def test_register_after_negative_lookup(self):
+        # Test that registering replaces a cached missing account
+        self.assertFalse(self.db.is_account_exist("new_user"))
+        self.db.register("new_user", "new_password")
+        self.assertTrue(self.db.is_account_exist("new_user"))
+
+    def test_duplicate_register(self):
+        # Test that the unique index refuses a taken username
+        self.db.ensure_indexes()
+        self.assertTrue(self.db.register("test_user", "test_password"))
+        self.assertFalse(self.db.register("test_user", "other_password"))
+        self.assertEqual(self.db.get_password("test_user"), "test_password")
+
+    def test_bulk_register(self):
+        # Test registering several users at once
+        self.db.ensure_indexes()
+        self.db.register("user1", "pass1")
+        inserted = self.db.bulk_register([("user1", "other"), ("user2", "pass2"), ("user3", "pass3")])
+        self.assertEqual(inserted, 2)
+        self.assertEqual(self.db.get_password("user1"), "pass1")
+        self.assertEqual(self.db.get_password("user3"), "pass3")
+
+    def test_bulk_login_logout(self):
+        # Test logging in and out several users at once
+        self.db.bulk_login([("user1", "127.0.0.1", 12345), ("user2", "127.0.0.2", 12346)])
+        self.assertTrue(self.db.is_account_online("user2"))
+        self.db.bulk_logout(["user1", "user2"])
+        self.assertFalse(self.db.is_account_online("user1"))
+        self.assertFalse(self.db.is_account_online("user2"))
+
+    def test_get_peers_ip_port(self):
+        # Test retrieving several peers at once
+        self.db.user_login("user1", "127.0.0.1", 12345)
+        self.db.user_login("user2", "127.0.0.2", 12346)
+        peers = self.db.get_peers_ip_port(["user1", "user2", "user3"])
+        self.assertEqual(peers, {"user1": ("127.0.0.1", 12345), "user2": ("127.0.0.2", 12346)})
+
+    def test_login_twice_keeps_one_record(self):
+        # Test that a second login replaces the address of the user
+        self.db.user_login("test_user", "127.0.0.1", 12345)
+        self.db.user_login("test_user", "127.0.0.1", 12346)
+        self.db.user_logout("test_user")
+        self.assertFalse(self.db.is_account_online("test_user"))
+
+    def test_create_chatroom(self):
+        # Test that chatrooms are saved once
+        self.assertTrue(self.db.create_chatroom("room"))
+        self.assertFalse(self.db.create_chatroom("room"))
+        self.db.create_chatroom("#alice#bob")
+        self.assertEqual(sorted(self.db.get_chatrooms()), ["#alice#bob", "room"])
+
+    def test_chatrooms_survive_clear_online_peers(self):
+        # Test that a registry restart keeps the chatrooms
+        self.db.create_chatroom("room")
+        self.db.clear_online_peers()
+        self.assertEqual(self.db.get_chatrooms(), ["room"])
+
+    def test_offline_messages(self):
+        # Test storing, loading and deleting waiting private messages
+        self.db.ensure_indexes()
+        self.db.store_offline_messages([("m1", "bob", "alice", "hi\nthere", 100.0), ("m2", "carol", "alice", "yo", 101.0)])
+        self.db.store_offline_messages([("m1", "bob", "alice", "hi\nthere", 100.0)])
+        self.assertEqual(sorted(self.db.load_offline_messages()),
+                         [("m1", "bob", "alice", "hi\nthere", 100.0), ("m2", "carol", "alice", "yo", 101.0)])
+        self.db.delete_offline_messages(["m1", "m3"])
+        self.assertEqual(self.db.load_offline_messages(), [("m2", "carol", "alice", "yo", 101.0)])
+
+@unittest.skipIf(not mongo_available(), "pymongo is not installed or no mongo server is reachable")
+class TestDB(DBConformance, unittest.TestCase):
+    def setUp(self):
+        self.client = MongoClient(MONGO_TEST_URI)
+        self.client.drop_database(MONGO_TEST_DATABASE)
+        self.db = DB(MongoBackend(MONGO_TEST_URI, MONGO_TEST_DATABASE, timeout_ms=2000))
+
     def tearDown(self):
-        self.client.drop_database("test_p2p_chat")
+        self.client.drop_database(MONGO_TEST_DATABASE)
+        self.db.backend.client.close()
+        self.client.close()
+
+class TestSQLiteDB(DBConformance, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = DB(SQLiteBackend(os.path.join(self.directory.name, "test.db")))
+
+    def tearDown(self):
+        self.db.backend.connection.close()
+        self.directory.cleanup()
+
+class TestMemoryDB(DBConformance, unittest.TestCase):
+    def setUp(self):
+        self.db = DB(MemoryBackend())
+
+class TestAccountCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = AccountCache(max_size=2, ttl=60, negative_ttl=5)
+
+    def test_hit_and_miss(self):
+        self.assertEqual(self.cache.get("test_user"), (False, None))
+        self.cache.put("test_user", {"username": "test_user", "password": "test_password"})
+        self.assertEqual(self.cache.get("test_user"), (True, {"username": "test_user", "password": "test_password"}))
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_negative_entry(self):
+        self.cache.put("nonexistent_user", None)
+        self.assertEqual(self.cache.get("nonexistent_user"), (True, None))
+
+    def test_lru_eviction(self):
+        self.cache.put("user1", {"username": "user1"})
+        self.cache.put("user2", {"username": "user2"})
+        self.cache.get("user1")
+        self.cache.put("user3", {"username": "user3"})
+        self.assertTrue(self.cache.get("user1")[0])
+        self.assertFalse(self.cache.get("user2")[0])
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_ttl(self):
+        with patch("db.time.monotonic", return_value=100.0):
+            self.cache.put("user1", {"username": "user1"})
+            self.cache.put("nonexistent_user", None)
+        with patch("db.time.monotonic", return_value=110.0):
+            self.assertTrue(self.cache.get("user1")[0])
+            self.assertFalse(self.cache.get("nonexistent_user")[0])
+        with patch("db.time.monotonic", return_value=200.0):
+            self.assertFalse(self.cache.get("user1")[0])
+
+    def test_invalidate(self):
+        self.cache.put("test_user", None)
+        self.cache.invalidate("test_user")
+        self.assertEqual(self.cache.get("test_user"), (False, None))
+
+
+class TestAsyncDB(unittest.TestCase):
+    def setUp(self):
+        self.db = DB(MemoryBackend())
+        self.async_db = AsyncDB(self.db)
+
+    def test_account_lookups(self):
+        async def lookups():
+            await self.async_db.register("test_user", "test_password")
+            return (
+                await self.async_db.is_account_exist("test_user"),
+                await self.async_db.get_password("test_user"),
+                await self.async_db.is_account_exist("nonexistent_user"),
+            )
+        self.assertEqual(asyncio.run(lookups()), (True, "test_password", False))
+        self.assertEqual(self.db.cache_stats()["hits"], 1)
+
+    def test_latency_stats(self):
+        self.db.user_login("test_user", "127.0.0.1", 12345)
+        self.db.is_account_online("test_user")
+        stats = self.db.latency_stats()
+        self.assertEqual(stats["upsert_online_peers"]["count"], 1)
+        self.assertEqual(stats["find_online_peer"]["count"], 1)
+
+class TestLatencyHistogram(unittest.TestCase):
+    def test_quantiles(self):
+        histogram = LatencyHistogram(buckets=(0.001, 0.01, 0.1))
+        for i in range(98):
+            histogram.record(0.0005)
+        histogram.record(0.05)
+        histogram.record(5)
+        self.assertEqual(histogram.quantile(0.5), 0.001)
+        self.assertEqual(histogram.quantile(0.99), 0.1)
+        self.assertEqual(histogram.quantile(1), float("inf"))
+        self.assertEqual(histogram.snapshot()["count"], 100)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,153 @@
+import unittest
+import os
+from unittest.mock import patch
+import tempfile
+import history
+from history import MessageHistory, RoomLog, recordHeader
+
+
+class TestRoomLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "lobby")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def fill(self, log, count, created=100.0):
+        for i in range(count):
+            self.assertEqual(log.append("message {}".format(i).encode(), created), i)
+
+    def test_last_and_since(self):
+        log = RoomLog(self.path)
+        self.fill(log, 10)
+        self.assertEqual([record[2] for record in log.last(3)], [b"message 7", b"message 8", b"message 9"])
+        self.assertEqual([record[0] for record in log.read(4, 2)], [4, 5])
+        self.assertEqual(log.read(10), [])
+        log.close()
+
+    def test_reads_across_segments_and_index_entries(self):
+        with patch.object(history, "INDEX_INTERVAL", 64):
+            log = RoomLog(self.path, segmentBytes=256)
+            self.fill(log, 100)
+        self.assertGreater(len(log.segments), 10)
+        self.assertGreater(len(log.segments[0].indexOffsets), 1)
+        records = log.read(37, 20)
+        self.assertEqual([record[0] for record in records], list(range(37, 57)))
+        self.assertEqual(records[0][2], b"message 37")
+        self.assertEqual(len(log.read(0)), 100)
+        log.close()
+
+    def test_reopened_log_goes_on(self):
+        log = RoomLog(self.path, segmentBytes=256)
+        self.fill(log, 30)
+        log.close()
+        log = RoomLog(self.path, segmentBytes=256)
+        self.assertEqual(log.nextOffset, 30)
+        self.assertEqual(log.append(b"after restart"), 30)
+        self.assertEqual(log.last(2)[0][2], b"message 29")
+        log.close()
+
+    def test_partly_written_record_is_cut_off(self):
+        log = RoomLog(self.path)
+        self.fill(log, 3)
+        segmentPath = log.segments[-1].path
+        log.close()
+        with open(segmentPath, "ab") as segment:
+            segment.write(recordHeader.pack(3, 100.0, 50) + b"cut")
+        log = RoomLog(self.path)
+        self.assertEqual(log.nextOffset, 3)
+        self.assertEqual(log.append(b"next"), 3)
+        self.assertEqual([record[2] for record in log.last(2)], [b"message 2", b"next"])
+        log.close()
+
+    def test_retention_deletes_old_segments(self):
+        # four records of 29 bytes fill a segment
+        log = RoomLog(self.path, segmentBytes=100)
+        for i in range(15):
+            log.append("message {}".format(i).encode(), 100.0 if i < 10 else 200.0)
+        self.assertEqual(len(log.segments), 4)
+        # the segment of messages 8 to 11 holds a newer message, it stays whole
+        self.assertEqual(log.expire(50, now=240.0), 2)
+        self.assertEqual(log.firstOffset, 8)
+        self.assertEqual([record[0] for record in log.read(0)], list(range(8, 15)))
+        self.assertEqual(len(os.listdir(self.path)), 2)
+        log.close()
+
+    def test_expired_last_segment_keeps_offsets(self):
+        log = RoomLog(self.path)
+        self.fill(log, 5, created=100.0)
+        self.assertEqual(log.expire(50, now=200.0), 1)
+        self.assertEqual(log.read(0), [])
+        self.assertEqual(log.append(b"later", 200.0), 5)
+        log.close()
+        log = RoomLog(self.path)
+        self.assertEqual(log.nextOffset, 6)
+        log.close()
+
+
+class TestMessageHistory(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.history = MessageHistory(self.directory.name, retention=60)
+
+    def tearDown(self):
+        self.history.close()
+        self.directory.cleanup()
+
+    def test_rooms_are_kept_apart(self):
+        self.history.append("lobby", b"a", created=100.0)
+        self.history.append("../other room", b"b")
+        self.history.append("..", b"c")
+        self.assertEqual(self.history.last("lobby", 10), ([(0, 100.0, b"a")], 1))
+        records, nextOffset = self.history.since("../other room", 0)
+        self.assertEqual([record[2] for record in records], [b"b"])
+        self.assertEqual(sorted(os.listdir(self.directory.name)), ["%2E%2E", "%2E%2E%2Fother%20room", "lobby"])
+        self.assertEqual(self.history.last("..", 1)[0][0][2], b"c")
+
+    def test_since_an_expired_offset_starts_at_the_first_message(self):
+        self.history.segmentBytes = 1
+        for i in range(5):
+            self.history.append("lobby", bytes([i]), created=100.0 + i)
+        self.history.expire(now=162.5)
+        records, nextOffset = self.history.since("lobby", 0)
+        self.assertEqual([record[0] for record in records], [3, 4])
+        self.assertEqual(nextOffset, 5)
+
+    def test_expire_opens_rooms_of_an_earlier_run(self):
+        self.history.append("lobby", b"old", created=100.0)
+        self.history.close()
+        self.assertEqual(self.history.expire(now=1000.0), 1)
+        self.assertEqual(self.history.rooms, {})
+
+    def test_expire_closes_idle_rooms_and_segments(self):
+        self.history.segmentBytes = 1
+        for i in range(3):
+            self.history.append("lobby", bytes([i]), created=100.0)
+        self.history.append("other", b"x", created=100.0)
+        self.history.since("lobby", 0)
+        self.history.expire(now=110.0)
+        # only the segment taking the appends stays open
+        self.assertEqual([segment.file is not None for segment in self.history.rooms["lobby"].segments],
+                         [False, False, True])
+        self.history.append("lobby", b"y", created=110.0)
+        self.history.expire(now=120.0)
+        self.assertEqual(list(self.history.rooms), ["lobby"])
+        self.history.expire(now=130.0)
+        self.assertEqual(self.history.rooms, {})
+        # a closed room is reopened as it was
+        self.assertEqual([record[2] for record in self.history.since("lobby", 0)[0]], [b"\x00", b"\x01", b"\x02", b"y"])
+
+    def test_closed_room_is_opened_once_its_oldest_segment_expired(self):
+        self.history.append("lobby", b"old", created=100.0)
+        self.history.expire(now=110.0)
+        self.history.expire(now=120.0)
+        with patch.object(self.history, "openLog", wraps=self.history.openLog) as openLog:
+            self.assertEqual(self.history.expire(now=150.0), 0)
+            openLog.assert_not_called()
+            self.assertEqual(self.history.expire(now=170.0), 1)
+            openLog.assert_called_once_with("lobby")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import unittest
+import zlib
+from protocol import (
+    FrameDecoder, MessageCodec, ProtocolError, ChatMessage, encodeFrame, encodeFrames, handshake,
+    encodeChatMessage, decodeChatMessage, messageFields,
+    FRAMED, LEGACY, BINARY, PROTOCOL_VERSION, TEXT_VERSION, CHAT_MESSAGE, COMPRESSED_CHAT_MESSAGE
+)
+
+
+class TestFrameDecoder(unittest.TestCase):
+    def setUp(self):
+        self.decoder = FrameDecoder(maxFrameSize=1024)
+
+    def test_partial_reads(self):
+        frame = encodeFrame("CHATROOM-JOIN room")
+        self.assertEqual(self.decoder.feed(frame[:2]), [])
+        self.assertEqual(self.decoder.feed(frame[2:7]), [])
+        self.assertEqual(self.decoder.feed(frame[7:]), [b"CHATROOM-JOIN room"])
+
+    def test_coalesced_frames(self):
+        data = encodeFrames(["SEARCH alice", "USERS-LIST", "CHATROOM-LIST"])
+        self.assertEqual(self.decoder.feed(data), [b"SEARCH alice", b"USERS-LIST", b"CHATROOM-LIST"])
+
+    def test_frame_split_across_coalesced_reads(self):
+        data = encodeFrames(["first", "second"])
+        self.assertEqual(self.decoder.feed(data[:12]), [b"first"])
+        self.assertEqual(self.decoder.feed(data[12:]), [b"second"])
+
+    def test_large_frame(self):
+        message = "users-list-success " + " ".join("user{}".format(i) for i in range(100))
+        decoder = FrameDecoder()
+        self.assertEqual(decoder.feed(encodeFrame(message)), [message.encode()])
+
+    def test_oversized_frame(self):
+        with self.assertRaises(ProtocolError):
+            self.decoder.feed(encodeFrame("x" * 2048))
+
+
+class TestMessageCodec(unittest.TestCase):
+    def test_negotiates_framed(self):
+        codec = MessageCodec()
+        messages = codec.feed(handshake() + encodeFrame("LOGIN alice secret 5000"))
+        self.assertEqual(codec.mode, FRAMED)
+        self.assertEqual(codec.takeHandshakeReply(), handshake(PROTOCOL_VERSION))
+        self.assertEqual(codec.takeHandshakeReply(), b"")
+        self.assertEqual(messages, ["LOGIN alice secret 5000"])
+
+    def test_handshake_split_across_reads(self):
+        codec = MessageCodec()
+        data = handshake() + encodeFrame("USERS-LIST")
+        self.assertEqual(codec.feed(data[:2]), [])
+        self.assertIsNone(codec.mode)
+        self.assertEqual(codec.feed(data[2:]), ["USERS-LIST"])
+
+    def test_negotiates_legacy(self):
+        codec = MessageCodec()
+        self.assertEqual(codec.feed(b"LOGIN alice secret 5000"), ["LOGIN alice secret 5000"])
+        self.assertEqual(codec.mode, LEGACY)
+        self.assertEqual(codec.takeHandshakeReply(), b"")
+        self.assertEqual(codec.encode(["login-success"]), b"login-success")
+
+    def test_legacy_message_starting_like_handshake(self):
+        codec = MessageCodec()
+        self.assertEqual(codec.feed(b"P"), [])
+        self.assertEqual(codec.feed(b"RIVATE-CHATROOM\nbob"), ["PRIVATE-CHATROOM\nbob"])
+        self.assertEqual(codec.mode, LEGACY)
+
+    def test_invalid_utf8(self):
+        framed = MessageCodec(FRAMED)
+        with self.assertRaises(ProtocolError):
+            framed.feed(encodeFrame(b"SEARCH \xff"))
+        with self.assertRaises(ProtocolError):
+            MessageCodec().feed(b"SEARCH \xff")
+
+    def test_framed_encode_batches(self):
+        codec = MessageCodec(FRAMED)
+        self.assertEqual(codec.encode(["a", "bc"]), encodeFrame("a") + encodeFrame("bc"))
+
+
+class TestChatMessage(unittest.TestCase):
+    def test_binary_round_trip(self):
+        payload = encodeChatMessage("alice", "hello\nworld")
+        self.assertEqual(payload, bytes((CHAT_MESSAGE, 5)) + b"alice" + b"hello\nworld")
+        message = decodeChatMessage(payload, {})
+        self.assertEqual(message.fields(), ["chat-message", "alice", "hello\nworld"])
+        self.assertIs(message.payload, payload)
+
+    def test_large_body_is_compressed(self):
+        content = "the same words again " * 100
+        payload = encodeChatMessage("alice", content)
+        self.assertEqual(payload[0], COMPRESSED_CHAT_MESSAGE)
+        self.assertLess(len(payload), len(content) // 4)
+        self.assertEqual(decodeChatMessage(payload, {}).content, content)
+        self.assertEqual(encodeChatMessage("alice", content, threshold=None)[0], CHAT_MESSAGE)
+
+    def test_sender_is_interned(self):
+        names = {}
+        first = decodeChatMessage(encodeChatMessage("alice", "a"), names)
+        second = decodeChatMessage(encodeChatMessage("alice", "b"), names)
+        self.assertIs(first.sender, second.sender)
+
+    def test_malformed_payloads(self):
+        with self.assertRaises(ProtocolError):
+            decodeChatMessage(bytes((CHAT_MESSAGE, 9)) + b"bob", {})
+        with self.assertRaises(ProtocolError):
+            decodeChatMessage(bytes((COMPRESSED_CHAT_MESSAGE, 3)) + b"bob" + b"not zlib", {})
+        bomb = bytes((COMPRESSED_CHAT_MESSAGE, 3)) + b"bob" + zlib.compress(b"x" * 4096)
+        with self.assertRaises(ProtocolError):
+            decodeChatMessage(bomb, {}, maxSize=1024)
+        with self.assertRaises(ProtocolError):
+            decodeChatMessage(bytes((CHAT_MESSAGE, 3)) + b"b\xffb" + b"hi", {})
+        with self.assertRaises(ProtocolError):
+            decodeChatMessage(bytes((CHAT_MESSAGE, 3)) + b"bob" + b"\xff", {})
+
+    def test_encoded_once_per_encoding(self):
+        message = ChatMessage("alice", "hi")
+        binary, framed, legacy = MessageCodec(FRAMED), MessageCodec(FRAMED, TEXT_VERSION), MessageCodec(LEGACY)
+        self.assertEqual(binary.encoding, BINARY)
+        self.assertIs(binary.encode([message]), MessageCodec(FRAMED).encode([message]))
+        self.assertEqual(framed.encode([message]), encodeFrame("chat-message\nalice\nhi"))
+        self.assertEqual(legacy.encode([message]), b"chat-message\nalice\nhi")
+        self.assertEqual(binary.encode(["welcome", message]), encodeFrame("welcome") + message.encode(BINARY))
+
+    def test_codec_decodes_text_and_binary(self):
+        codec = MessageCodec(FRAMED)
+        data = encodeFrame("chatroom-join\nbob") + ChatMessage("bob", "hi").encode(BINARY)
+        messages = codec.feed(data)
+        self.assertEqual(messages[0], "chatroom-join\nbob")
+        self.assertEqual(messageFields(messages[1]), ["chat-message", "bob", "hi"])
+
+    def test_text_only_side_negotiates_text(self):
+        codec = MessageCodec(version=TEXT_VERSION)
+        codec.feed(handshake())
+        self.assertEqual(codec.takeHandshakeReply(), handshake(TEXT_VERSION))
+        self.assertEqual(codec.encoding, FRAMED)
+
+
+if __name__ == '__main__':
+    unittest.main()
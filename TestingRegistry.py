@@ -0,0 +1,713 @@
+import unittest
+import threading
+import time
+import json
+import logging
+import queue
+import urllib.request
+from socket import socket, socketpair, AF_INET, SOCK_DGRAM
+from unittest.mock import MagicMock, patch
+import registry
+import protocol
+from registry import LivenessTracker, HelloReceiver, helloSocket
+from presence import PresenceIndex, WriteBehindQueue, sortedPage
+from passwords import PasswordHasher, ServerBusy
+from rooms import RoomRegistry
+from subscriptions import DeltaFeed, formatUsersDelta, formatRoomsDelta
+from metrics import Metrics, LatencyHistogram, startMetricsServer
+from logs import JsonFormatter, RateLimitFilter, DeferredQueueHandler
+from offline import OfflineQueue, formatPrivateMessages
+from tokens import SessionTokens
+import db
+
+
+class TestLivenessTracker(unittest.TestCase):
+    def setUp(self):
+        self.tracker = LivenessTracker(timeout=3, tick=0.5)
+
+    def test_peer_expires_after_timeout(self):
+        self.tracker.touch("alice", now=100.0)
+        self.assertEqual(self.tracker.sweep(now=101.0), [])
+        self.assertEqual(self.tracker.sweep(now=104.0), ["alice"])
+        self.assertNotIn("alice", self.tracker)
+
+    def test_hello_postpones_expiry(self):
+        self.tracker.touch("alice", now=100.0)
+        self.tracker.sweep(now=101.0)
+        self.tracker.touch("alice", now=102.0)
+        self.assertEqual(self.tracker.sweep(now=104.0), [])
+        self.assertEqual(self.tracker.sweep(now=106.0), ["alice"])
+
+    def test_removed_peer_does_not_expire(self):
+        self.tracker.touch("alice", now=100.0)
+        self.tracker.remove("alice")
+        self.assertEqual(self.tracker.sweep(now=110.0), [])
+        self.assertEqual(len(self.tracker), 0)
+
+    def test_expired_peers_are_returned_as_one_batch(self):
+        for i in range(100):
+            self.tracker.touch("user{}".format(i), now=100.0)
+        self.tracker.touch("alive", now=103.0)
+        expired = self.tracker.sweep(now=104.0)
+        self.assertEqual(len(expired), 100)
+        self.assertIn("alive", self.tracker)
+
+    def test_sweep_after_stall(self):
+        self.tracker.touch("alice", now=100.0)
+        self.tracker.sweep(now=100.0)
+        self.assertEqual(self.tracker.sweep(now=500.0), ["alice"])
+
+    def test_batch_of_hellos(self):
+        self.tracker.touch("alice", now=100.0)
+        self.tracker.touch("bob", now=100.0)
+        self.tracker.touchMany(["alice", "carol"], now=102.0)
+        self.assertEqual(self.tracker.sweep(now=104.0), ["bob"])
+        self.assertEqual(sorted(self.tracker.sweep(now=106.0)), ["alice", "carol"])
+
+
+class TestHelloReceiver(unittest.TestCase):
+    def setUp(self):
+        self.presence = PresenceIndex()
+        for username in ("alice", "bob"):
+            self.presence.login(username, "10.0.0.1", 5000)
+        self.liveness = LivenessTracker()
+        self.receiving = helloSocket("127.0.0.1", 0)
+        self.sending = socket(AF_INET, SOCK_DGRAM)
+        patchers = [patch.object(registry, "presence", self.presence), patch.object(registry, "liveness", self.liveness)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.receiving.close()
+        self.sending.close()
+
+    def send(self, *datagrams):
+        for datagram in datagrams:
+            self.sending.sendto(datagram, self.receiving.getsockname())
+
+    # waits for the datagrams to be queued on the loopback socket, then drains them
+    def drain(self, receiver, expected):
+        count = 0
+        for i in range(100):
+            count += receiver.drain(self.receiving)
+            if count >= expected:
+                return count
+            threading.Event().wait(0.01)
+        return count
+
+    def test_online_senders_are_marked_alive(self):
+        self.send(b"HELLO alice", b"HELLO bob\n", b"HELLO alice", b"HELLO mallory", b"HELLO", b"SEARCH alice",
+                  b"HELLO \xff\xfe")
+        self.assertEqual(self.drain(HelloReceiver(), 7), 7)
+        self.assertIn("alice", self.liveness)
+        self.assertIn("bob", self.liveness)
+        self.assertEqual(len(self.liveness), 2)
+
+    def test_batch_size_bounds_a_wakeup(self):
+        receiver = HelloReceiver(batchSize=2)
+        self.send(b"HELLO alice", b"HELLO alice", b"HELLO bob")
+        self.assertEqual(self.drain(receiver, 2), 2)
+        self.assertNotIn("bob", self.liveness)
+        self.assertEqual(self.drain(receiver, 1), 1)
+        self.assertIn("bob", self.liveness)
+
+    def test_failing_socket_ends_the_batch(self):
+        broken = MagicMock(**{"recvfrom_into.side_effect": OSError(9, "Bad file descriptor")})
+        self.assertEqual(HelloReceiver(batchSize=4).drain(broken), 0)
+        self.assertEqual(broken.recvfrom_into.call_count, 4)
+
+    def test_logged_out_user_is_not_marked_alive(self):
+        receiver = HelloReceiver()
+        self.send(b"HELLO alice")
+        self.drain(receiver, 1)
+        self.presence.logout("alice")
+        self.liveness.remove("alice")
+        self.send(b"HELLO alice")
+        self.drain(receiver, 1)
+        self.assertNotIn("alice", self.liveness)
+
+
+class TestPresenceIndex(unittest.TestCase):
+    def setUp(self):
+        self.writeBehind = MagicMock(spec=WriteBehindQueue)
+        self.presence = PresenceIndex(self.writeBehind)
+
+    def test_login_and_search(self):
+        session = object()
+        self.assertTrue(self.presence.login("alice", "10.0.0.1", "5000", session))
+        self.assertTrue(self.presence.isOnline("alice"))
+        self.assertEqual(self.presence.address("alice"), ("10.0.0.1", "5000"))
+        self.assertIs(self.presence.session("alice"), session)
+        self.assertIsNone(self.presence.address("bob"))
+        self.writeBehind.login.assert_called_once_with("alice", "10.0.0.1", "5000")
+
+    def test_second_login_is_refused(self):
+        self.presence.login("alice", "10.0.0.1", "5000")
+        self.assertFalse(self.presence.login("alice", "10.0.0.2", "5001"))
+        self.assertEqual(self.presence.address("alice"), ("10.0.0.1", "5000"))
+
+    def test_logout_of_other_session_is_ignored(self):
+        session = object()
+        self.presence.login("alice", "10.0.0.1", "5000", session)
+        self.assertIsNone(self.presence.logout("alice", object()))
+        self.assertIs(self.presence.logout("alice", session), session)
+        self.assertNotIn("alice", self.presence)
+        self.writeBehind.logout.assert_called_once_with("alice")
+
+    def test_usernames(self):
+        self.presence.login("alice", "10.0.0.1", "5000")
+        self.presence.login("bob", "10.0.0.2", "5000")
+        self.assertEqual(sorted(self.presence.usernames()), ["alice", "bob"])
+
+
+class TestListPages(unittest.TestCase):
+    def setUp(self):
+        self.names = ["user{:03d}".format(i) for i in range(250)]
+
+    def test_pages_cover_the_list_once(self):
+        seen = []
+        cursor = None
+        while True:
+            page, cursor = sortedPage(self.names, 100, cursor)
+            seen += page
+            if cursor is None:
+                break
+        self.assertEqual(seen, self.names)
+
+    def test_prefix_search(self):
+        self.assertEqual(sortedPage(self.names, 5, prefix="user12"), (["user120", "user121", "user122", "user123", "user124"], "user124"))
+        self.assertEqual(sortedPage(self.names, 5, "user124", "user12"), (["user125", "user126", "user127", "user128", "user129"], None))
+        self.assertEqual(sortedPage(self.names, 5, prefix="nobody"), ([], None))
+
+    def test_presence_page_follows_logins(self):
+        presence = PresenceIndex()
+        for username in ("carol", "alice", "bob"):
+            presence.login(username, "10.0.0.1", "5000")
+        presence.logout("bob")
+        self.assertEqual(presence.page(10), (["alice", "carol"], None))
+
+    def test_room_page(self):
+        rooms = RoomRegistry()
+        rooms.create("b")
+        rooms.create("a")
+        rooms.join("b", "alice")
+        self.assertEqual(rooms.page(1), (["a : 0"], "a"))
+        self.assertEqual(rooms.page(1, "a"), (["b : 1"], None))
+
+
+class TestDeltaFeed(unittest.TestCase):
+    def test_changes_are_coalesced(self):
+        feed = DeltaFeed(formatUsersDelta)
+        session = MagicMock()
+        feed.subscribe(session)
+        presence = PresenceIndex(feed=feed)
+        presence.login("alice", "10.0.0.1", "5000")
+        presence.login("bob", "10.0.0.2", "5000")
+        presence.logout("alice")
+        feed.flush()
+        session.sendResponse.assert_called_once_with("users-delta -alice +bob")
+        feed.flush()
+        self.assertEqual(session.sendResponse.call_count, 1)
+
+    def test_nothing_is_kept_without_subscribers(self):
+        feed = DeltaFeed(formatRoomsDelta)
+        rooms = RoomRegistry(feed=feed)
+        rooms.create("room")
+        self.assertEqual(feed.pending, {})
+        session = MagicMock()
+        feed.subscribe(session)
+        rooms.join("room", "alice")
+        feed.flush()
+        session.sendResponse.assert_called_once_with("rooms-delta\nroom : 1")
+
+    def test_failed_subscriber_is_dropped(self):
+        feed = DeltaFeed(formatUsersDelta)
+        session = MagicMock()
+        session.sendResponse.side_effect = OSError()
+        feed.subscribe(session)
+        feed.publish("alice", True)
+        feed.flush()
+        self.assertEqual(feed.subscribers, set())
+
+
+class TestWriteBehindQueue(unittest.TestCase):
+    def setUp(self):
+        self.database = MagicMock()
+        self.writeBehind = WriteBehindQueue(self.database)
+
+    def test_writes_latest_state(self):
+        self.writeBehind.write([("alice", ("10.0.0.1", "5000")), ("alice", None), ("bob", ("10.0.0.2", "5000"))])
+        self.database.bulk_logout.assert_called_once_with(["alice"])
+        self.database.bulk_login.assert_called_once_with([("bob", "10.0.0.2", "5000")])
+
+    def test_relogin_replaces_record(self):
+        self.writeBehind.write([("alice", None), ("alice", ("10.0.0.3", "6000"))])
+        self.database.bulk_logout.assert_called_once_with([])
+        self.database.bulk_login.assert_called_once_with([("alice", "10.0.0.3", "6000")])
+
+    def test_background_thread_applies_changes(self):
+        self.writeBehind.start()
+        self.writeBehind.login("alice", "10.0.0.1", "5000")
+        self.writeBehind.flush()
+        self.database.clear_online_peers.assert_called_once_with()
+        self.database.bulk_login.assert_called_once_with([("alice", "10.0.0.1", "5000")])
+
+
+class TestRelaySwitch(unittest.TestCase):
+    def setUp(self):
+        self.relay = MagicMock(host="10.0.0.9", port=16700)
+        rooms = RoomRegistry()
+        rooms.create("room")
+        rooms.join("room", "alice")
+        self.patches = [
+            patch.object(registry, "relay", self.relay),
+            patch.object(registry, "relayThreshold", 3),
+            patch.object(registry, "relayRooms", set()),
+            patch.object(registry, "chatrooms", rooms),
+            patch.object(registry, "presence", PresenceIndex(MagicMock(spec=WriteBehindQueue))),
+        ]
+        for patcher in self.patches:
+            patcher.start()
+        registry.presence.login("alice", "10.0.0.1", "5000")
+        registry.presence.login("bob", "10.0.0.2", "5000")
+
+    def tearDown(self):
+        for patcher in self.patches:
+            patcher.stop()
+
+    def session(self, username):
+        session = registry.ClientSession("10.0.0.3", 5000)
+        session.username = username
+        return session
+
+    def join(self, username):
+        return self.session(username).handleMessage(["CHATROOM-JOIN", "room"])
+
+    def test_small_room_stays_mesh(self):
+        self.assertEqual(self.join("bob"), "chatroom-join-success\n10.0.0.1,5000")
+        self.relay.bridge.assert_not_called()
+
+    def test_room_switches_to_relay_at_threshold(self):
+        self.join("bob")
+        self.assertEqual(self.join("carol"), "chatroom-join-relay\n10.0.0.9,16700")
+        room, addresses = self.relay.bridge.call_args[0]
+        self.assertEqual(sorted(addresses), [("10.0.0.1", "5000"), ("10.0.0.2", "5000")])
+        self.assertEqual(self.join("dave"), "chatroom-join-relay\n10.0.0.9,16700")
+        self.assertEqual(self.relay.bridge.call_count, 1)
+
+    def test_empty_room_goes_back_to_mesh(self):
+        self.join("bob")
+        carol = self.session("carol")
+        carol.handleMessage(["CHATROOM-JOIN", "room"])
+        self.assertIn("room", registry.relayRooms)
+        carol.handleMessage(["chatroom-leave-request"])
+        registry.leaveRooms("alice")
+        registry.leaveRooms("bob")
+        self.assertNotIn("room", registry.relayRooms)
+        self.assertEqual(self.join("dave"), "chatroom-join-success")
+
+
+class TestOfflineQueue(unittest.TestCase):
+    def setUp(self):
+        self.database = db.DB(db.MemoryBackend())
+        self.offline = OfflineQueue(self.database, maxPerUser=2, ttl=60)
+        self.offline.load()
+
+    def test_backlog_is_bounded(self):
+        self.assertTrue(self.offline.put("alice", "bob", "one", now=100.0))
+        self.assertTrue(self.offline.put("alice", "bob", "two", now=101.0))
+        self.assertFalse(self.offline.put("alice", "bob", "three", now=102.0))
+        self.assertEqual(len(self.offline), 2)
+        self.assertEqual(self.offline.take("alice", now=110.0), [("bob", "one", 100.0), ("bob", "two", 101.0)])
+        self.assertNotIn("alice", self.offline)
+        self.assertEqual(self.offline.take("alice"), [])
+
+    def test_expired_messages_are_dropped(self):
+        self.offline.put("alice", "bob", "old", now=100.0)
+        self.offline.put("carol", "bob", "new", now=150.0)
+        self.assertEqual(self.offline.expire(now=170.0), 1)
+        self.assertNotIn("alice", self.offline)
+        self.assertEqual(self.offline.take("carol", now=215.0), [])
+        self.assertEqual(len(self.offline), 0)
+
+    def test_messages_survive_a_restart(self):
+        self.offline.put("alice", "bob", "kept", now=1e12)
+        self.offline.put("carol", "bob", "delivered", now=1e12)
+        self.offline.take("carol")
+        self.offline.writer.flush()
+        restarted = OfflineQueue(self.database, maxPerUser=2, ttl=60)
+        restarted.load()
+        self.assertEqual(restarted.take("alice"), [("bob", "kept", 1e12)])
+        restarted.writer.flush()
+        self.assertEqual(self.database.load_offline_messages(), [])
+
+
+class TestPrivateMessage(unittest.TestCase):
+    def setUp(self):
+        self.patches = [
+            patch.object(registry, "presence", PresenceIndex(MagicMock(spec=WriteBehindQueue))),
+            patch.object(registry, "offline", OfflineQueue()),
+            patch.object(registry, "db", MagicMock()),
+            patch.object(registry, "liveness", LivenessTracker()),
+        ]
+        for patcher in self.patches:
+            patcher.start()
+        registry.db.is_account_exist.side_effect = lambda username: username in ("alice", "bob")
+        self.bob = registry.ClientSession("10.0.0.2", 5000)
+        self.bob.username = "bob"
+
+    def tearDown(self):
+        for patcher in self.patches:
+            patcher.stop()
+
+    def test_online_recipient_is_pushed_the_message(self):
+        alice = MagicMock()
+        registry.presence.login("alice", "10.0.0.1", "5000", alice)
+        self.assertEqual(self.bob.handleMessages(["PRIVATE-MESSAGE alice hi  there"]), ["private-message-delivered"])
+        self.assertEqual(alice.sendResponse.call_args[0][0].split("\n")[1:], ["bob {} 9".format(int(time.time())), "hi  there"])
+
+    def test_offline_recipient_gets_the_messages_after_login(self):
+        self.assertEqual(self.bob.handleMessages(["PRIVATE-MESSAGE alice first", "PRIVATE-MESSAGE alice second"]),
+                         ["private-message-queued", "private-message-queued"])
+        self.assertEqual(self.bob.handleMessages(["PRIVATE-MESSAGE nobody hi"]), ["private-message-user-not-found"])
+        registry.db.get_password.return_value = b"hash"
+        alice = registry.ClientSession("10.0.0.1", 5000)
+        with patch.object(registry, "passwordHasher", MagicMock(**{"check.return_value": True})):
+            responses = alice.handleMessages(["LOGIN alice password 5000"])
+        self.assertEqual(responses[0], "login-success")
+        self.assertEqual(responses[1].split("\n")[0], "private-messages 2")
+        self.assertEqual(len(registry.offline), 0)
+
+    def test_legacy_peer_leaves_its_messages_queued(self):
+        registry.offline.put("alice", "bob", "meanwhile")
+        registry.db.get_password.return_value = b"hash"
+        alice = registry.ClientSession("10.0.0.1", 5000)
+        # a legacy text connection would read a push as part of a response
+        alice.readsPushes = lambda: False
+        alice.sendResponse = MagicMock()
+        with patch.object(registry, "passwordHasher", MagicMock(**{"check.return_value": True})):
+            self.assertEqual(alice.handleMessages(["LOGIN alice password 5000"]), ["login-success"])
+        self.assertEqual(self.bob.handleMessages(["PRIVATE-MESSAGE alice hi"]), ["private-message-queued"])
+        HelloReceiver().deliver("alice")
+        alice.sendResponse.assert_not_called()
+        self.assertEqual([message[1] for message in registry.offline.take("alice")], ["meanwhile", "hi"])
+
+    def test_queued_message_is_delivered_with_a_hello(self):
+        alice = MagicMock()
+        registry.presence.login("alice", "10.0.0.1", "5000", alice)
+        registry.offline.put("alice", "bob", "meanwhile")
+        HelloReceiver().deliver("alice")
+        self.assertTrue(alice.sendResponse.call_args[0][0].startswith("private-messages 1\nbob "))
+        self.assertNotIn("alice", registry.offline)
+
+    def test_format(self):
+        self.assertEqual(formatPrivateMessages([("bob", "a\nb", 100.5)]), "private-messages 1\nbob 100 3\na\nb")
+
+
+class TestSessionTokens(unittest.TestCase):
+    def setUp(self):
+        self.tokens = SessionTokens(b"secret", ttl=100, window=10)
+
+    def test_token_is_used_up_by_a_resume(self):
+        token = self.tokens.issue("alice", now=1000)
+        self.assertEqual(self.tokens.check("alice", token, now=1001), (True, None))
+        self.assertEqual(self.tokens.resume("bob", token, now=1001), (False, None))
+        self.assertEqual(self.tokens.resume("alice", token, now=1001), (True, None))
+        self.assertEqual(self.tokens.resume("alice", token, now=1002), (False, None))
+
+    def test_forged_and_expired_tokens_are_refused(self):
+        token = self.tokens.issue("alice", now=1000)
+        expires, nonce, signature = token.split(".")
+        self.assertEqual(self.tokens.resume("alice", "{}.{}.{}".format(int(expires) + 100, nonce, signature), now=1001),
+                         (False, None))
+        self.assertEqual(self.tokens.resume("alice", "garbage", now=1001), (False, None))
+        self.assertEqual(SessionTokens(b"other").resume("alice", token, now=1001), (False, None))
+        self.assertEqual(self.tokens.resume("alice", token, now=1101), (False, None))
+
+    def test_only_the_last_token_resumes(self):
+        first = self.tokens.issue("alice", now=1000)
+        second = self.tokens.issue("alice", now=1001)
+        self.assertEqual(self.tokens.resume("alice", first, now=1002), (False, None))
+        self.tokens.revoke("alice")
+        self.assertEqual(self.tokens.resume("alice", second, now=1002), (False, None))
+
+    def test_ended_session_keeps_its_room_within_the_window(self):
+        token = self.tokens.issue("alice", now=1000)
+        self.tokens.suspend("alice", "lobby", now=1050)
+        self.assertEqual(self.tokens.resume("alice", token, now=1061), (False, None))
+        token = self.tokens.issue("alice", now=1000)
+        self.tokens.suspend("alice", "lobby", now=1050)
+        self.assertEqual(self.tokens.resume("alice", token, now=1060), (True, "lobby"))
+
+    def test_sweep_drops_stale_sessions(self):
+        self.tokens.issue("alice", now=1000)
+        self.tokens.suspend("alice", now=1000)
+        self.tokens.issue("bob", now=1020)
+        self.assertEqual(len(self.tokens), 1)
+
+
+class TestSessionResume(unittest.TestCase):
+    def setUp(self):
+        rooms = RoomRegistry()
+        rooms.create("lobby")
+        self.patches = [
+            patch.object(registry, "presence", PresenceIndex(MagicMock(spec=WriteBehindQueue))),
+            patch.object(registry, "chatrooms", rooms),
+            patch.object(registry, "tokens", SessionTokens()),
+            patch.object(registry, "db", MagicMock()),
+            patch.object(registry, "liveness", LivenessTracker()),
+            patch.object(registry, "passwordHasher", MagicMock(**{"check.return_value": True})),
+        ]
+        for patcher in self.patches:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patches:
+            patcher.stop()
+
+    def login(self):
+        session = registry.ClientSession("10.0.0.1", 5000)
+        session.closeConnection = MagicMock()
+        response, token = session.handleMessage(["LOGIN", "alice", "password", "5000", "token"]).split()
+        self.assertEqual(response, "login-success")
+        session.handleMessage(["CHATROOM-JOIN", "lobby"])
+        return session, token
+
+    def test_timed_out_peer_resumes_into_its_room(self):
+        session, token = self.login()
+        registry.expireSessions(["alice"])
+        self.assertEqual(registry.chatrooms.roomMembers("lobby"), [])
+        resumed = registry.ClientSession("10.0.0.1", 5001)
+        response = resumed.handleMessage(["RESUME", "alice", token, "5000"])
+        self.assertEqual(response.split("\n")[1], "lobby")
+        self.assertEqual(registry.chatrooms.roomMembers("lobby"), ["alice"])
+        self.assertIs(registry.presence.session("alice"), resumed)
+        registry.passwordHasher.check.assert_called_once()
+        # the token was used up, the next one came with the answer
+        self.assertEqual(resumed.handleMessage(["RESUME", "alice", token, "5000"]), "resume-invalid")
+
+    def test_resume_takes_over_a_dropped_connection(self):
+        session, token = self.login()
+        resumed = registry.ClientSession("10.0.0.1", 5001)
+        self.assertTrue(resumed.handleMessage(["RESUME", "alice", token, "5000"]).startswith("resume-success "))
+        session.closeConnection.assert_called_once_with()
+        self.assertEqual(resumed.chatroom, "lobby")
+
+    def test_refused_login_keeps_the_token(self):
+        session, token = self.login()
+        # alice is still online on this session, the resume is refused without using the token up
+        self.assertEqual(session.handleMessage(["RESUME", "alice", token, "5000"]), "login-online")
+        resumed = registry.ClientSession("10.0.0.1", 5001)
+        self.assertTrue(resumed.handleMessage(["RESUME", "alice", token, "5000"]).startswith("resume-success "))
+
+    def test_session_of_another_user_cannot_resume(self):
+        session, token = self.login()
+        registry.expireSessions(["alice"])
+        registry.presence.login("bob", "10.0.0.2", 5002)
+        other = registry.ClientSession("10.0.0.2", 5002)
+        other.username = "bob"
+        self.assertEqual(other.handleMessage(["RESUME", "alice", token, "5000"]), "resume-invalid")
+        self.assertIsNone(registry.presence.session("alice"))
+
+    def test_logout_revokes_the_token(self):
+        session, token = self.login()
+        session.handleMessage(["LOGOUT"])
+        self.assertEqual(registry.ClientSession("10.0.0.1", 5001).handleMessage(["RESUME", "alice", token, "5000"]),
+                         "resume-invalid")
+
+
+class TestNeedsWorker(unittest.TestCase):
+    def test_blocking_commands(self):
+        self.assertTrue(registry.needsWorker(["SEARCH bob", "LOGIN alice password 5000"]))
+        self.assertFalse(registry.needsWorker(["SEARCH bob", "CHATROOM-CREATE\nlobby"]))
+
+    def test_room_writes_when_the_rooms_are_persisted(self):
+        with patch.object(registry, "chatrooms", RoomRegistry(MagicMock())):
+            self.assertTrue(registry.needsWorker(["CHATROOM-CREATE\nlobby"]))
+            self.assertTrue(registry.needsWorker(["PRIVATE-CHATROOM\nbob"]))
+            self.assertFalse(registry.needsWorker(["CHATROOM-JOIN lobby"]))
+
+
+class TestRoomRegistry(unittest.TestCase):
+    def setUp(self):
+        self.database = MagicMock()
+        self.rooms = RoomRegistry(self.database)
+
+    def test_create_is_saved(self):
+        self.assertTrue(self.rooms.create("room"))
+        self.assertFalse(self.rooms.create("room"))
+        self.assertIn("room", self.rooms)
+        self.database.create_chatroom.assert_called_once_with("room")
+
+    def test_join_returns_other_members(self):
+        self.rooms.create("room")
+        self.assertEqual(self.rooms.join("room", "alice"), [])
+        self.assertEqual(self.rooms.join("room", "bob"), ["alice"])
+        self.assertEqual(self.rooms.join("room", "bob"), ["alice"])
+        self.assertEqual(self.rooms.count("room"), 2)
+        self.assertIsNone(self.rooms.join("missing", "alice"))
+
+    def test_leave(self):
+        self.rooms.create("room")
+        self.rooms.join("room", "alice")
+        self.rooms.join("room", "bob")
+        self.assertEqual(self.rooms.leave("room", "alice"), 1)
+        self.assertIsNone(self.rooms.leave("room", "alice"))
+        self.assertEqual(self.rooms.roomsOf("alice"), [])
+        self.assertEqual(self.rooms.roomMembers("room"), ["bob"])
+
+    def test_leave_all_rooms_of_user(self):
+        for room in ("a", "b", "c"):
+            self.rooms.create(room)
+        self.rooms.join("a", "alice")
+        self.rooms.join("b", "alice")
+        self.rooms.join("b", "bob")
+        self.assertEqual(sorted(self.rooms.leaveAll("alice")), [("a", 0), ("b", 1)])
+        self.assertEqual(self.rooms.leaveAll("alice"), [])
+        self.assertEqual(self.rooms.count("b"), 1)
+
+    def test_listing_follows_member_counts(self):
+        self.rooms.create("room")
+        self.assertEqual(self.rooms.listing(), "chatroom-list-success\nroom : 0")
+        self.rooms.join("room", "alice")
+        self.assertEqual(self.rooms.listing(), "chatroom-list-success\nroom : 1")
+
+    def test_load_saved_rooms(self):
+        self.database.get_chatrooms.return_value = ["room", "#alice#bob"]
+        self.rooms.load()
+        self.assertIn("#alice#bob", self.rooms)
+        self.assertEqual(self.rooms.count("room"), 0)
+
+
+class TestPasswordHasher(unittest.TestCase):
+    def setUp(self):
+        self.hasher = PasswordHasher(workers=1, maxPending=1, rounds=4)
+
+    def tearDown(self):
+        self.hasher.shutdown()
+
+    def test_hash_and_check(self):
+        hashed = self.hasher.hash("test_password")
+        self.assertTrue(self.hasher.check("test_password", hashed))
+        self.assertFalse(self.hasher.check("wrong_password", hashed))
+
+    def test_full_queue_is_busy(self):
+        release = threading.Event()
+        future = self.hasher.submit(release.wait)
+        with self.assertRaises(ServerBusy):
+            self.hasher.submit(release.wait)
+        release.set()
+        future.result()
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics("test")
+        self.metrics.histogram("command_seconds", "Command time", "command")
+        self.metrics.counter("responses_total", "Responses", "response")
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = LatencyHistogram(buckets=(0.001, 0.01))
+        self.metrics.histogram("db_seconds", "Storage time", "operation", {"find": histogram})
+        for seconds in (0.0005, 0.005, 0.005, 5):
+            histogram.record(seconds)
+        lines = self.metrics.render().splitlines()
+        self.assertIn('test_db_seconds_bucket{operation="find",le="0.001"} 1', lines)
+        self.assertIn('test_db_seconds_bucket{operation="find",le="0.01"} 3', lines)
+        self.assertIn('test_db_seconds_bucket{operation="find",le="+Inf"} 4', lines)
+        self.assertIn('test_db_seconds_count{operation="find"} 4', lines)
+        self.assertIn("# TYPE test_db_seconds histogram", lines)
+
+    def test_counters_and_gauges(self):
+        self.metrics.increment("responses_total", "login-success")
+        self.metrics.increment("responses_total", "login-success")
+        self.metrics.gauge("online_peers", "Peers logged in", lambda: 3)
+        self.metrics.gauge("lookups_total", "Lookups", lambda: {"hit": 5}, "result", "counter")
+        lines = self.metrics.render().splitlines()
+        self.assertIn('test_responses_total{response="login-success"} 2', lines)
+        self.assertIn("test_online_peers 3", lines)
+        self.assertIn("# TYPE test_lookups_total counter", lines)
+        self.assertIn('test_lookups_total{result="hit"} 5', lines)
+
+    def test_endpoint(self):
+        self.metrics.observe("command_seconds", "SEARCH", 0.002)
+        server = startMetricsServer(self.metrics, "127.0.0.1", 0)
+        try:
+            url = "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+            body = urllib.request.urlopen(url, timeout=5).read().decode()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn('test_command_seconds_count{command="SEARCH"} 1', body.splitlines())
+
+    def test_registry_times_commands(self):
+        with patch.object(registry, "metrics", self.metrics), \
+                patch.object(registry, "presence", PresenceIndex(MagicMock(spec=WriteBehindQueue))):
+            session = registry.ClientSession("10.0.0.3", 5000)
+            session.handleMessages(["USERS-LIST", "NOT-A-COMMAND x"])
+        histograms = self.metrics.histograms["command_seconds"][2]
+        self.assertEqual(sorted(histograms), ["USERS-LIST", "other"])
+        self.assertEqual(self.metrics.counters["responses_total"][2], {"users-list-success": 1})
+
+
+class TestLogging(unittest.TestCase):
+    def record(self, message, *args, **extra):
+        record = logging.LogRecord("registry", logging.INFO, __file__, 1, message, args, None)
+        record.__dict__.update(extra)
+        return record
+
+    def test_json_record_has_extra_fields(self):
+        entry = json.loads(JsonFormatter().format(self.record("Received from %s", "10.0.0.1", command="SEARCH")))
+        self.assertEqual(entry["message"], "Received from 10.0.0.1")
+        self.assertEqual(entry["command"], "SEARCH")
+        self.assertEqual(entry["level"], "INFO")
+
+    def test_rate_limited_category(self):
+        limiter = RateLimitFilter({"hello": 2})
+        allowed = [limiter.filter(self.record("hello", category="hello")) for i in range(5)]
+        self.assertEqual(allowed, [True, True, False, False, False])
+        self.assertTrue(limiter.filter(self.record("search")))
+        limiter.buckets["hello"][0] = 1
+        record = self.record("hello", category="hello")
+        self.assertTrue(limiter.filter(record))
+        self.assertEqual(record.suppressed, 3)
+
+    def test_message_is_formatted_by_the_listener(self):
+        formatted = []
+
+        class Text:
+            def __str__(self):
+                formatted.append(True)
+                return "text"
+
+        records = queue.SimpleQueue()
+        DeferredQueueHandler(records).handle(self.record("-> %s", Text()))
+        self.assertEqual(formatted, [])
+        self.assertEqual(records.get_nowait().getMessage(), "-> text")
+
+    def test_passwords_are_not_logged(self):
+        self.assertEqual(str(registry.LoggedCommand(["LOGIN", "alice", "secret", "5000"])), "LOGIN alice *** 5000")
+        self.assertEqual(str(registry.LoggedCommand(["ACCOUNTS-IMPORT", "a", "h1", "b", "h2"])),
+                         "ACCOUNTS-IMPORT (2 accounts)")
+
+
+
+class TestClientThread(unittest.TestCase):
+    def test_message_that_is_not_utf8_ends_the_connection(self):
+        server, client = socketpair()
+        thread = registry.ClientThread("10.0.0.1", 5000, server)
+        feed = MagicMock()
+        thread.subscriptions.add(feed)
+        thread.start()
+        client.sendall(protocol.handshake() + protocol.encodeFrame(b"SEARCH \xff"))
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        # the session was ended, not left to the garbage collector
+        feed.unsubscribe.assert_called_once_with(thread)
+        self.assertEqual(server.fileno(), -1)
+        client.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
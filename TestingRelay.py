@@ -0,0 +1,184 @@
+import unittest
+import asyncio
+import tempfile
+import protocol
+from history import MessageHistory
+from relay import RelayServer
+
+
+class TestRelayServer(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.relay = RelayServer("127.0.0.1", 0, history=MessageHistory(self.directory.name))
+        await self.relay.start()
+        self.port = self.relay.server.sockets[0].getsockname()[1]
+        self.writers = []
+
+    async def asyncTearDown(self):
+        for writer in self.writers:
+            writer.close()
+        self.relay.server.close()
+        await self.relay.server.wait_closed()
+        self.relay.history.close()
+        self.directory.cleanup()
+
+    # connects a framed member to the relay and joins the room
+    async def join(self, room, username, version=protocol.PROTOCOL_VERSION):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        self.writers.append(writer)
+        writer.write(protocol.handshake(version))
+        self.assertEqual(await reader.readexactly(protocol.HANDSHAKE_SIZE), protocol.handshake(version))
+        codec = protocol.MessageCodec(protocol.FRAMED, version)
+        writer.write(codec.encode(["relay-join\n{}\n{}".format(room, username)]))
+        member = (reader, writer, codec, [])
+        self.assertEqual(await self.receive(member), "welcome")
+        return member
+
+    async def receive(self, member):
+        reader, writer, codec, received = member
+        while not received:
+            received.extend(codec.feed(await asyncio.wait_for(reader.read(protocol.RECV_SIZE), 2)))
+        return received.pop(0)
+
+    async def test_message_is_fanned_out_to_the_room(self):
+        alice = await self.join("room", "alice")
+        bob = await self.join("room", "bob")
+        carol = await self.join("room", "carol")
+        other = await self.join("other", "dave")
+        self.assertEqual(await self.receive(alice), "chatroom-join\nbob")
+        alice[1].write(alice[2].encode(["chat-message\nalice\nhello"]))
+        self.assertEqual(await self.receive(bob), "chatroom-join\ncarol")
+        self.assertEqual(await self.receive(bob), "chat-message\nalice\nhello")
+        self.assertEqual(await self.receive(carol), "chat-message\nalice\nhello")
+        self.assertEqual(await self.receive(alice), "chatroom-join\ncarol")
+        await asyncio.sleep(0.05)
+        self.assertEqual(other[3], [])
+
+    async def test_binary_message_is_forwarded_as_it_came(self):
+        alice = await self.join("room", "alice")
+        bob = await self.join("room", "bob")
+        carol = await self.join("room", "carol", protocol.TEXT_VERSION)
+        await self.receive(alice)
+        await self.receive(alice)
+        await self.receive(bob)
+        message = protocol.ChatMessage("alice", "hello " * 200)
+        alice[1].write(alice[2].encode([message]))
+        received = await self.receive(bob)
+        self.assertEqual(received.payload, message.binary())
+        self.assertEqual((received.sender, received.content), ("alice", message.content))
+        # a member that only speaks text gets the text form
+        self.assertEqual(await self.receive(carol), message.text())
+
+    async def test_joiner_gets_the_history(self):
+        alice = await self.join("room", "alice")
+        alice[1].write(alice[2].encode([protocol.ChatMessage("alice", "first"), "chat-message\nalice\nsecond",
+                                        protocol.ChatMessage("alice", "third")]))
+        bob = await self.join("room", "bob", protocol.TEXT_VERSION)
+        bob[1].write(bob[2].encode(["relay-history\nlast\n2"]))
+        self.assertEqual(await self.receive(bob), "chat-message\nalice\nsecond")
+        self.assertEqual(await self.receive(bob), "chat-message\nalice\nthird")
+        self.assertEqual(await self.receive(bob), "relay-history-end\n3")
+        # the sender learns the offset after its message
+        self.assertEqual(await self.receive(alice), "relay-offset\n1")
+        self.assertEqual(await self.receive(alice), "relay-offset\n2")
+        self.assertEqual(await self.receive(alice), "relay-offset\n3")
+        self.assertEqual(await self.receive(alice), "chatroom-join\nbob")
+        # a peer that comes back asks for what it missed since its offset
+        alice[1].write(alice[2].encode([protocol.ChatMessage("alice", "fourth")]))
+        self.assertEqual(await self.receive(bob), "chat-message\nalice\nfourth")
+        carol = await self.join("room", "carol")
+        carol[1].write(carol[2].encode(["relay-history\nsince\n3"]))
+        self.assertEqual((await self.receive(carol)).content, "fourth")
+        self.assertEqual(await self.receive(carol), "relay-history-end\n4")
+
+    async def test_leave_removes_member(self):
+        alice = await self.join("room", "alice")
+        bob = await self.join("room", "bob")
+        bob[1].write(bob[2].encode(["chatroom-leave\nbob"]))
+        self.assertEqual(await self.receive(alice), "chatroom-join\nbob")
+        self.assertEqual(await self.receive(alice), "chatroom-leave\nbob")
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(self.relay.rooms["room"]), 1)
+
+    # starts a mesh peer that answers the handshake and records what the relay
+    # sends, returns its server, the queue of received messages and its writers
+    async def meshPeer(self):
+        meshReceived = asyncio.Queue()
+        meshWriters = []
+
+        async def handle(reader, writer):
+            meshWriters.append(writer)
+            codec = protocol.MessageCodec()
+            while True:
+                data = await reader.read(protocol.RECV_SIZE)
+                if not data:
+                    break
+                for message in codec.feed(data):
+                    meshReceived.put_nowait(message)
+                reply = codec.takeHandshakeReply()
+                if reply:
+                    writer.write(reply)
+
+        return await asyncio.start_server(handle, "127.0.0.1", 0), meshReceived, meshWriters
+
+    async def test_bridge_joins_mesh_peer(self):
+        meshServer, meshReceived, meshWriters = await self.meshPeer()
+        meshPort = meshServer.sockets[0].getsockname()[1]
+        try:
+            self.relay.bridge("room", [("127.0.0.1", str(meshPort))])
+            self.assertEqual(await asyncio.wait_for(meshReceived.get(), 2), "chatroom-join\nrelay")
+            alice = await self.join("room", "alice")
+            self.assertEqual(await asyncio.wait_for(meshReceived.get(), 2), "chatroom-join\nalice")
+            alice[1].write(alice[2].encode(["chat-message\nalice\nhi mesh"]))
+            self.assertEqual(await asyncio.wait_for(meshReceived.get(), 2), "chat-message\nalice\nhi mesh")
+            self.assertEqual(await self.receive(alice), "relay-offset\n1")
+            # a message of the mesh reaches the relay members
+            meshWriters[0].write(protocol.encodeFrame("chat-message\nbob\nhi relay"))
+            self.assertEqual(await self.receive(alice), "chat-message\nbob\nhi relay")
+        finally:
+            for writer in meshWriters:
+                writer.close()
+            meshServer.close()
+
+    async def test_mesh_peer_that_parks_does_not_park_relay_members(self):
+        meshServer, meshReceived, meshWriters = await self.meshPeer()
+        meshPort = meshServer.sockets[0].getsockname()[1]
+        try:
+            self.relay.bridge("room", [("127.0.0.1", str(meshPort))])
+            self.assertEqual(await asyncio.wait_for(meshReceived.get(), 2), "chatroom-join\nrelay")
+            alice = await self.join("room", "alice")
+            meshWriters[0].write(protocol.encodeFrame("chatroom-leave\nbob\npark"))
+            # without the park field the member drops the bridge instead of parking its relay connection
+            self.assertEqual(await self.receive(alice), "chatroom-leave\nbob")
+            alice[1].write(alice[2].encode(["chatroom-leave\nalice\npark"]))
+            await asyncio.sleep(0.05)
+            self.assertNotIn("room", self.relay.rooms)
+        finally:
+            for writer in meshWriters:
+                writer.close()
+            meshServer.close()
+
+    async def test_member_leave_keeps_the_bridge(self):
+        meshServer, meshReceived, meshWriters = await self.meshPeer()
+        meshPort = meshServer.sockets[0].getsockname()[1]
+        try:
+            self.relay.bridge("room", [("127.0.0.1", str(meshPort))])
+            self.assertEqual(await asyncio.wait_for(meshReceived.get(), 2), "chatroom-join\nrelay")
+            alice = await self.join("room", "alice")
+            bob = await self.join("room", "bob")
+            self.assertEqual(await asyncio.wait_for(meshReceived.get(), 2), "chatroom-join\nalice")
+            self.assertEqual(await asyncio.wait_for(meshReceived.get(), 2), "chatroom-join\nbob")
+            bob[1].write(bob[2].encode(["chatroom-leave\nbob"]))
+            self.assertEqual(await self.receive(alice), "chatroom-join\nbob")
+            self.assertEqual(await self.receive(alice), "chatroom-leave\nbob")
+            # the mesh peer, which would close the bridge on a leave, gets the next message instead
+            alice[1].write(alice[2].encode(["chat-message\nalice\nstill here"]))
+            self.assertEqual(await asyncio.wait_for(meshReceived.get(), 2), "chat-message\nalice\nstill here")
+        finally:
+            for writer in meshWriters:
+                writer.close()
+            meshServer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,313 @@
+import unittest
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import protocol
+from shards import Shard, HashRing, ShardRouter, mergeLists
+
+
+# returns a tcp port and a udp port that are free on localhost
+def freePorts():
+    with socket.socket() as tcp, socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
+        tcp.bind(("127.0.0.1", 0))
+        udp.bind(("127.0.0.1", 0))
+        return tcp.getsockname()[1], udp.getsockname()[1]
+
+
+class TestHashRing(unittest.TestCase):
+    def setUp(self):
+        self.shards = [Shard("127.0.0.1", 17601 + i, 17501 + i) for i in range(4)]
+        self.ring = HashRing(self.shards)
+        self.keys = ["user{}".format(i) for i in range(4000)]
+
+    def test_keys_are_spread_over_the_shards(self):
+        counts = {}
+        for key in self.keys:
+            shard = self.ring.shardFor(key)
+            counts[shard.name] = counts.get(shard.name, 0) + 1
+        self.assertEqual(len(counts), 4)
+        for count in counts.values():
+            self.assertGreater(count, 600)
+            self.assertLess(count, 1400)
+
+    def test_added_shard_only_takes_keys(self):
+        newShard = Shard("127.0.0.1", 17605, 17505)
+        ring = self.ring.withShard(newShard)
+        moved = 0
+        for key in self.keys:
+            if ring.shardFor(key) is not self.ring.shardFor(key):
+                self.assertIs(ring.shardFor(key), newShard)
+                moved += 1
+        self.assertGreater(moved, 400)
+        self.assertLess(moved, 1400)
+
+    def test_same_shards_give_same_placement(self):
+        ring = HashRing([Shard(shard.host, shard.port, shard.portUDP) for shard in self.shards])
+        for key in self.keys[:100]:
+            self.assertEqual(ring.shardFor(key).name, self.ring.shardFor(key).name)
+
+
+class TestMergeLists(unittest.TestCase):
+    def test_full_lists(self):
+        merged = mergeLists(["users-list-success alice", "users-list-success bob carol"], [], " ",
+                            "users-list-success", "users-list-page")
+        self.assertEqual(merged, "users-list-success alice bob carol")
+
+    def test_pages(self):
+        responses = ["users-list-page b a b", "users-list-page - c"]
+        merged = mergeLists(responses, ["limit=2"], " ", "users-list-success", "users-list-page")
+        self.assertEqual(merged, "users-list-page b a b")
+        merged = mergeLists(["users-list-page - d", "users-list-page - c"], ["limit=2"], " ",
+                            "users-list-success", "users-list-page")
+        self.assertEqual(merged, "users-list-page - c d")
+
+    def test_chatroom_pages(self):
+        responses = ["chatroom-list-page -\nb : 2", "chatroom-list-page -\na : 0\nc : 1"]
+        merged = mergeLists(responses, ["limit=2"], "\n", "chatroom-list-success", "chatroom-list-page")
+        self.assertEqual(merged, "chatroom-list-page b\na : 0\nb : 2")
+
+
+# secret the test shards share with the router
+SECRET = "test-shard-secret"
+
+
+# runs registry shards as processes and the router in the test's event loop
+class ShardedRegistryTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.processes = []
+        shards = [self.startShard(*self.storageArgs()) for i in range(2)]
+        for shard in shards:
+            await self.waitForShard(shard)
+        port, portUDP = freePorts()
+        self.router = ShardRouter(shards, "127.0.0.1", port, portUDP, SECRET)
+        await self.router.start()
+        self.clients = []
+
+    async def asyncTearDown(self):
+        for reader, writer, codec in self.clients:
+            writer.close()
+        # lets the router sessions see the peers leave
+        await asyncio.sleep(0.2)
+        self.router.server.close()
+        self.router.helloTransport.close()
+        for process in self.processes:
+            process.kill()
+            process.wait()
+
+    # arguments of the storage of a shard, every shard keeps its accounts in memory of its own
+    def storageArgs(self):
+        return ["--db", "memory"]
+
+    def startShard(self, *storageArgs):
+        port, portUDP = freePorts()
+        self.processes.append(subprocess.Popen(
+            [sys.executable, "registry.py", "--shard", "--host", "127.0.0.1", "--port", str(port),
+             "--udp-port", str(portUDP), "--bcrypt-rounds", "4"] + list(storageArgs),
+            cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL,
+            env=dict(os.environ, **{protocol.SHARD_SECRET_ENV: SECRET}),
+        ))
+        return Shard("127.0.0.1", port, portUDP)
+
+    async def waitForShard(self, shard):
+        deadline = time.time() + 10
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(shard.host, shard.port)
+                writer.close()
+                return
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+    # connects to the router, or to a shard at port
+    async def connect(self, port=None):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port or self.router.port)
+        writer.write(protocol.handshake())
+        await reader.readexactly(protocol.HANDSHAKE_SIZE)
+        client = (reader, writer, protocol.MessageCodec(protocol.FRAMED))
+        self.clients.append(client)
+        return client
+
+    async def request(self, client, message):
+        reader, writer, codec = client
+        writer.write(codec.encode([message]))
+        while True:
+            messages = codec.feed(await asyncio.wait_for(reader.read(protocol.RECV_SIZE), 10))
+            if messages:
+                return messages[0]
+
+    # sends the message, if any, and returns the next count messages
+    async def receive(self, client, message, count):
+        reader, writer, codec = client
+        if message is not None:
+            writer.write(codec.encode([message]))
+        messages = []
+        while len(messages) < count:
+            messages += codec.feed(await asyncio.wait_for(reader.read(protocol.RECV_SIZE), 10))
+        return messages
+
+    async def login(self, username, port):
+        client = await self.connect()
+        self.assertEqual(await self.request(client, "JOIN {} pw".format(username)), "join-success")
+        self.assertEqual(await self.request(client, "LOGIN {} pw {}".format(username, port)), "login-success")
+        return client
+
+    # asks the router to add the shard, with the secret of the shards
+    async def addShard(self, client, shard):
+        client[1].write(client[2].encode(["SHARD-AUTH " + SECRET]))
+        return await self.request(client, "SHARD-ADD {}:{}:{}".format(shard.host, shard.port, shard.portUDP))
+
+
+class TestShardedRegistry(ShardedRegistryTestCase):
+    async def test_users_on_every_shard(self):
+        clients = [await self.login("user{}".format(i), 5000 + i) for i in range(12)]
+        owners = {self.router.ring.shardFor("user{}".format(i)).name for i in range(12)}
+        self.assertEqual(len(owners), 2)
+        self.assertEqual(await self.request(clients[0], "JOIN user5 pw"), "join-exist")
+        self.assertEqual(await self.request(clients[0], "SEARCH user7"), "search-success 127.0.0.1:5007")
+        response = await self.request(clients[0], "USERS-LIST")
+        self.assertEqual(sorted(response.split()[1:]), sorted("user{}".format(i) for i in range(12)))
+        response = await self.request(clients[0], "USERS-LIST limit=5 after=user3")
+        self.assertEqual(response, "users-list-page user8 user4 user5 user6 user7 user8")
+
+    async def test_chatroom_members_on_other_shards(self):
+        clients = [await self.login("user{}".format(i), 5000 + i) for i in range(6)]
+        self.assertEqual(await self.request(clients[0], "CHATROOM-CREATE lobby"), "chatroom-creation-success")
+        for client in clients[:5]:
+            await self.request(client, "CHATROOM-JOIN lobby")
+        response = await self.request(clients[5], "CHATROOM-JOIN lobby")
+        self.assertEqual(sorted(response.split("\n")[1:]), ["127.0.0.1,{}".format(5000 + i) for i in range(5)])
+        self.assertEqual(await self.request(clients[0], "CHATROOM-LIST"), "chatroom-list-success\nlobby : 6")
+
+    async def test_private_message_to_a_user_of_another_shard(self):
+        ring = self.router.ring
+        recipient = next("user{}".format(i) for i in range(1, 20)
+                         if ring.shardFor("user{}".format(i)).name != ring.shardFor("user0").name)
+        client = await self.login("user0", 5000)
+        other = await self.connect()
+        self.assertEqual(await self.request(other, "JOIN {} pw".format(recipient)), "join-success")
+        self.assertEqual(await self.request(client, "PRIVATE-MESSAGE {} see you later".format(recipient)),
+                         "private-message-queued")
+        self.assertEqual(await self.request(client, "PRIVATE-MESSAGE nobody hi"), "private-message-user-not-found")
+        # the queued messages are pushed right after the login
+        messages = await self.receive(other, "LOGIN {} pw 5001".format(recipient), 2)
+        self.assertIn("login-success", messages)
+        self.assertIn("private-messages 1\nuser0", [message[:len("private-messages 1\nuser0")] for message in messages])
+        self.assertEqual(await self.request(client, "PRIVATE-MESSAGE {} now".format(recipient)), "private-message-delivered")
+        self.assertTrue((await self.receive(other, None, 1))[0].endswith(" 3\nnow"))
+
+    async def test_resume_through_the_router(self):
+        client = await self.connect()
+        self.assertEqual(await self.request(client, "JOIN user1 pw"), "join-success")
+        response, token = (await self.request(client, "LOGIN user1 pw 5001 token")).split()
+        self.assertEqual(response, "login-success")
+        client[1].close()
+        resumed = await self.connect()
+        response = await self.request(resumed, "RESUME user1 {} 5001".format(token))
+        self.assertTrue(response.startswith("resume-success "))
+        self.assertEqual(await self.request(resumed, "SEARCH user1"), "search-success 127.0.0.1:5001")
+        self.assertEqual(await self.request(await self.connect(), "RESUME user1 {} 5001".format(token)), "resume-invalid")
+
+    async def test_shard_refuses_shard_commands_without_the_secret(self):
+        shard = self.router.ring.shards[0]
+        client = await self.connect(shard.port)
+        self.assertEqual(await self.request(client, "ACCOUNTS-EXPORT limit=10"), "shard-unauthorized")
+        self.assertEqual(await self.request(client, "ROOMS-DELETE lobby"), "shard-unauthorized")
+        client[1].write(client[2].encode(["SHARD-AUTH wrong"]))
+        self.assertEqual(await self.request(client, "ACCOUNTS-EXPORT limit=10"), "shard-unauthorized")
+        client[1].write(client[2].encode(["SHARD-AUTH " + SECRET]))
+        self.assertTrue((await self.request(client, "ACCOUNTS-EXPORT limit=10")).startswith("accounts-page "))
+
+    async def test_command_without_its_arguments(self):
+        client = await self.connect()
+        self.assertEqual(await self.request(client, "SEARCH"), "search-invalid")
+        self.assertEqual(await self.request(client, "LOGIN user1"), "login-invalid")
+        # the session goes on
+        self.assertEqual(await self.request(client, "JOIN user1 pw"), "join-success")
+
+    async def test_shard_add_without_the_secret(self):
+        client = await self.connect()
+        shard = self.startShard(*self.storageArgs())
+        await self.waitForShard(shard)
+        address = "SHARD-ADD {}:{}:{}".format(shard.host, shard.port, shard.portUDP)
+        self.assertEqual(await self.request(client, address), "shard-unauthorized")
+        client[1].write(client[2].encode(["SHARD-AUTH wrong"]))
+        self.assertEqual(await self.request(client, address), "shard-unauthorized")
+        self.assertEqual(len(self.router.ring.shards), 2)
+
+    async def test_added_shard_takes_its_accounts(self):
+        clients = [await self.login("user{}".format(i), 5000 + i) for i in range(20)]
+        await self.request(clients[0], "CHATROOM-CREATE lobby")
+        shard = self.startShard(*self.storageArgs())
+        await self.waitForShard(shard)
+        response = await self.addShard(clients[0], shard)
+        moved = [i for i in range(20) if self.router.ring.shardFor("user{}".format(i)).name == shard.name]
+        self.assertEqual(response.split()[:2], ["shard-add-success", str(len(moved))])
+        self.assertTrue(moved)
+        # once everything moved the previous owners are no longer asked
+        self.assertIsNone(self.router.previousRing)
+        # users that stayed logged in on their previous shard are still found
+        self.assertEqual(await self.request(clients[0], "SEARCH user{}".format(moved[0])),
+                         "search-success 127.0.0.1:{}".format(5000 + moved[0]))
+        # and log in on their new shard next time
+        client = await self.connect()
+        self.assertEqual(await self.request(client, "LOGIN user{} pw 6000".format(moved[-1])), "login-online")
+        self.assertEqual(await self.request(client, "JOIN user{} pw".format(moved[-1])), "join-exist")
+        self.assertEqual(await self.request(client, "CHATROOM-JOIN lobby"), "chatroom-join-success")
+
+
+# shards that keep their accounts in sqlite files, and their logs, in a directory of the test
+class TestShardedRegistryOnSQLite(ShardedRegistryTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.shardCount = 0
+        await super().asyncSetUp()
+
+    async def asyncTearDown(self):
+        await super().asyncTearDown()
+        self.directory.cleanup()
+
+    # a file and a log of its own for every shard
+    def storageArgs(self):
+        self.shardCount += 1
+        return self.sharedStorageArgs(self.shardCount)
+
+    def sharedStorageArgs(self, number):
+        path = os.path.join(self.directory.name, "registry-{}".format(number))
+        return ["--db", "sqlite", "--db-path", path + ".db", "--log-file", path + ".log"]
+
+    async def test_added_shard_keeps_every_account(self):
+        client = await self.connect()
+        for i in range(20):
+            self.assertEqual(await self.request(client, "JOIN user{} pw".format(i)), "join-success")
+        shard = self.startShard(*self.storageArgs())
+        await self.waitForShard(shard)
+        response = await self.addShard(client, shard)
+        self.assertEqual(response.split()[0], "shard-add-success")
+        self.assertGreater(int(response.split()[1]), 0)
+        for i in range(20):
+            self.assertEqual(await self.request(client, "SEARCH user{}".format(i)), "search-user-not-online")
+
+    async def test_shard_of_a_shared_storage_is_not_added(self):
+        client = await self.connect()
+        for i in range(20):
+            await self.request(client, "JOIN user{} pw".format(i))
+        ring = self.router.ring
+        # the storage of the first shard
+        shard = self.startShard(*self.sharedStorageArgs(1))
+        await self.waitForShard(shard)
+        response = await self.addShard(client, shard)
+        self.assertEqual(response, "shard-add-shared-storage")
+        self.assertIs(self.router.ring, ring)
+        self.assertIsNone(self.router.previousRing)
+        for i in range(20):
+            self.assertEqual(await self.request(client, "SEARCH user{}".format(i)), "search-user-not-online")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,40 +1,746 @@
 # Includes database operations
-from pymongo import MongoClient
+import asyncio
+import hashlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from metrics import LatencyHistogram
 
+# pymongo is only needed by the mongo backend
+try:
+    from pymongo import MongoClient, ASCENDING, UpdateOne
+    from pymongo.errors import DuplicateKeyError, BulkWriteError
+except ImportError:
+    MongoClient = None
 
-class DB:
-    # db initializations
+# backend used when none is given, overridden by the P2P_DB_BACKEND environment variable
+DEFAULT_BACKEND = "mongo"
+MONGO_URI = "mongodb://localhost:27017/"
+MONGO_DATABASE = "p2p-chat-phase-3"
+SQLITE_PATH = "registry.db"
+
+
+# Size bounded LRU cache of account records with a time to live. Unknown
+# usernames are cached too (negative entries), with a shorter time to live,
+# so repeated lookups of a missing account do not reach the database.
+class AccountCache:
+    def __init__(self, max_size=10000, ttl=300, negative_ttl=10):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # username -> (account or None, expiry time), least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # returns (True, account) on a hit, where account is None for a known missing
+    # username, and (False, None) on a miss
+    def get(self, username):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self.entries[username]
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(username)
+            self.hits += 1
+            return True, entry[0]
+
+    # caches the account of the username, None records that it does not exist
+    def put(self, username, account):
+        ttl = self.ttl if account is not None else self.negative_ttl
+        with self.lock:
+            self.entries[username] = (account, time.monotonic() + ttl)
+            self.entries.move_to_end(username)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    # drops the cached entry of the username
+    def invalidate(self, username):
+        with self.lock:
+            self.entries.pop(username, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    # hit/miss counters for sizing the cache
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+# Storage interface behind DB, every backend keeps the accounts, the online
+# peers and the chatrooms of the registry and implements these operations
+class StorageBackend:
+    # prepares the storage, creating the unique username indexes
+    def ensure_indexes(self):
+        raise NotImplementedError
+
+    # returns {"username", "password"} of the account, or None
+    def find_account(self, username):
+        raise NotImplementedError
+
+    # creates the account, returns False if the username is taken
+    def insert_account(self, username, password):
+        raise NotImplementedError
+
+    # creates the accounts of (username, password) pairs, returns the number created
+    def insert_accounts(self, accounts):
+        raise NotImplementedError
+
+    # returns up to limit (username, password) pairs in username order, after the given username
+    def find_accounts(self, after, limit):
+        raise NotImplementedError
+
+    # deletes the accounts of the usernames, returns the number deleted
+    def delete_accounts(self, usernames):
+        raise NotImplementedError
+
+    # returns (ip, port) of the online user, or None
+    def find_online_peer(self, username):
+        raise NotImplementedError
+
+    # returns username -> (ip, port) of the online ones among the usernames
+    def find_online_peers(self, usernames):
+        raise NotImplementedError
+
+    # inserts or replaces the online records of (username, ip, port) tuples
+    def upsert_online_peers(self, peers):
+        raise NotImplementedError
+
+    # deletes the online records of the usernames
+    def delete_online_peers(self, usernames):
+        raise NotImplementedError
+
+    # deletes every online record
+    def clear_online_peers(self):
+        raise NotImplementedError
+
+    # returns the names of the saved chatrooms
+    def find_chatrooms(self):
+        raise NotImplementedError
+
+    # saves the chatroom, returns False if it is already saved
+    def insert_chatroom(self, name):
+        raise NotImplementedError
+
+    # deletes the saved chatroom
+    def delete_chatroom(self, name):
+        raise NotImplementedError
+
+    # returns every waiting private message as (id, recipient, sender, content, created)
+    def find_offline_messages(self):
+        raise NotImplementedError
+
+    # saves (id, recipient, sender, content, created) messages
+    def insert_offline_messages(self, messages):
+        raise NotImplementedError
+
+    # deletes the messages of the ids
+    def delete_offline_messages(self, ids):
+        raise NotImplementedError
+
+    # returns the name of the storage, backends of the same name share their data
+    def location(self):
+        raise NotImplementedError
+
+
+# MongoDB backend, the collections are indexed on username. The connection
+# pool is sized explicitly and every wait is bounded by a timeout, so a lost
+# server shows up as an error instead of hanging the registry threads.
+class MongoBackend(StorageBackend):
+    def __init__(self, uri=MONGO_URI, database=MONGO_DATABASE, pool_size=100, min_pool_size=0,
+                 timeout_ms=5000, write_concern=None, read_preference=None):
+        if MongoClient is None:
+            raise RuntimeError("the mongo backend needs pymongo installed")
+        options = {
+            "maxPoolSize": pool_size,
+            "minPoolSize": min_pool_size,
+            "serverSelectionTimeoutMS": timeout_ms,
+            "connectTimeoutMS": timeout_ms,
+            "socketTimeoutMS": timeout_ms,
+            "waitQueueTimeoutMS": timeout_ms,
+        }
+        # write concern is a number of nodes or a mode such as "majority"
+        if write_concern is not None:
+            options["w"] = int(write_concern) if str(write_concern).isdigit() else write_concern
+        # read preference such as "primary", "primaryPreferred" or "secondaryPreferred"
+        if read_preference is not None:
+            options["readPreference"] = read_preference
+        self.client = MongoClient(uri, **options)
+        self.db = self.client[database]
+        # the uri may hold a password, only its hash is told
+        self.name = "mongo {} {}".format(hashlib.sha256(uri.encode()).hexdigest()[:16], database)
+
+    def location(self):
+        return self.name
+
+    def ensure_indexes(self):
+        self.db.accounts.create_index([("username", ASCENDING)], unique=True)
+        self.db.online_peers.create_index([("username", ASCENDING)], unique=True)
+        self.db.chatrooms.create_index([("name", ASCENDING)], unique=True)
+        self.db.offline_messages.create_index([("recipient", ASCENDING)])
+
+    def find_account(self, username):
+        return self.db.accounts.find_one({"username": username}, {"_id": 0, "username": 1, "password": 1})
+
+    def insert_account(self, username, password):
+        try:
+            self.db.accounts.insert_one({"username": username, "password": password})
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def insert_accounts(self, accounts):
+        documents = [{"username": username, "password": password} for username, password in accounts]
+        try:
+            return len(self.db.accounts.insert_many(documents, ordered=False).inserted_ids)
+        except BulkWriteError as err:
+            return err.details["nInserted"]
+
+    def find_accounts(self, after, limit):
+        query = {} if after is None else {"username": {"$gt": after}}
+        cursor = self.db.accounts.find(query, {"_id": 0, "username": 1, "password": 1})
+        return [(res["username"], res["password"]) for res in cursor.sort("username", ASCENDING).limit(limit)]
+
+    def delete_accounts(self, usernames):
+        return self.db.accounts.delete_many({"username": {"$in": list(usernames)}}).deleted_count
+
+    def find_online_peer(self, username):
+        res = self.db.online_peers.find_one({"username": username})
+        if res is None:
+            return None
+        return (res["ip"], res["port"])
+
+    def find_online_peers(self, usernames):
+        cursor = self.db.online_peers.find(
+            {"username": {"$in": list(usernames)}}, {"_id": 0, "username": 1, "ip": 1, "port": 1}
+        )
+        return {res["username"]: (res["ip"], res["port"]) for res in cursor}
+
+    def upsert_online_peers(self, peers):
+        requests = [
+            UpdateOne({"username": username}, {"$set": {"ip": ip, "port": port}}, upsert=True)
+            for username, ip, port in peers
+        ]
+        self.db.online_peers.bulk_write(requests, ordered=False)
+
+    def delete_online_peers(self, usernames):
+        self.db.online_peers.delete_many({"username": {"$in": list(usernames)}})
+
+    def clear_online_peers(self):
+        self.db.online_peers.delete_many({})
+
+    def find_chatrooms(self):
+        return [res["name"] for res in self.db.chatrooms.find({}, {"_id": 0, "name": 1})]
+
+    def insert_chatroom(self, name):
+        try:
+            self.db.chatrooms.insert_one({"name": name})
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def delete_chatroom(self, name):
+        self.db.chatrooms.delete_one({"name": name})
+
+    def find_offline_messages(self):
+        return [(res["_id"], res["recipient"], res["sender"], res["content"], res["created"])
+                for res in self.db.offline_messages.find({})]
+
+    def insert_offline_messages(self, messages):
+        documents = [
+            {"_id": message_id, "recipient": recipient, "sender": sender, "content": content, "created": created}
+            for message_id, recipient, sender, content, created in messages
+        ]
+        try:
+            self.db.offline_messages.insert_many(documents, ordered=False)
+        except BulkWriteError:
+            # messages written before are left as they are
+            pass
+
+    def delete_offline_messages(self, ids):
+        self.db.offline_messages.delete_many({"_id": {"$in": list(ids)}})
+
+
+# Embedded SQLite backend for registries without an external database. The
+# file is in WAL mode, so readers are not blocked by the writer, and the
+# statements are constant strings, which sqlite3 prepares once and caches.
+class SQLiteBackend(StorageBackend):
+    FIND_ACCOUNT = "SELECT username, password FROM accounts WHERE username = ?"
+    INSERT_ACCOUNT = "INSERT OR IGNORE INTO accounts (username, password) VALUES (?, ?)"
+    FIND_ONLINE_PEER = "SELECT ip, port FROM online_peers WHERE username = ?"
+    UPSERT_ONLINE_PEER = "INSERT OR REPLACE INTO online_peers (username, ip, port) VALUES (?, ?, ?)"
+    DELETE_ONLINE_PEER = "DELETE FROM online_peers WHERE username = ?"
+    INSERT_CHATROOM = "INSERT OR IGNORE INTO chatrooms (name) VALUES (?)"
+    FIND_ACCOUNTS = "SELECT username, password FROM accounts WHERE username > ? ORDER BY username LIMIT ?"
+    DELETE_ACCOUNT = "DELETE FROM accounts WHERE username = ?"
+    INSERT_OFFLINE_MESSAGE = "INSERT OR IGNORE INTO offline_messages (id, recipient, sender, content, created) VALUES (?, ?, ?, ?, ?)"
+    DELETE_OFFLINE_MESSAGE = "DELETE FROM offline_messages WHERE id = ?"
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        if path == ":memory:":
+            self.name = "sqlite {} {} {}".format(socket.gethostname(), os.getpid(), id(self))
+        else:
+            self.name = "sqlite {} {}".format(socket.gethostname(), os.path.realpath(path))
+        # one connection shared by the registry threads, used under the lock
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, cached_statements=64)
+        self.lock = threading.Lock()
+        if path != ":memory:":
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.ensure_indexes()
+
+    def location(self):
+        return self.name
+
+    # the primary keys are the unique username indexes; columns without a type keep the python values as they are
+    def ensure_indexes(self):
+        with self.lock:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS accounts (username TEXT PRIMARY KEY, password)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS online_peers (username TEXT PRIMARY KEY, ip, port)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS chatrooms (name TEXT PRIMARY KEY)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS offline_messages (id TEXT PRIMARY KEY, recipient, sender, content, created)"
+            )
+
+    def find_account(self, username):
+        with self.lock:
+            row = self.connection.execute(self.FIND_ACCOUNT, (username,)).fetchone()
+        if row is None:
+            return None
+        return {"username": row[0], "password": row[1]}
+
+    def insert_account(self, username, password):
+        with self.lock:
+            return self.connection.execute(self.INSERT_ACCOUNT, (username, password)).rowcount == 1
+
+    def insert_accounts(self, accounts):
+        with self.lock:
+            before = self.connection.total_changes
+            with self.connection:
+                self.connection.execute("BEGIN")
+                self.connection.executemany(self.INSERT_ACCOUNT, accounts)
+            return self.connection.total_changes - before
+
+    def find_accounts(self, after, limit):
+        with self.lock:
+            return [tuple(row) for row in self.connection.execute(self.FIND_ACCOUNTS, ("" if after is None else after, limit))]
+
+    def delete_accounts(self, usernames):
+        with self.lock:
+            before = self.connection.total_changes
+            with self.connection:
+                self.connection.execute("BEGIN")
+                self.connection.executemany(self.DELETE_ACCOUNT, [(username,) for username in usernames])
+            return self.connection.total_changes - before
+
+    def find_online_peer(self, username):
+        with self.lock:
+            row = self.connection.execute(self.FIND_ONLINE_PEER, (username,)).fetchone()
+        return None if row is None else (row[0], row[1])
+
+    def find_online_peers(self, usernames):
+        usernames = list(usernames)
+        peers = {}
+        with self.lock:
+            # one query per chunk, sqlite limits the number of parameters
+            for start in range(0, len(usernames), 500):
+                chunk = usernames[start:start + 500]
+                query = "SELECT username, ip, port FROM online_peers WHERE username IN ({})".format(
+                    ",".join("?" * len(chunk))
+                )
+                for username, ip, port in self.connection.execute(query, chunk):
+                    peers[username] = (ip, port)
+        return peers
+
+    def upsert_online_peers(self, peers):
+        with self.lock:
+            with self.connection:
+                self.connection.execute("BEGIN")
+                self.connection.executemany(self.UPSERT_ONLINE_PEER, peers)
+
+    def delete_online_peers(self, usernames):
+        with self.lock:
+            with self.connection:
+                self.connection.execute("BEGIN")
+                self.connection.executemany(self.DELETE_ONLINE_PEER, [(username,) for username in usernames])
+
+    def clear_online_peers(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM online_peers")
+
+    def find_chatrooms(self):
+        with self.lock:
+            return [row[0] for row in self.connection.execute("SELECT name FROM chatrooms")]
+
+    def insert_chatroom(self, name):
+        with self.lock:
+            return self.connection.execute(self.INSERT_CHATROOM, (name,)).rowcount == 1
+
+    def delete_chatroom(self, name):
+        with self.lock:
+            self.connection.execute("DELETE FROM chatrooms WHERE name = ?", (name,))
+
+    def find_offline_messages(self):
+        with self.lock:
+            return [tuple(row) for row in self.connection.execute(
+                "SELECT id, recipient, sender, content, created FROM offline_messages")]
+
+    def insert_offline_messages(self, messages):
+        with self.lock:
+            with self.connection:
+                self.connection.execute("BEGIN")
+                self.connection.executemany(self.INSERT_OFFLINE_MESSAGE, messages)
+
+    def delete_offline_messages(self, ids):
+        with self.lock:
+            with self.connection:
+                self.connection.execute("BEGIN")
+                self.connection.executemany(self.DELETE_OFFLINE_MESSAGE, [(message_id,) for message_id in ids])
+
+
+# Pure in-memory backend, nothing survives a restart
+class MemoryBackend(StorageBackend):
     def __init__(self):
-        self.client = MongoClient("mongodb://localhost:27017/")
-        self.db = self.client["p2p-chat-phase-3"]
+        self.accounts = {}
+        self.online_peers = {}
+        self.chatrooms = set()
+        # id -> (id, recipient, sender, content, created)
+        self.offline_messages = {}
+        self.lock = threading.Lock()
+
+    def ensure_indexes(self):
+        pass
+
+    def location(self):
+        return "memory {} {} {}".format(socket.gethostname(), os.getpid(), id(self))
+
+    def find_account(self, username):
+        password = self.accounts.get(username)
+        if password is None:
+            return None
+        return {"username": username, "password": password}
+
+    def insert_account(self, username, password):
+        with self.lock:
+            if username in self.accounts:
+                return False
+            self.accounts[username] = password
+            return True
+
+    def insert_accounts(self, accounts):
+        return sum(1 for username, password in accounts if self.insert_account(username, password))
+
+    def find_accounts(self, after, limit):
+        with self.lock:
+            usernames = sorted(username for username in self.accounts if after is None or username > after)
+            return [(username, self.accounts[username]) for username in usernames[:limit]]
+
+    def delete_accounts(self, usernames):
+        with self.lock:
+            return sum(1 for username in usernames if self.accounts.pop(username, None) is not None)
+
+    def find_online_peer(self, username):
+        return self.online_peers.get(username)
+
+    def find_online_peers(self, usernames):
+        return {username: self.online_peers[username] for username in usernames if username in self.online_peers}
+
+    def upsert_online_peers(self, peers):
+        with self.lock:
+            for username, ip, port in peers:
+                self.online_peers[username] = (ip, port)
+
+    def delete_online_peers(self, usernames):
+        with self.lock:
+            for username in usernames:
+                self.online_peers.pop(username, None)
+
+    def clear_online_peers(self):
+        with self.lock:
+            self.online_peers.clear()
+
+    def find_chatrooms(self):
+        with self.lock:
+            return list(self.chatrooms)
+
+    def insert_chatroom(self, name):
+        with self.lock:
+            if name in self.chatrooms:
+                return False
+            self.chatrooms.add(name)
+            return True
+
+    def delete_chatroom(self, name):
+        with self.lock:
+            self.chatrooms.discard(name)
+
+    def find_offline_messages(self):
+        with self.lock:
+            return list(self.offline_messages.values())
+
+    def insert_offline_messages(self, messages):
+        with self.lock:
+            for message in messages:
+                self.offline_messages.setdefault(message[0], tuple(message))
+
+    def delete_offline_messages(self, ids):
+        with self.lock:
+            for message_id in ids:
+                self.offline_messages.pop(message_id, None)
+
+
+# Wraps a backend and records the latency of every operation in a histogram
+# per operation name
+class TimedBackend:
+    def __init__(self, backend):
+        self.backend = backend
+        self.histograms = {}
+
+    def __getattr__(self, name):
+        attribute = getattr(self.backend, name)
+        # only the operations of the storage interface are timed
+        if not hasattr(StorageBackend, name) or name.startswith("_"):
+            return attribute
+        histogram = self.histograms.setdefault(name, LatencyHistogram())
+
+        def timed(*args):
+            start = time.perf_counter()
+            try:
+                return attribute(*args)
+            finally:
+                histogram.record(time.perf_counter() - start)
+
+        # later lookups find the wrapper directly, without __getattr__
+        self.__dict__[name] = timed
+        return timed
+
+    # latency summary of every operation called so far
+    def latency_stats(self):
+        return {name: histogram.snapshot() for name, histogram in self.histograms.items()}
+
+
+# creates a backend by name, "mongo", "sqlite" or "memory",
+# options are the pool and timeout settings of the mongo backend
+def create_backend(name=None, path=None, **options):
+    if name is None:
+        name = os.environ.get("P2P_DB_BACKEND", DEFAULT_BACKEND)
+    if name == "mongo":
+        return MongoBackend(os.environ.get("P2P_MONGO_URI", MONGO_URI), **options)
+    if name == "sqlite":
+        return SQLiteBackend(path or os.environ.get("P2P_DB_PATH", SQLITE_PATH))
+    if name == "memory":
+        return MemoryBackend()
+    raise ValueError("unknown database backend: {}".format(name))
+
+
+class DB:
+    # db initializations, backend is a StorageBackend or the name of one
+    def __init__(self, backend=None, cache_size=10000, cache_ttl=300, negative_cache_ttl=10):
+        if backend is None or isinstance(backend, str):
+            backend = create_backend(backend)
+        self.backend = TimedBackend(backend)
+        # cache of account lookups, accounts rarely change once registered
+        self.account_cache = AccountCache(cache_size, cache_ttl, negative_cache_ttl)
+
+    # replaces the storage backend, used when the registry is configured at startup
+    def set_backend(self, backend):
+        self.backend = TimedBackend(backend)
+        self.account_cache.clear()
+
+    # latency summary (count, mean, p50, p99 in seconds) of every storage operation
+    def latency_stats(self):
+        return self.backend.latency_stats()
+
+    # latency histogram of every storage operation called so far
+    def latency_histograms(self):
+        return dict(self.backend.histograms)
+
+    # creates the unique username indexes, lookups use them instead of scanning
+    # the collections, and duplicate accounts or online records are refused
+    def ensure_indexes(self):
+        self.backend.ensure_indexes()
+
+    # retrieves the account record of the username through the cache, None if it does not exist
+    def find_account(self, username):
+        hit, account = self.account_cache.get(username)
+        if hit:
+            return account
+        return self.load_account(username)
+
+    # reads the account record from the backend into the cache
+    def load_account(self, username):
+        account = self.backend.find_account(username)
+        self.account_cache.put(username, account)
+        return account
 
     # checks if an account with the username exists
     def is_account_exist(self, username):
-        return self.db.accounts.find_one({"username": username}) is not None
+        return self.find_account(username) is not None
 
-    # registers a user
+    # registers a user, returns False if the username is already taken
     def register(self, username, password):
-        account = {"username": username, "password": password}
-        self.db.accounts.insert_one(account)
+        try:
+            return self.backend.insert_account(username, password)
+        finally:
+            # a negative entry of the username would now be wrong
+            self.account_cache.invalidate(username)
+
+    # registers several users with one round trip, takes (username, password) pairs
+    # and returns the number of accounts created, taken usernames are skipped
+    def bulk_register(self, accounts):
+        accounts = list(accounts)
+        if not accounts:
+            return 0
+        try:
+            return self.backend.insert_accounts(accounts)
+        finally:
+            for username, password in accounts:
+                self.account_cache.invalidate(username)
+
+    # returns up to limit (username, password) pairs in username order after the given
+    # username, used to move accounts between the shards of a sharded registry
+    def export_accounts(self, after, limit):
+        return self.backend.find_accounts(after, limit)
+
+    # name of the storage, registries that tell the same name share their accounts
+    def storage_location(self):
+        return self.backend.location()
+
+    # deletes the accounts of the usernames, returns the number deleted
+    def delete_accounts(self, usernames):
+        usernames = list(usernames)
+        if not usernames:
+            return 0
+        try:
+            return self.backend.delete_accounts(usernames)
+        finally:
+            for username in usernames:
+                self.account_cache.invalidate(username)
 
     # retrieves the password for a given username
     def get_password(self, username):
-        return self.db.accounts.find_one({"username": username})["password"]
+        return self.find_account(username)["password"]
+
+    # hit/miss counters of the account cache
+    def cache_stats(self):
+        return self.account_cache.stats()
 
     # checks if an account with the username online
     def is_account_online(self, username):
-        return self.db.online_peers.find_one({"username": username}) is not None
+        return self.backend.find_online_peer(username) is not None
 
-    # logs in the user
+    # logs in the user, an existing record of the user is replaced
     def user_login(self, username, ip, port):
-        online_peer = {"username": username, "ip": ip, "port": port}
-        self.db.online_peers.insert_one(online_peer)
+        self.backend.upsert_online_peers([(username, ip, port)])
+
+    # logs in several users with one round trip, takes (username, ip, port) tuples
+    def bulk_login(self, peers):
+        peers = list(peers)
+        if peers:
+            self.backend.upsert_online_peers(peers)
 
     # logs out the user
     def user_logout(self, username):
-        self.db.online_peers.delete_one({"username": username})
+        self.backend.delete_online_peers([username])
+
+    # logs out several users with one round trip
+    def bulk_logout(self, usernames):
+        usernames = list(usernames)
+        if usernames:
+            self.backend.delete_online_peers(usernames)
+
+    # logs out every user, used when the registry starts
+    def clear_online_peers(self):
+        self.backend.clear_online_peers()
 
     # retrieves the ip address and the port number of the username
     def get_peer_ip_port(self, username):
-        res = self.db.online_peers.find_one({"username": username})
-        return (res["ip"], res["port"])
+        return self.backend.find_online_peer(username)
+
+    # retrieves the ip addresses and port numbers of several usernames with one
+    # round trip, returns a dict of username -> (ip, port) of the online ones
+    def get_peers_ip_port(self, usernames):
+        return self.backend.find_online_peers(usernames)
+
+    # retrieves the names of the saved chatrooms
+    def get_chatrooms(self):
+        return self.backend.find_chatrooms()
+
+    # saves a chatroom, returns False if it already exists
+    def create_chatroom(self, name):
+        return self.backend.insert_chatroom(name)
+
+    # deletes a saved chatroom
+    def delete_chatroom(self, name):
+        self.backend.delete_chatroom(name)
+
+    # retrieves the private messages waiting for their recipients,
+    # as (id, recipient, sender, content, created) tuples
+    def load_offline_messages(self):
+        return self.backend.find_offline_messages()
+
+    # saves waiting private messages with one round trip
+    def store_offline_messages(self, messages):
+        messages = list(messages)
+        if messages:
+            self.backend.insert_offline_messages(messages)
+
+    # deletes delivered or expired private messages with one round trip
+    def delete_offline_messages(self, ids):
+        ids = list(ids)
+        if ids:
+            self.backend.delete_offline_messages(ids)
+
+
+# Awaitable front of DB for the asyncio registry. Cached account lookups are
+# answered on the event loop, every other call runs on the executor, so the
+# loop never waits for the database.
+class AsyncDB:
+    def __init__(self, db, executor=None):
+        self.db = db
+        self.executor = executor
+
+    # runs a blocking DB method on the executor
+    async def run(self, method, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, method, *args)
+
+    async def find_account(self, username):
+        hit, account = self.db.account_cache.get(username)
+        if hit:
+            return account
+        return await self.run(self.db.load_account, username)
+
+    async def is_account_exist(self, username):
+        return await self.find_account(username) is not None
+
+    async def get_password(self, username):
+        return (await self.find_account(username))["password"]
+
+    # any other DB method is awaited on the executor
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+
+        async def call(*args):
+            return await self.run(method, *args)
+
+        return call
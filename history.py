@@ -0,0 +1,279 @@
+# Message history of the chatrooms, kept by the relay
+#
+# Every room has an append-only log split into segment files named after the
+# offset of their first message. A record is a header (offset, time, length)
+# followed by the binary chat message as it was sent. Segments are read
+# through memory maps, and a sparse index of every segment points at a record
+# every INDEX_INTERVAL bytes, so a replay seeks once and then reads on.
+# Segments whose newest message is older than the retention are deleted.
+# Only the segment a room appends to is kept open, and only rooms in use.
+import bisect
+import mmap
+import os
+import struct
+import time
+from urllib.parse import quote, unquote
+
+# bytes of a segment after which the next message starts a new one
+SEGMENT_BYTES = 4 * 1024 * 1024
+# bytes of records between two entries of the sparse index
+INDEX_INTERVAL = 4096
+# seconds a message is kept
+RETENTION_SECONDS = 7 * 24 * 3600
+# messages returned by one read at most
+MAX_READ = 1000
+SEGMENT_SUFFIX = ".log"
+
+recordHeader = struct.Struct("!QdI")
+
+
+# One segment file of a room log, appended with unbuffered writes and read
+# through a memory map that is remapped when the file has grown; a closed
+# segment is opened again by the next read
+class Segment:
+    def __init__(self, path, baseOffset):
+        self.path = path
+        self.baseOffset = baseOffset
+        self.file = open(path, "ab+", buffering=0)
+        self.size = 0
+        self.nextOffset = baseOffset
+        # time of the newest record, None while the segment is empty
+        self.lastTime = None
+        # sparse index, offsets and positions of every INDEX_INTERVAL bytes of records
+        self.indexOffsets = []
+        self.indexPositions = []
+        self.map = None
+        self.recover()
+
+    # rebuilds the index from the records, a partly written last record is cut off
+    def recover(self):
+        size = os.fstat(self.file.fileno()).st_size
+        position = 0
+        if size:
+            view = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                while position + recordHeader.size <= size:
+                    offset, created, length = recordHeader.unpack_from(view, position)
+                    end = position + recordHeader.size + length
+                    if end > size:
+                        break
+                    self.indexRecord(offset, position)
+                    self.nextOffset = offset + 1
+                    self.lastTime = created
+                    position = end
+            finally:
+                view.close()
+        if position < size:
+            self.file.truncate(position)
+        self.size = position
+
+    def indexRecord(self, offset, position):
+        if not self.indexPositions or position - self.indexPositions[-1] >= INDEX_INTERVAL:
+            self.indexOffsets.append(offset)
+            self.indexPositions.append(position)
+
+    def append(self, payload, created):
+        offset = self.nextOffset
+        self.file.write(recordHeader.pack(offset, created, len(payload)) + payload)
+        self.indexRecord(offset, self.size)
+        self.size += recordHeader.size + len(payload)
+        self.nextOffset = offset + 1
+        self.lastTime = created
+        return offset
+
+    # returns up to limit records (offset, time, payload) from the offset on
+    def read(self, since, limit):
+        records = []
+        if self.size == 0 or since >= self.nextOffset:
+            return records
+        if self.file is None:
+            self.file = open(self.path, "ab+", buffering=0)
+        if self.map is None or len(self.map) < self.size:
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+        view = self.map
+        entry = bisect.bisect_right(self.indexOffsets, since) - 1
+        position = self.indexPositions[max(entry, 0)]
+        while position < self.size and len(records) < limit:
+            offset, created, length = recordHeader.unpack_from(view, position)
+            start = position + recordHeader.size
+            position = start + length
+            if offset >= since:
+                records.append((offset, created, view[start:position]))
+        return records
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def delete(self):
+        self.close()
+        os.remove(self.path)
+
+
+# Append-only log of one room, a list of segments in offset order; the last
+# one takes the appends and is the only one kept open between reads
+class RoomLog:
+    def __init__(self, directory, segmentBytes=SEGMENT_BYTES):
+        self.directory = directory
+        self.segmentBytes = segmentBytes
+        os.makedirs(directory, exist_ok=True)
+        bases = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                       if name.endswith(SEGMENT_SUFFIX))
+        self.segments = [Segment(self.segmentPath(base), base) for base in bases]
+        if not self.segments:
+            self.segments.append(Segment(self.segmentPath(0), 0))
+        self.closeIdle()
+
+    def segmentPath(self, baseOffset):
+        return os.path.join(self.directory, "{:020d}{}".format(baseOffset, SEGMENT_SUFFIX))
+
+    @property
+    def firstOffset(self):
+        return self.segments[0].baseOffset
+
+    @property
+    def nextOffset(self):
+        return self.segments[-1].nextOffset
+
+    # appends a message and returns its offset
+    def append(self, payload, created=None):
+        if self.segments[-1].size >= self.segmentBytes:
+            self.roll()
+        return self.segments[-1].append(payload, time.time() if created is None else created)
+
+    # starts a new segment at the next offset
+    def roll(self):
+        nextOffset = self.nextOffset
+        self.segments[-1].close()
+        self.segments.append(Segment(self.segmentPath(nextOffset), nextOffset))
+
+    # closes the segments before the last, opened by a replay
+    def closeIdle(self):
+        for segment in self.segments[:-1]:
+            segment.close()
+
+    # time of the newest message of the oldest segment, None while it is empty
+    @property
+    def oldestTime(self):
+        return self.segments[0].lastTime
+
+    # returns up to limit records (offset, time, payload) from the offset on,
+    # read in order from the segment holding the offset onwards
+    def read(self, since, limit=MAX_READ):
+        limit = min(limit, MAX_READ)
+        bases = [segment.baseOffset for segment in self.segments]
+        records = []
+        for segment in self.segments[max(bisect.bisect_right(bases, since) - 1, 0):]:
+            records += segment.read(since, limit - len(records))
+            if len(records) == limit:
+                break
+        return records
+
+    # returns the last count records
+    def last(self, count):
+        count = min(count, MAX_READ)
+        return self.read(max(self.nextOffset - count, 0), count)
+
+    # deletes the segments whose newest message is older than the retention;
+    # an expired last segment is replaced by an empty one, so offsets go on
+    def expire(self, retention, now=None):
+        deadline = (time.time() if now is None else now) - retention
+        expired = 0
+        while self.segments and self.segments[0].lastTime is not None and self.segments[0].lastTime < deadline:
+            if len(self.segments) == 1:
+                self.roll()
+            self.segments.pop(0).delete()
+            expired += 1
+        return expired
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+
+# Logs of every room under one directory, a room's log is opened on first use
+# and closed by the retention pass once the room was not used since the last one
+class MessageHistory:
+    def __init__(self, directory, retention=RETENTION_SECONDS, segmentBytes=SEGMENT_BYTES):
+        self.directory = directory
+        self.retention = retention
+        self.segmentBytes = segmentBytes
+        # room -> RoomLog of the open rooms
+        self.rooms = {}
+        # open rooms read or appended since the last retention pass
+        self.used = set()
+        # room -> time from which the oldest segment of a closed room has expired
+        self.closedExpiry = {}
+
+    def room(self, name):
+        self.used.add(name)
+        log = self.rooms.get(name)
+        if log is None:
+            log = self.openLog(name)
+            self.rooms[name] = log
+            self.closedExpiry.pop(name, None)
+        return log
+
+    def openLog(self, name):
+        # dots are escaped too, a room named ".." stays under the directory
+        return RoomLog(os.path.join(self.directory, quote(name, safe="").replace(".", "%2E")), self.segmentBytes)
+
+    # closes the log of a room and remembers when the retention has to look at it again
+    def closeLog(self, name, log):
+        oldestTime = log.oldestTime
+        self.closedExpiry[name] = float("inf") if oldestTime is None else oldestTime + self.retention
+        log.close()
+
+    def append(self, room, payload, created=None):
+        return self.room(room).append(payload, created)
+
+    # returns the records of the room from the offset on, and the offset after them
+    def since(self, room, offset, limit=MAX_READ):
+        log = self.room(room)
+        records = log.read(max(offset, log.firstOffset), limit)
+        return records, records[-1][0] + 1 if records else log.nextOffset
+
+    # returns the last count records of the room, and the offset after them
+    def last(self, room, count):
+        log = self.room(room)
+        records = log.last(count)
+        return records, records[-1][0] + 1 if records else log.nextOffset
+
+    # applies the retention to the logs of every room and closes the rooms and
+    # segments nobody used since the last pass; the log of a closed room, such
+    # as one of an earlier run, is only opened once its oldest segment may have
+    # expired, and closed again right after
+    def expire(self, now=None):
+        now = time.time() if now is None else now
+        expired = 0
+        for name, log in list(self.rooms.items()):
+            expired += log.expire(self.retention, now)
+            if name in self.used:
+                log.closeIdle()
+            else:
+                del self.rooms[name]
+                self.closeLog(name, log)
+        self.used.clear()
+        if os.path.isdir(self.directory):
+            for entry in os.listdir(self.directory):
+                name = unquote(entry)
+                if name in self.rooms or self.closedExpiry.get(name, 0) > now:
+                    continue
+                log = self.openLog(name)
+                try:
+                    expired += log.expire(self.retention, now)
+                finally:
+                    self.closeLog(name, log)
+        return expired
+
+    def close(self):
+        for log in self.rooms.values():
+            log.close()
+        self.rooms = {}
+        self.used.clear()
@@ -0,0 +1,102 @@
+# Logging pipeline of the registry processes
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+# bytes of a log file before it is rotated, and the rotated files kept
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+# records per second written for a rate limited category, a record is put in
+# a category with extra={"category": ...}; HELLO records come every second
+# from every peer
+CATEGORY_RATES = {"hello": 10}
+
+# attributes every LogRecord has, the others were given with extra= and are
+# written as fields of the JSON record
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+
+# Formats a record as one JSON object per line, with the fields given in extra=
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# Token bucket per category of records: past its rate the records of a
+# category are dropped, and the next one let through tells how many were
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rates=CATEGORY_RATES):
+        logging.Filter.__init__(self)
+        self.rates = rates
+        # category -> [tokens, time of the last record, records dropped since the last one let through]
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, "category", None))
+        if rate is None:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(record.category)
+            if bucket is None:
+                bucket = self.buckets[record.category] = [rate, now, 0]
+            bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            if bucket[2]:
+                record.suppressed = bucket[2]
+                bucket[2] = 0
+        return True
+
+
+# QueueHandler that hands the record over as it is, its message is only
+# formatted by the listener thread, if it is written at all
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+# Sends the records of every logger to a queue; one listener thread formats
+# them as JSON lines into a rotating file, and onto the terminal with
+# console, so a thread that logs never waits for the disk or a terminal.
+# Returns the listener, which is stopped, and the queue flushed, at exit.
+def setupLogging(filename, level=logging.INFO, console=False, rates=CATEGORY_RATES,
+                 maxBytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+    records = queue.SimpleQueue()
+    fileHandler = logging.handlers.RotatingFileHandler(filename, maxBytes=maxBytes, backupCount=backups)
+    fileHandler.setFormatter(JsonFormatter())
+    handlers = [fileHandler]
+    if console:
+        consoleHandler = logging.StreamHandler()
+        consoleHandler.setFormatter(logging.Formatter("%(levelname)s %(name)s: %(message)s"))
+        handlers.append(consoleHandler)
+    listener = logging.handlers.QueueListener(records, *handlers)
+    handler = DeferredQueueHandler(records)
+    handler.addFilter(RateLimitFilter(rates))
+    root = logging.getLogger()
+    for previous in list(root.handlers):
+        root.removeHandler(previous)
+    root.addHandler(handler)
+    root.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
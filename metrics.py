@@ -0,0 +1,164 @@
+# Latency measurements of the registry, and their Prometheus endpoint
+import bisect
+import http.server
+import threading
+
+# upper bounds (seconds) of the histogram buckets, 1us doubling up to about 8s
+LATENCY_BUCKETS = tuple(0.000001 * 2 ** i for i in range(24))
+
+
+# Histogram of latencies on fixed, exponentially growing buckets, recording
+# a value is a bisect and two additions
+class LatencyHistogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # the last count is for values above the highest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+
+    # upper bound of the bucket holding the given quantile, 0 < quantile <= 1
+    def quantile(self, quantile):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.count
+        if total == 0:
+            return 0.0
+        rank = quantile * total
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+    # cumulative count of every bucket, the total count and the sum
+    def cumulative(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.count
+            seconds = self.sum
+        running = 0
+        cumulative = []
+        for count in counts[:-1]:
+            running += count
+            cumulative.append(running)
+        return cumulative, total, seconds
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+
+# Counters, latency histograms and gauges of a process in the Prometheus text
+# format. Histograms and counters have one label; a histogram's count is the
+# counter of its events. Gauges, and histograms kept elsewhere, are functions
+# called on every scrape, so they cost nothing between scrapes.
+class Metrics:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        # name -> (help, label, {label value -> LatencyHistogram} or a function returning one)
+        self.histograms = {}
+        # name -> (help, label, {label value -> count})
+        self.counters = {}
+        # name -> (help, label, function returning a number, or {label value -> number} with a label, type)
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, name, help, label, source=None):
+        self.histograms[name] = (help, label, {} if source is None else source)
+
+    def counter(self, name, help, label):
+        self.counters[name] = (help, label, {})
+
+    # kind is "counter" for totals kept by other objects, like the cache hits
+    def gauge(self, name, help, function, label=None, kind="gauge"):
+        self.gauges[name] = (help, label, function, kind)
+
+    # records a duration in the histogram of the label value
+    def observe(self, name, value, seconds):
+        histograms = self.histograms[name][2]
+        histogram = histograms.get(value)
+        if histogram is None:
+            with self.lock:
+                histogram = histograms.setdefault(value, LatencyHistogram())
+        histogram.record(seconds)
+
+    def increment(self, name, value):
+        counts = self.counters[name][2]
+        with self.lock:
+            counts[value] = counts.get(value, 0) + 1
+
+    def render(self):
+        lines = []
+        for name, (help, label, source) in self.histograms.items():
+            name = self.prefix + "_" + name
+            lines += ["# HELP {} {}".format(name, help), "# TYPE {} histogram".format(name)]
+            histograms = source() if callable(source) else dict(source)
+            for value, histogram in sorted(histograms.items()):
+                cumulative, total, seconds = histogram.cumulative()
+                labels = '{}="{}"'.format(label, escapeLabel(value))
+                for bound, count in zip(histogram.buckets, cumulative):
+                    lines.append('{}_bucket{{{},le="{!r}"}} {}'.format(name, labels, bound, count))
+                lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, labels, total))
+                lines.append("{}_sum{{{}}} {!r}".format(name, labels, seconds))
+                lines.append("{}_count{{{}}} {}".format(name, labels, total))
+        for name, (help, label, counts) in self.counters.items():
+            name = self.prefix + "_" + name
+            lines += ["# HELP {} {}".format(name, help), "# TYPE {} counter".format(name)]
+            with self.lock:
+                counts = sorted(counts.items())
+            for value, count in counts:
+                lines.append('{}{{{}="{}"}} {}'.format(name, label, escapeLabel(value), count))
+        for name, (help, label, function, kind) in self.gauges.items():
+            name = self.prefix + "_" + name
+            lines += ["# HELP {} {}".format(name, help), "# TYPE {} {}".format(name, kind)]
+            if label is None:
+                lines.append("{} {}".format(name, function()))
+            else:
+                for value, number in sorted(function().items()):
+                    lines.append('{}{{{}="{}"}} {}'.format(name, label, escapeLabel(value), number))
+        return "\n".join(lines) + "\n"
+
+
+def escapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# answers GET /metrics with the metrics of the server
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # scrapes are not logged
+    def log_message(self, format, *args):
+        pass
+
+
+# serves the metrics on http://host:port/metrics from a daemon thread
+def startMetricsServer(metrics, host, port):
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,178 @@
+# Store-and-forward of the private messages sent to offline users
+import collections
+import logging
+import queue
+import threading
+import time
+import uuid
+
+# messages kept for one recipient, a sender is told when the queue is full
+MAX_MESSAGES_PER_USER = 100
+# seconds a message waits for its recipient before it is dropped
+MESSAGE_TTL = 7 * 24 * 3600
+# characters of a private message at most
+MAX_MESSAGE_LENGTH = 4096
+# seconds between two passes that drop the expired messages
+EXPIRE_INTERVAL = 60
+
+log = logging.getLogger("registry.offline")
+
+
+# Messages waiting for their recipients, held in memory by recipient. Every
+# change is also handed to the writer thread, which persists it through the
+# database in batches and drops the expired messages now and then, so the
+# sessions never wait for the database.
+class OfflineQueue:
+    def __init__(self, database=None, maxPerUser=MAX_MESSAGES_PER_USER, ttl=MESSAGE_TTL):
+        self.maxPerUser = maxPerUser
+        self.ttl = ttl
+        # recipient -> deque of (id, sender, content, created), oldest first
+        self.queues = {}
+        self.count = 0
+        self.lock = threading.Lock()
+        self.writer = None if database is None else OfflineWriter(database, self)
+
+    # loads the messages a previous run persisted, then starts the writer
+    def load(self):
+        if self.writer is None:
+            return
+        now = time.time()
+        expired = []
+        with self.lock:
+            for messageId, recipient, sender, content, created in sorted(
+                    self.writer.database.load_offline_messages(), key=lambda message: message[4]):
+                entries = self.queues.setdefault(recipient, collections.deque())
+                if created + self.ttl < now or len(entries) >= self.maxPerUser:
+                    expired.append(messageId)
+                    continue
+                entries.append((messageId, sender, content, created))
+                self.count += 1
+        if expired:
+            self.writer.delete(expired)
+        self.writer.start()
+
+    # queues a message, returns False if the recipient's queue is full
+    def put(self, recipient, sender, content, now=None):
+        created = time.time() if now is None else now
+        messageId = uuid.uuid4().hex
+        with self.lock:
+            entries = self.queues.setdefault(recipient, collections.deque())
+            self.dropExpired(entries, created)
+            if len(entries) >= self.maxPerUser:
+                return False
+            entries.append((messageId, sender, content, created))
+            self.count += 1
+            if self.writer is not None:
+                self.writer.insert((messageId, recipient, sender, content, created))
+        return True
+
+    # removes and returns the messages of the recipient that have not expired,
+    # as (sender, content, created) oldest first
+    def take(self, recipient, now=None):
+        with self.lock:
+            entries = self.queues.pop(recipient, None)
+            if entries is None:
+                return []
+            self.count -= len(entries)
+            if self.writer is not None:
+                self.writer.delete([entry[0] for entry in entries])
+        deadline = (time.time() if now is None else now) - self.ttl
+        return [(sender, content, created) for messageId, sender, content, created in entries if created >= deadline]
+
+    # drops the expired messages of every recipient, returns how many were dropped
+    def expire(self, now=None):
+        now = time.time() if now is None else now
+        dropped = 0
+        with self.lock:
+            for recipient in list(self.queues):
+                entries = self.queues[recipient]
+                dropped += self.dropExpired(entries, now)
+                if not entries:
+                    del self.queues[recipient]
+        return dropped
+
+    # drops the expired messages at the front of a recipient's queue, under the lock
+    def dropExpired(self, entries, now):
+        expired = []
+        while entries and entries[0][3] + self.ttl < now:
+            expired.append(entries.popleft()[0])
+        self.count -= len(expired)
+        if expired and self.writer is not None:
+            self.writer.delete(expired)
+        return len(expired)
+
+    def __contains__(self, recipient):
+        return recipient in self.queues
+
+    def __len__(self):
+        return self.count
+
+
+# Persists the changes of the offline queue on a background thread, every
+# batch with one insert and one delete round trip, and expires the queue
+# when no change came for EXPIRE_INTERVAL seconds
+class OfflineWriter(threading.Thread):
+    def __init__(self, database, offlineQueue, batchSize=512):
+        threading.Thread.__init__(self, daemon=True)
+        self.database = database
+        self.offlineQueue = offlineQueue
+        self.batchSize = batchSize
+        self.queue = queue.Queue()
+        self.lastExpire = time.monotonic()
+
+    def insert(self, message):
+        self.queue.put((message, None))
+
+    def delete(self, messageIds):
+        self.queue.put((None, messageIds))
+
+    def run(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=EXPIRE_INTERVAL)]
+            except queue.Empty:
+                batch = []
+            while batch and len(batch) < self.batchSize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch:
+                self.write(batch)
+            if time.monotonic() - self.lastExpire >= EXPIRE_INTERVAL:
+                self.lastExpire = time.monotonic()
+                dropped = self.offlineQueue.expire()
+                if dropped:
+                    log.info("Dropped %d expired offline messages", dropped)
+            for _ in batch:
+                self.queue.task_done()
+
+    # a message delivered in the same batch it was queued in is never written
+    def write(self, batch):
+        inserts = {}
+        deletes = []
+        for message, messageIds in batch:
+            if message is not None:
+                inserts[message[0]] = message
+            else:
+                for messageId in messageIds:
+                    if inserts.pop(messageId, None) is None:
+                        deletes.append(messageId)
+        try:
+            self.database.delete_offline_messages(deletes)
+            self.database.store_offline_messages(list(inserts.values()))
+        except Exception as err:
+            log.error("Writing %d offline message changes failed: %s", len(batch), err)
+
+    # waits until every queued change is written
+    def flush(self):
+        self.queue.join()
+
+
+# push of the delivered messages: a header line, then for every message a
+# line "sender created length" followed by its content of that many characters
+def formatPrivateMessages(messages):
+    parts = ["private-messages {}".format(len(messages))]
+    for sender, content, created in messages:
+        parts.append("{} {} {}\n{}".format(sender, int(created), len(content), content))
+    return "\n".join(parts)
@@ -0,0 +1,73 @@
+# Password hashing and verification on a bounded worker pool
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import bcrypt
+
+# default bcrypt cost factor, every step doubles the work of a hash
+DEFAULT_ROUNDS = 12
+
+
+class ServerBusy(Exception):
+    pass
+
+
+def hashPassword(password, rounds):
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds))
+
+
+def checkPassword(password, hashed):
+    return bcrypt.checkpw(password.encode("utf-8"), hashed)
+
+
+# Runs bcrypt work on a pool of threads (bcrypt releases the GIL) or processes.
+# At most maxPending jobs are queued or running, a job beyond that is refused
+# with ServerBusy straight away, so a login storm turns into busy replies
+# instead of an ever growing queue.
+class PasswordHasher:
+    def __init__(self, workers=4, maxPending=64, rounds=DEFAULT_ROUNDS, useProcesses=False):
+        self.workers = workers
+        self.maxPending = maxPending
+        self.rounds = rounds
+        if useProcesses:
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.slots = threading.BoundedSemaphore(maxPending)
+        # "hash" and "check" -> LatencyHistogram, set to record the time of
+        # every hash and check, waiting for a free worker included
+        self.histograms = None
+
+    # submits a job, raises ServerBusy if the queue is full
+    def submit(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            raise ServerBusy()
+        try:
+            future = self.executor.submit(function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda done: self.slots.release())
+        return future
+
+    # returns the bcrypt hash of the password
+    def hash(self, password):
+        return self.run("hash", hashPassword, password, self.rounds)
+
+    # checks the password against its bcrypt hash
+    def check(self, password, hashed):
+        return self.run("check", checkPassword, password, hashed)
+
+    # runs a job and waits for its result
+    def run(self, operation, function, *args):
+        if self.histograms is None:
+            return self.submit(function, *args).result()
+        start = time.perf_counter()
+        future = self.submit(function, *args)
+        try:
+            return future.result()
+        finally:
+            self.histograms[operation].record(time.perf_counter() - start)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -1,124 +1,1009 @@
 from socket import *
+import asyncio
+import collections
 import threading
-import select
+from concurrent.futures import ThreadPoolExecutor
+import time
+import selectors
 import maskpass
+import protocol
+
+# bytes queued for a peer before it is disconnected as a slow consumer
+HIGH_WATER_MARK = 1024 * 1024
+# seconds a leaving peer waits for its queued messages to go out
+DRAIN_TIMEOUT = 2
+# entries asked for in one page of the users and chatroom lists
+LIST_PAGE_SIZE = 100
+REGISTRY_PORT = 16600
+REGISTRY_UDP_PORT = 16500
+# seconds between two hello messages of a logged in peer
+HELLO_INTERVAL = 1
+# messages of the list subscriptions and private messages, pushed by the registry between its answers
+PUSHED_MESSAGES = ("users-delta", "rooms-delta", "private-messages")
+# messages of the room's history shown when joining through a relay that keeps one
+HISTORY_ON_JOIN = 20
+# connections opened at once when joining a chatroom, and seconds one may take
+CONNECT_PARALLELISM = 32
+CONNECT_TIMEOUT = 3
+# connections kept open between chatrooms, the oldest are closed beyond that
+IDLE_CONNECTIONS = 64
 
 
 class PeerServer(threading.Thread):
-    # Peer server initialization
-    def __init__(self, username, peerServerPort):
-        threading.Thread.__init__(self)
+    # Peer server initialization, it listens on the address of this host unless host is given
+    def __init__(self, username, peerServerPort, host=None):
+        threading.Thread.__init__(self, daemon=True)
         self.username = username
         self.peerServerSocket = socket(AF_INET, SOCK_STREAM)
-        self.peerServerHost = gethostbyname(gethostname())
+        self.peerServerHost = gethostbyname(gethostname()) if host is None else host
         self.peerServerPort = peerServerPort
         self.peerServerSocket.bind((self.peerServerHost, self.peerServerPort))
         self.peerServerSocket.listen()
-        self.inputs = [self.peerServerSocket]
         self.connectedPeers = []
+        # codec of every connected peer, framed or legacy text
+        self.codecs = {}
+        # bytes waiting to be sent to every connected peer, flushed when its socket is writable
+        self.outbound = {}
+        self.outboundLock = threading.Condition()
+        # connections opened by this peer by "host,port" of the member, and the
+        # parked ones, kept open after a chatroom was left in case the next room
+        # has the same members, oldest first; a parked peer gets no chat messages
+        self.addresses = {}
+        self.idlePeers = collections.OrderedDict()
+        # reused connections whose member has not welcomed the join yet, a
+        # leave of the member's earlier room may still be on its way on them
+        self.joining = set()
+        # connections to a relay, a leave on them is that of another member of the room
+        self.relays = set()
+        # wakes the peer server thread up when another thread changes what it waits for
+        self.wakeupReader, self.wakeupWriter = socketpair()
+        self.wakeupReader.setblocking(False)
+        self.wakeupWriter.setblocking(False)
+        # epoll on linux, every socket is registered with its handler
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.peerServerSocket, selectors.EVENT_READ, self.acceptPeer)
+        self.selector.register(self.wakeupReader, selectors.EVENT_READ, self.readWakeup)
+        # called with the username and the content of every chat message instead of printing it
+        self.onMessage = None
+        # offset of the next message of a relay room in its history, known once
+        # the relay sent the history or the offset after a message of this
+        # peer, so a peer that rejoins can ask for what it missed
+        self.roomOffset = None
 
-    # main method of the peer server thread
+    # main method of the peer server thread, it sleeps until one of the
+    # registered sockets is ready and calls the handler registered with it
     def run(self):
         while self.username != None:
-            # monitors for the incoming connections
-            readable, writable, exceptional = select.select(self.inputs + self.connectedPeers, [], [], 1)
-            for sock in readable:
-                # if the socket that is receiving the connection is the tcp socket of the peer's server, enters here
-                if sock is self.peerServerSocket:
-                    # accepts the connection, and adds its connection socket to the connected peers list
-                    connectedPeerSocket, addr = sock.accept()
-                    self.connectedPeers.append(connectedPeerSocket)
-
-                # if the socket that receives the data is used to communicate with a connected peer, then enters here
-                else:
-                    message = None
-                    try:
-                        message = sock.recv(1024).decode().split("\n")
-                    except:
-                        pass
-                    # print("DEBUG: " + ', '.join(message))
-                    if message is None:
-                        sock.close()
-                        self.connectedPeers.remove(sock)
-                    elif len(message) == 0:
-                        sock.close()
-                        self.connectedPeers.remove(sock)
-                    elif message[0] == "chatroom-join":
-                        print(message[1] + " joined the chatroom.")
-                        sock.send("welcome".encode())
-                    elif message[0] == "chatroom-leave":
-                        print(message[1] + " left the chatroom.")
-                        sock.close()
-                        self.connectedPeers.remove(sock)
-                    elif message[0] == "chat-message":
-                        username = message[1]
-                        content = "\n".join(message[2:])
-                        print(username + " -> " + content)
-                    elif message[0] == "welcome":
-                        print("WELCOME!!")
+            for key, events in self.selector.select():
+                key.data(key.fileobj, events)
+
+    # stops the peer server thread and closes its connections
+    def stop(self):
+        self.username = None
+        self.wakeup()
+        self.selector.unregister(self.peerServerSocket)
+        self.peerServerSocket.close()
+        for sock in list(self.connectedPeers):
+            self.removePeer(sock)
+
+    # accepts a connection, and adds its connection socket to the connected peers
+    def acceptPeer(self, sock, events):
+        connectedPeerSocket, addr = sock.accept()
+        # the protocol of the connected peer is negotiated from its first bytes
+        self.addPeer(connectedPeerSocket, protocol.MessageCodec())
+
+    def readWakeup(self, sock, events):
+        try:
+            sock.recv(4096)
+        except BlockingIOError:
+            pass
+
+    # handles a connected peer whose socket is readable or writable
+    def handlePeer(self, sock, events):
+        if events & selectors.EVENT_WRITE:
+            self.flush(sock)
+        if not events & selectors.EVENT_READ:
+            return
+        messages = None
+        try:
+            data = sock.recv(protocol.RECV_SIZE)
+            if data:
+                codec = self.codecFor(sock)
+                messages = codec.feed(data)
+                reply = codec.takeHandshakeReply()
+                if reply:
+                    self.queue(sock, reply)
+        except BlockingIOError:
+            return
+        except (OSError, protocol.ProtocolError):
+            pass
+        if messages is None:
+            self.removePeer(sock)
+            return
+        # a single read may hold several messages, binary chat messages come decoded
+        for message in messages:
+            if not self.handleMessage(sock, protocol.messageFields(message)):
+                break
+
+    # processes a message of a connected peer, returns False if the peer left
+    def handleMessage(self, sock, message):
+        # print("DEBUG: " + ', '.join(message))
+        if len(message) == 0:
+            self.removePeer(sock)
+            return False
+        elif message[0] == "chatroom-join":
+            print(message[1] + " joined the chatroom.")
+            with self.outboundLock:
+                self.idlePeers.pop(sock, None)
+                # the "host,port" of the member's peer server, so this peer
+                # reuses the connection if it joins a room with the member next
+                if len(message) > 2 and sock in self.outbound:
+                    self.addresses[message[2]] = sock
+            self.sendMessage(sock, "welcome")
+        elif message[0] == "chatroom-leave":
+            print(message[1] + " left the chatroom.")
+            # a member that parks the connection may join another room with us;
+            # the member sent the leave before it got the join of this peer
+            if len(message) > 2 and message[2] == "park":
+                with self.outboundLock:
+                    if sock not in self.joining:
+                        self.park(sock)
+                return True
+            if sock in self.relays:
+                return True
+            self.removePeer(sock)
+            return False
+        elif message[0] == "chat-message":
+            username = message[1]
+            content = "\n".join(message[2:])
+            if self.roomOffset is not None:
+                self.roomOffset += 1
+            if self.onMessage is not None:
+                self.onMessage(username, content)
+            else:
+                print(username + " -> " + content)
+        elif message[0] == "welcome":
+            with self.outboundLock:
+                self.joining.discard(sock)
+            print("WELCOME!!")
+        elif message[0] in ("relay-history-end", "relay-offset") and len(message) > 1:
+            self.roomOffset = int(message[1]) if message[1].isdigit() else None
+        return True
+
+    # returns the codec of a connected peer
+    def codecFor(self, sock):
+        codec = self.codecs.get(sock)
+        if codec is None:
+            codec = protocol.MessageCodec()
+            self.codecs[sock] = codec
+        return codec
+
+    # adds a peer connected to or by this peer, its socket is made
+    # non-blocking so a slow peer never holds up the others; address is the
+    # "host,port" of a member this peer connected to, its connection is reused
+    def addPeer(self, sock, codec, address=None):
+        sock.setblocking(False)
+        with self.outboundLock:
+            self.codecs[sock] = codec
+            self.outbound[sock] = bytearray()
+            self.connectedPeers.append(sock)
+            if address is not None:
+                self.addresses[address] = sock
+            self.selector.register(sock, selectors.EVENT_READ, self.handlePeer)
+
+    # the peers in the chatroom, the parked connections left out
+    def members(self):
+        with self.outboundLock:
+            return [sock for sock in self.connectedPeers if sock not in self.idlePeers]
+
+    # keeps the connection of a peer open out of the chatroom, the oldest
+    # parked connections are closed beyond IDLE_CONNECTIONS
+    def park(self, sock):
+        with self.outboundLock:
+            if sock not in self.outbound:
+                return
+            self.idlePeers[sock] = None
+            while len(self.idlePeers) > IDLE_CONNECTIONS:
+                self.removePeer(next(iter(self.idlePeers)))
+
+    # returns the open connection to the member at address taken out of the
+    # parked ones, or None if there is none or its member closed it
+    def takeConnection(self, address):
+        with self.outboundLock:
+            sock = self.addresses.get(address)
+            if sock is None:
+                return None
+            if not isAlive(sock):
+                self.removePeer(sock)
+                return None
+            self.idlePeers.pop(sock, None)
+            self.joining.add(sock)
+            return sock
+
+    # "host,port" of the peer server, sent with chatroom-join
+    def address(self):
+        return "{},{}".format(self.peerServerHost, self.peerServerPort)
+
+    # queues a message for a connected peer in the protocol of its connection
+    def sendMessage(self, sock, message):
+        self.queue(sock, self.codecFor(sock).encode([message]))
+
+    # queues bytes for a peer and sends what the socket takes right away,
+    # the rest is sent by the peer server thread once the socket is writable
+    def queue(self, sock, data):
+        with self.outboundLock:
+            buffer = self.outbound.get(sock)
+            if buffer is None:
+                return
+            wasEmpty = not buffer
+            buffer += data
+            if len(buffer) > HIGH_WATER_MARK:
+                print("Disconnecting a peer that does not read its messages.")
+                self.removePeer(sock)
+                return
+        if wasEmpty:
+            self.flush(sock)
+
+    # sends as much of the queued bytes of a peer as its socket takes without
+    # blocking, the socket is watched for writability only while bytes are left
+    def flush(self, sock):
+        with self.outboundLock:
+            buffer = self.outbound.get(sock)
+            if not buffer:
+                return
+            try:
+                sent = sock.send(buffer)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self.removePeer(sock)
+                return
+            del buffer[:sent]
+            if buffer:
+                self.watch(sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+            else:
+                self.watch(sock, selectors.EVENT_READ)
+                self.outboundLock.notify_all()
+
+    # changes the events a peer socket is watched for
+    def watch(self, sock, events):
+        if self.selector.get_key(sock).events != events:
+            self.selector.modify(sock, events, self.handlePeer)
+            # the peer server thread may be waiting on the old events
+            if threading.current_thread() is not self:
+                self.wakeup()
+
+    # waits until the queued messages of every peer are sent, or the timeout passes
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        with self.outboundLock:
+            return self.outboundLock.wait_for(lambda: not any(self.outbound.values()), timeout)
+
+    def wakeup(self):
+        try:
+            self.wakeupWriter.send(b"\0")
+        except BlockingIOError:
+            pass
+
+    # closes the connection of a peer and forgets it
+    def removePeer(self, sock):
+        with self.outboundLock:
+            if sock in self.connectedPeers:
+                self.selector.unregister(sock)
+                self.connectedPeers.remove(sock)
+            sock.close()
+            self.codecs.pop(sock, None)
+            self.outbound.pop(sock, None)
+            self.idlePeers.pop(sock, None)
+            self.joining.discard(sock)
+            self.relays.discard(sock)
+            for address, connection in list(self.addresses.items()):
+                if connection is sock:
+                    del self.addresses[address]
+            self.outboundLock.notify_all()
+
+
+# whether the other end of a non-blocking connection has not closed it
+def isAlive(sock):
+    try:
+        return sock.recv(1, MSG_PEEK) != b""
+    except (BlockingIOError, InterruptedError):
+        return True
+    except OSError:
+        return False
 
 
 class PeerClient(threading.Thread):
-    def __init__(self, username, chatroom, peerServer, peersToConnect=None):
+    # relay is the "host,port" of the registry's relay, a peer joining a room
+    # through it holds that single connection instead of one per member;
+    # history, ("last", count) or ("since", offset), asks the relay for the
+    # earlier messages of the room. The "host,port" of the members, or of the
+    # relay, that could not be reached are left in unreachable, the room goes on without them
+    def __init__(self, username, chatroom, peerServer, peersToConnect=None, relay=None, history=None):
         threading.Thread.__init__(self)
         self.username = username
         self.chatroom = chatroom
         self.peerServer = peerServer
-        if peersToConnect != None:
-            for peer in peersToConnect:
-                peer = peer.split(",")
-                peerHost = peer[0]
-                peerPort = int(peer[1])
-                sock = socket(AF_INET, SOCK_STREAM)
-                sock.connect((peerHost, peerPort))
-                message = "chatroom-join\n{}".format(self.username)
-                sock.send(message.encode())
-                self.peerServer.connectedPeers.append(sock)
-
-    # main method of the peer client thread
+        self.relaySocket = None
+        self.unreachable = []
+        # offsets are those of the room joined here
+        self.peerServer.roomOffset = None
+        if relay != None:
+            self.connectRelay(relay, history)
+        elif peersToConnect != None:
+            self.connectMembers(peersToConnect)
+
+    # connects to the relay at "host,port" and joins the room through it, a
+    # relay that cannot be reached within CONNECT_TIMEOUT is left in unreachable
+    def connectRelay(self, relay, history):
+        relayHost, relayPort = relay.split(",")
+        try:
+            sock = create_connection((relayHost, int(relayPort)), CONNECT_TIMEOUT)
+        except (OSError, ValueError):
+            self.unreachable.append(relay)
+            return
+        try:
+            connection = protocol.MessageSocket.connect(sock)
+            messages = ["relay-join\n{}\n{}".format(self.chatroom, self.username)]
+            if history is not None:
+                messages.append("relay-history\n{}\n{}".format(*history))
+            connection.sendMany(messages)
+        except OSError:
+            sock.close()
+            self.unreachable.append(relay)
+            return
+        self.peerServer.relays.add(sock)
+        self.peerServer.addPeer(sock, connection.codec)
+        self.relaySocket = sock
+
+    # connects to the members of the chatroom, CONNECT_PARALLELISM at a time
+    # so a big room costs a few round trips instead of one per member; the
+    # connection parked when a member was left in an earlier room is reused
+    def connectMembers(self, addresses):
+        pending = []
+        for address in addresses:
+            sock = self.peerServer.takeConnection(address)
+            if sock is not None:
+                self.peerServer.sendMessage(sock, self.joinMessage())
+            # the connection failed on the join, the member is connected to again
+            if sock is None or sock not in self.peerServer.connectedPeers:
+                pending.append(address)
+        if not pending:
+            return
+        with ThreadPoolExecutor(max_workers=min(CONNECT_PARALLELISM, len(pending))) as executor:
+            for address, connected in zip(pending, executor.map(self.connectMember, pending)):
+                if not connected:
+                    self.unreachable.append(address)
+
+    # connects to the member at "host,port" and joins it, returns False if
+    # it cannot be reached within CONNECT_TIMEOUT
+    def connectMember(self, address):
+        host, port = address.split(",")
+        try:
+            sock = create_connection((host, int(port)), CONNECT_TIMEOUT)
+        except (OSError, ValueError):
+            return False
+        try:
+            connection = protocol.MessageSocket.connect(sock)
+            connection.send(self.joinMessage())
+        except OSError:
+            sock.close()
+            return False
+        self.peerServer.addPeer(sock, connection.codec, address)
+        return True
+
+    def joinMessage(self):
+        return "chatroom-join\n{}\n{}".format(self.username, self.peerServer.address())
+
+    # main method of the peer client thread, reads the messages to send until ":quit"
     def run(self):
         print('You have joined Chatroom. \nStart typing to send a message. Send ":quit" to leave the chatroom.')
         while self.chatroom != None:
             content = input()
 
             if content == ":quit":
-                message = "chatroom-leave\n" + self.username
+                self.leave()
             else:
-                message = "chat-message\n{}\n{}".format(self.username, content)
+                self.send(content)
 
-            for sock in self.peerServer.connectedPeers:
-                sock.send(message.encode())
+    # sends a chat message to the members of the chatroom, it is encoded once
+    # for all the members whose connection takes the same encoding
+    def send(self, content):
+        self.broadcast(protocol.ChatMessage(self.username, content))
 
-            if content == ":quit":
-                self.chatroom = None
-                for sock in self.peerServer.connectedPeers:
-                    sock.close()
+    # tells the members the peer left and waits for the queued messages to go
+    # out; the connections to the members are parked for the next chatroom,
+    # the one to the relay is closed
+    def leave(self):
+        members = self.peerServer.members()
+        for sock in members:
+            if sock is self.relaySocket:
+                self.peerServer.sendMessage(sock, "chatroom-leave\n" + self.username)
+            else:
+                self.peerServer.sendMessage(sock, "chatroom-leave\n{}\npark".format(self.username))
+        self.chatroom = None
+        self.peerServer.drain()
+        for sock in members:
+            if sock is self.relaySocket:
+                self.peerServer.removePeer(sock)
+            else:
+                self.peerServer.park(sock)
 
+    def broadcast(self, message):
+        # messages are only queued here, a stalled peer does not delay the others
+        for sock in self.peerServer.members():
+            self.peerServer.sendMessage(sock, message)
 
-class peerMain:
-    # peer initializations
-    def __init__(self, username=None, peerServerPort=None):
-        # registry host, port
-        self.registryName = input("Enter IP address of registry: ")
-        self.registryPort = 16600
 
-        # connection initialization
-        self.tcpClientSocket = socket(AF_INET, SOCK_STREAM)
-        self.tcpClientSocket.connect((self.registryName, self.registryPort))
-        self.udpClientSocket = socket(AF_INET, SOCK_DGRAM)
-        self.registryUDPPort = 16500
+# Headless client of the registry, for bots, load tests and the interactive
+# peer below. Every method sends one command and returns its answer; once
+# logged in, a timer sends the hello messages and, unless serve is False, a
+# peer server takes the connections of the chatroom members.
+class RegistryClient:
+    def __init__(self, host, port=REGISTRY_PORT, portUDP=REGISTRY_UDP_PORT, peerHost=None):
+        self.host = host
+        self.port = port
+        self.portUDP = portUDP
+        # address the peer server binds, the address of this host by default
+        self.peerHost = peerHost
+        self.registry = None
+        self.udpClientSocket = None
+        self.username = None
+        self.peerServer = None
+        self.peerClient = None
+        self.chatroom = None
+        self.timer = None
+        # offset of the next message of every relay room this peer left, a
+        # rejoin asks for the messages since then
+        self.roomOffsets = {}
+        # token that resumes the session, and the port of the peer server it was logged in with
+        self.token = None
+        self.peerPort = None
+        # users-delta, rooms-delta and private-messages received while waiting for an answer
+        self.pushed = collections.deque()
 
-        # peer info
-        self.username = username
-        self.peerServerPort = peerServerPort
+    # connects to the registry and negotiates the framed protocol, a logout
+    # ends the session so the client connects again before the next login
+    def connect(self):
+        sock = socket(AF_INET, SOCK_STREAM)
+        sock.connect((self.host, self.port))
+        self.registry = protocol.MessageSocket.connect(sock)
+        if self.udpClientSocket is None:
+            self.udpClientSocket = socket(AF_INET, SOCK_DGRAM)
+        return self
+
+    # sends a command and returns its answer
+    def request(self, message):
+        self.registry.send(message)
+        while True:
+            response = self.registry.receive()
+            if response is None:
+                raise ConnectionError("registry closed the connection")
+            if not response.startswith(PUSHED_MESSAGES):
+                return response
+            self.pushed.append(response)
+
+    # keeps the pushed messages sent right after the last answer, such as the
+    # private messages that follow a login-success, in pushed
+    def collectPushes(self):
+        waiting = self.registry.receiveWaiting()
+        self.pushed.extend([message for message in waiting if message.startswith(PUSHED_MESSAGES)])
+        self.registry.received = [message for message in waiting if not message.startswith(PUSHED_MESSAGES)]
+
+    # creates an account, answers join-success, join-exist or server-busy
+    def register(self, username, password):
+        return self.request("JOIN {} {}".format(username, password))
+
+    # answers login-success, login-account-not-exist, login-wrong-password,
+    # login-online or server-busy; port is where the peer server listens
+    def login(self, username, password, port, serve=True):
+        response, self.token = parseLogin(self.request("LOGIN {} {} {} token".format(username, password, port)))
+        if response == "login-success":
+            self.username = username
+            self.peerPort = port
+            self.collectPushes()
+            if serve:
+                self.peerServer = PeerServer(username, port, self.peerHost)
+                self.peerServer.start()
+            self.sendHelloMessage()
+        return response
+
+    # takes the session up again on a new connection, after the registry
+    # logged this peer out for missing hellos or the connection dropped; no
+    # password is checked, and the peer server and the chatroom connections
+    # are kept. Answers resume-success, or resume-invalid once the token
+    # expired or was used, the client is then logged out and connected again
+    def resume(self):
+        if self.registry is not None:
+            self.registry.close()
+        self.connect()
+        if self.token is None:
+            self.endSession()
+            return "resume-invalid"
+        response, self.token, room = parseResume(self.request(resumeCommand(self.username, self.token, self.peerPort)))
+        if response != "resume-success":
+            self.endSession()
+            return response
+        self.collectPushes()
+        # the relay may have gone with the registry, the room is joined again
+        # and the messages sent meanwhile fetched from the relay
+        if self.chatroom is not None and relayLost(self.peerClient):
+            self.joinRoom(self.chatroom)
+        # a sharded registry leaves joining the chatroom again to the peer
+        elif self.chatroom is not None and room != self.chatroom:
+            self.request("CHATROOM-JOIN {}".format(self.chatroom))
+        return response
+
+    def logout(self):
+        if self.peerClient is not None:
+            self.peerClient.leave()
+            self.peerClient = None
+        self.registry.send(logoutCommand(self.username))
+        self.endSession()
+        self.registry.close()
+
+    # forgets the session on this side, its chatroom connections are closed
+    def endSession(self):
+        if self.peerClient is not None:
+            self.peerClient.leave()
+            self.peerClient = None
+        self.chatroom = None
+        self.username = None
+        self.token = None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.peerServer is not None:
+            self.peerServer.stop()
+            self.peerServer = None
+
+    # returns the answer and the (host, port) of the user, None if it is not online
+    def search(self, username):
+        return parseSearch(self.request("SEARCH " + username))
+
+    # returns the online users, asked for page by page
+    def users(self):
+        return list(self.listPages("USERS-LIST", " "))
+
+    # returns (room, member count) of every chatroom, asked for page by page
+    def chatrooms(self):
+        return [parseRoomEntry(entry) for entry in self.listPages("CHATROOM-LIST", "\n")]
+
+    def listPages(self, command, separator):
+        cursor = None
+        while True:
+            entries, cursor = parseListPage(self.request(listCommand(command, cursor)), separator)
+            yield from entries
+            if cursor is None:
+                return
+
+    # answers chatroom-creation-success or chatroom-exists
+    def createChatroom(self, name):
+        return self.request("CHATROOM-CREATE\n{}".format(name))
+
+    # returns the answer and the name of the private chatroom with the user
+    def privateChatroom(self, username):
+        return parsePrivateChatroom(self.request("PRIVATE-CHATROOM\n{}".format(username)))
+
+    # sends a private message, queued by the registry if the user is offline; answers
+    # private-message-delivered, private-message-queued, private-message-queue-full,
+    # private-message-user-not-found or private-message-too-long
+    def privateMessage(self, username, content):
+        return self.request("PRIVATE-MESSAGE {} {}".format(username, content))
+
+    # returns the private messages received so far as (sender, content, time),
+    # the ones queued while this user was offline come after its login
+    def privateMessages(self):
+        return takePrivateMessages(self.pushed)
+
+    # joins the chatroom and connects to its members, or to the relay of the
+    # registry; answers chatroom-join-success, chatroom-join-relay or chatroom-not-found;
+    # history is passed to PeerClient, a mesh room has none, and defaults to
+    # the messages since this peer was last in the room
+    def joinRoom(self, name, history=None):
+        response = self.request("CHATROOM-JOIN {}".format(name)).split("\n")
+        if response[0] in ("chatroom-join-success", "chatroom-join-relay"):
+            self.leavePeers()
+            self.chatroom = name
+            if self.peerServer is not None:
+                self.peerClient = PeerClient(self.username, name, self.peerServer, *roomConnections(response),
+                                             history=history or roomHistory(self.roomOffsets, name))
+        return response[0]
+
+    # leaves the members or the relay of the chatroom, unless the peer client
+    # left already, keeping the offset of the room
+    def leavePeers(self):
+        if self.peerClient is not None:
+            if self.peerClient.chatroom is not None:
+                self.peerClient.leave()
+            self.peerClient = None
+            if self.peerServer.roomOffset is not None:
+                self.roomOffsets[self.chatroom] = self.peerServer.roomOffset
+
+    # sends a chat message to the members of the chatroom
+    def send(self, content):
+        self.peerClient.send(content)
+
+    # leaves the chatroom, its members are told before they are disconnected
+    def leaveRoom(self):
+        self.leavePeers()
+        self.chatroom = None
+        self.registry.send("chatroom-leave-request")
+
+    # answers subscribe-success, the changes of the list then come as pushed
+    # messages, collected in pushed while the client waits for answers
+    def subscribe(self, listName):
+        return self.request("SUBSCRIBE " + listName)
+
+    def sendHelloMessage(self):
+        message = "HELLO {}".format(self.username)
+        try:
+            self.udpClientSocket.sendto(message.encode(), (self.host, self.portUDP))
+        except OSError:
+            # the network is down for a moment, the next hello tries again
+            pass
+        self.timer = threading.Timer(HELLO_INTERVAL, self.sendHelloMessage)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.peerServer is not None:
+            self.peerServer.stop()
+        if self.registry is not None:
+            self.registry.close()
+        if self.udpClientSocket is not None:
+            self.udpClientSocket.close()
+
+
+# The registry client for asyncio code, with the methods of RegistryClient as
+# coroutines. The peer server and the chatroom connections are the threaded
+# ones; their blocking parts run in the default executor.
+class AsyncRegistryClient:
+    def __init__(self, host, port=REGISTRY_PORT, portUDP=REGISTRY_UDP_PORT, peerHost=None):
+        self.host = host
+        self.port = port
+        self.portUDP = portUDP
+        self.peerHost = peerHost
+        self.reader = None
+        self.writer = None
+        self.codec = None
+        self.received = collections.deque()
+        self.udpClientSocket = None
+        self.username = None
         self.peerServer = None
         self.peerClient = None
+        self.chatroom = None
+        self.helloTask = None
+        self.roomOffsets = {}
+        self.token = None
+        self.peerPort = None
+        self.pushed = collections.deque()
 
-        # timer for hello
-        self.timer = None
+    async def connect(self, timeout=2):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(protocol.handshake())
+        try:
+            reply = await asyncio.wait_for(self.reader.readexactly(protocol.HANDSHAKE_SIZE), timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            reply = b""
+        if reply.startswith(protocol.HANDSHAKE_MAGIC):
+            self.codec = protocol.MessageCodec(protocol.FRAMED, reply[len(protocol.HANDSHAKE_MAGIC)])
+        else:
+            # a registry that does not answer the handshake speaks plain text
+            self.codec = protocol.MessageCodec(protocol.LEGACY)
+        self.received.clear()
+        return self
+
+    async def request(self, message):
+        self.writer.write(self.codec.encode([message]))
+        while True:
+            while not self.received:
+                data = await self.reader.read(protocol.RECV_SIZE)
+                if not data:
+                    raise ConnectionError("registry closed the connection")
+                self.received.extend(self.codec.feed(data))
+            response = self.received.popleft()
+            if not response.startswith(PUSHED_MESSAGES):
+                return response
+            self.pushed.append(response)
+
+    # keeps the pushed messages received with the last answer in pushed
+    def collectPushes(self):
+        pushes = [message for message in self.received if message.startswith(PUSHED_MESSAGES)]
+        for message in pushes:
+            self.received.remove(message)
+        self.pushed.extend(pushes)
+
+    # sends a message the registry does not answer
+    def post(self, message):
+        self.writer.write(self.codec.encode([message]))
+
+    async def register(self, username, password):
+        return await self.request("JOIN {} {}".format(username, password))
+
+    # hello is False when the caller sends the hello messages itself
+    async def login(self, username, password, port, serve=True, hello=True):
+        response, self.token = parseLogin(await self.request("LOGIN {} {} {} token".format(username, password, port)))
+        if response == "login-success":
+            self.username = username
+            self.peerPort = port
+            self.collectPushes()
+            if serve:
+                self.peerServer = PeerServer(username, port, self.peerHost)
+                self.peerServer.start()
+            if hello:
+                self.helloTask = asyncio.create_task(self.sendHelloMessages())
+        return response
 
-        # run the main
-        self.main()
+    # the hello messages go on while the session is resumed
+    async def resume(self):
+        if self.writer is not None:
+            self.writer.close()
+        await self.connect()
+        if self.token is None:
+            await self.endSession()
+            return "resume-invalid"
+        response, self.token, room = parseResume(await self.request(resumeCommand(self.username, self.token, self.peerPort)))
+        if response != "resume-success":
+            await self.endSession()
+            return response
+        self.collectPushes()
+        if self.chatroom is not None and relayLost(self.peerClient):
+            await self.joinRoom(self.chatroom)
+        elif self.chatroom is not None and room != self.chatroom:
+            await self.request("CHATROOM-JOIN {}".format(self.chatroom))
+        return response
+
+    async def logout(self):
+        if self.peerClient is not None:
+            await asyncio.to_thread(self.peerClient.leave)
+            self.peerClient = None
+        self.chatroom = None
+        self.post(logoutCommand(self.username))
+        self.username = None
+        self.token = None
+        self.close()
+
+    # forgets the session on this side and stays connected for a new login
+    async def endSession(self):
+        if self.peerClient is not None:
+            await asyncio.to_thread(self.peerClient.leave)
+            self.peerClient = None
+        self.chatroom = None
+        self.username = None
+        self.token = None
+        if self.helloTask is not None:
+            self.helloTask.cancel()
+            self.helloTask = None
+        if self.peerServer is not None:
+            self.peerServer.stop()
+            self.peerServer = None
+
+    async def search(self, username):
+        return parseSearch(await self.request("SEARCH " + username))
+
+    async def users(self):
+        return await self.listPages("USERS-LIST", " ")
+
+    async def chatrooms(self):
+        return [parseRoomEntry(entry) for entry in await self.listPages("CHATROOM-LIST", "\n")]
+
+    async def listPages(self, command, separator):
+        entries = []
+        cursor = None
+        while True:
+            page, cursor = parseListPage(await self.request(listCommand(command, cursor)), separator)
+            entries += page
+            if cursor is None:
+                return entries
+
+    async def createChatroom(self, name):
+        return await self.request("CHATROOM-CREATE\n{}".format(name))
+
+    async def privateChatroom(self, username):
+        return parsePrivateChatroom(await self.request("PRIVATE-CHATROOM\n{}".format(username)))
+
+    async def privateMessage(self, username, content):
+        return await self.request("PRIVATE-MESSAGE {} {}".format(username, content))
+
+    def privateMessages(self):
+        return takePrivateMessages(self.pushed)
+
+    async def joinRoom(self, name, history=None):
+        response = (await self.request("CHATROOM-JOIN {}".format(name))).split("\n")
+        if response[0] in ("chatroom-join-success", "chatroom-join-relay"):
+            await self.leavePeers()
+            self.chatroom = name
+            if self.peerServer is not None:
+                self.peerClient = await asyncio.to_thread(
+                    PeerClient, self.username, name, self.peerServer, *roomConnections(response),
+                    history or roomHistory(self.roomOffsets, name)
+                )
+        return response[0]
+
+    async def leavePeers(self):
+        if self.peerClient is not None:
+            if self.peerClient.chatroom is not None:
+                await asyncio.to_thread(self.peerClient.leave)
+            self.peerClient = None
+            if self.peerServer.roomOffset is not None:
+                self.roomOffsets[self.chatroom] = self.peerServer.roomOffset
+
+    # messages to the members are only queued, so this does not block
+    def send(self, content):
+        self.peerClient.send(content)
+
+    async def leaveRoom(self):
+        await self.leavePeers()
+        self.chatroom = None
+        self.post("chatroom-leave-request")
+
+    async def subscribe(self, listName):
+        return await self.request("SUBSCRIBE " + listName)
+
+    async def sendHelloMessages(self):
+        self.udpClientSocket = socket(AF_INET, SOCK_DGRAM)
+        self.udpClientSocket.setblocking(False)
+        message = "HELLO {}".format(self.username).encode()
+        while True:
+            try:
+                self.udpClientSocket.sendto(message, (self.host, self.portUDP))
+            except OSError:
+                # a full buffer or the network down for a moment, the next hello tries again
+                pass
+            await asyncio.sleep(HELLO_INTERVAL)
+
+    def close(self):
+        if self.helloTask is not None:
+            self.helloTask.cancel()
+            self.helloTask = None
+        if self.udpClientSocket is not None:
+            self.udpClientSocket.close()
+            self.udpClientSocket = None
+        if self.peerServer is not None:
+            self.peerServer.stop()
+            self.peerServer = None
+        if self.writer is not None:
+            self.writer.close()
+
+
+# LOGOUT of the user, a LOGOUT without a user logs out the session's user
+def logoutCommand(username):
+    return "LOGOUT" if username is None else "LOGOUT " + username
+
+
+# "login-success token" -> ("login-success", "token"), a registry without
+# session tokens answers login-success alone
+def parseLogin(response):
+    kind, _, token = response.partition(" ")
+    return kind, token or None
+
+
+def resumeCommand(username, token, port):
+    return "RESUME {} {} {}".format(username, token, port)
+
+
+# "resume-success token\nroom" -> ("resume-success", "token", "room"), the
+# room line is there if the registry put the peer back in its chatroom
+def parseResume(response):
+    first, _, room = response.partition("\n")
+    kind, _, token = first.partition(" ")
+    return kind, token or None, room or None
+
+
+# command asking for the page of a list after the cursor
+def listCommand(command, cursor):
+    message = "{} limit={}".format(command, LIST_PAGE_SIZE)
+    if cursor is not None:
+        message += " after=" + cursor
+    return message
+
+
+# returns the entries of a list page and the cursor of the next page, None
+# after the last page; a registry without pages sends the whole list at once
+def parseListPage(response, separator):
+    kind, rest = (response.split(None, 1) + [""])[:2]
+    if kind in ("users-list-success", "chatroom-list-success"):
+        return [entry for entry in rest.split(separator) if entry], None
+    if not kind.endswith("-page"):
+        return [], None
+    cursor, _, entries = rest.partition(separator)
+    return [entry for entry in entries.split(separator) if entry], None if cursor == "-" else cursor
+
+
+# "room : 3" -> ("room", 3)
+def parseRoomEntry(entry):
+    room, _, count = entry.rpartition(" : ")
+    return room, int(count)
+
+
+# returns the answer of a search and the (host, port) of an online user
+def parseSearch(response):
+    response = response.split()
+    if response[0] == "search-success":
+        host, port = response[1].split(":")
+        return response[0], (host, port)
+    return response[0], None
+
+
+# returns the answer and the name of the private chatroom
+def parsePrivateChatroom(response):
+    if response == "user does not exist":
+        return response, None
+    kind, _, name = response.partition("\n")
+    return kind, name
+
+
+# "private-messages N" followed by N "sender time length" lines, each
+# followed by its content -> [(sender, content, time)]
+def parsePrivateMessages(response):
+    header, _, rest = response.partition("\n")
+    messages = []
+    for _ in range(int(header.split()[1])):
+        line, _, rest = rest.partition("\n")
+        sender, created, length = line.split()
+        messages.append((sender, rest[:int(length)], int(created)))
+        rest = rest[int(length) + 1:]
+    return messages
+
+
+# removes the private-messages pushes from the pushed messages and returns their messages
+def takePrivateMessages(pushed):
+    messages = []
+    for response in [response for response in pushed if response.startswith("private-messages")]:
+        pushed.remove(response)
+        messages += parsePrivateMessages(response)
+    return messages
+
+
+# the history a join of the room asks for without one given, the messages
+# since the offset the room had when this peer left it, or None
+def roomHistory(roomOffsets, name):
+    if name in roomOffsets:
+        return ("since", roomOffsets[name])
+    return None
+
+
+# whether the chatroom of the peer client was served by a relay that closed the connection
+def relayLost(peerClient):
+    return (peerClient is not None and peerClient.relaySocket is not None
+            and peerClient.relaySocket not in peerClient.peerServer.connectedPeers)
+
+
+# arguments of PeerClient for the answer of a chatroom join
+def roomConnections(response):
+    if response[0] == "chatroom-join-relay":
+        return None, response[1]
+    return response[1:], None
+
+
+# Interactive peer, a front end of RegistryClient that asks for the choices
+# and prints the answers
+class peerMain:
+    # peer initializations
+    def __init__(self, username=None, peerServerPort=None):
+        # registry host, the framed protocol is negotiated on connection
+        self.registryName = input("Enter IP address of registry: ")
+        self.client = RegistryClient(self.registryName).connect()
+        self.client.username = username
+        self.peerServerPort = peerServerPort
+
+        # run the main, after a lost registry connection the session is resumed
+        # with its token and the main goes on
+        while True:
+            try:
+                self.main()
+                return
+            except OSError:
+                print("Connection to the registry lost, resuming the session...")
+                try:
+                    if self.client.resume() == "resume-success":
+                        print("Session resumed.")
+                    else:
+                        print("The session expired, please log in again.")
+                except OSError:
+                    print("The registry cannot be reached.")
 
     def main(self):
         # main loop for program
@@ -126,7 +1011,7 @@ class peerMain:
             choice = "0"
 
             # in case that the user is not yet logged in
-            if self.username == None:
+            if self.client.username == None:
                 choice = input("\nOptions: \n\tCreate account: 1 \n\tLogin: 2 \nChoice: ")
 
                 match choice:
@@ -147,15 +1032,13 @@ class peerMain:
                                 break
 
                         # account creation
-                        message = "JOIN {} {}".format(username, password)
-                        self.tcpClientSocket.send(message.encode())
-                        response = self.tcpClientSocket.recv(1024).decode()
-
-                        match response:
+                        match self.client.register(username, password):
                             case "join-success":
                                 print("Account created successfully.")
                             case "join-exist":
                                 print("Username already exists.")
+                            case "server-busy":
+                                print("Registry is busy, please try again.")
 
                     # user is not logged in, log in with entered username, password
                     case "2":
@@ -171,31 +1054,27 @@ class peerMain:
                                     print("Port number must be integer between 1024 and 65535")
                                 else:
                                     break
-                        message = "LOGIN {} {} {}".format(username, password, port)
-                        self.tcpClientSocket.send(message.encode())
-                        response = self.tcpClientSocket.recv(1024).decode()
 
-                        match response:
+                        match self.client.login(username, password, port):
                             case "login-account-not-exist":
                                 print("No accounts exists with this username")
                             case "login-wrong-password":
                                 print("Incorrect password")
                             case "login-online":
                                 print("User is already online.")
-
+                            case "server-busy":
+                                print("Registry is busy, please try again.")
                             case "login-success":
                                 print("Successful Login!")
-                                self.username = username
                                 self.peerServerPort = port
-                                self.peerServer = PeerServer(self.username, self.peerServerPort)
-                                self.peerServer.start()
-                                self.sendHelloMessage()
 
                     case _:
                         print("Something went wrong, please try again")
 
             # otherwise if user is already logged in
             else:
+                for sender, content, created in self.client.privateMessages():
+                    print("\n{} -> {}: {}".format(time.strftime("%H:%M", time.localtime(created)), sender, content))
                 choice = input(
                     "\nOptions: \n\tLogout: 1 \n\tSearch for User: 2 \n\tActive Users: 3"
                     + "\n\tJoin Chatroom: 4 \n\tShow Chatrooms: 5 \n\tCreate Chatroom: 6 \n\tChat with User: 7"
@@ -203,40 +1082,20 @@ class peerMain:
                 )
 
                 match choice:
-                    # user logged out
+                    # user logged out, the registry ends the session so the next login connects again
                     case "1":
-                        self.username = None
+                        self.client.logout()
                         print("Logged out successfully")
-                        if self.username != None:
-                            message = "LOGOUT " + self.username
-                        else:
-                            message = "LOGOUT"
-                        self.tcpClientSocket.send(message.encode())
-
-                        if self.peerServer != None:
-                            self.peerServer.username = None
-                            self.peerServer.peerServerSocket.close()
-                            for sock in self.peerServer.connectedPeers:
-                                sock.close()
-                            self.peerServer = None
-
-                        if self.peerClient != None:
-                            self.peerClient.chatroom = None
-                            self.peerClient = None
-
-                        if self.timer is not None:
-                            self.timer.cancel()
+                        self.client.connect()
 
                     # search for a user
                     case "2":
                         username = input("Username to be searched: ")
-                        message = "SEARCH {}".format(username)
-                        self.tcpClientSocket.send(message.encode())
-                        response = self.tcpClientSocket.recv(1024).decode().split()
+                        response, address = self.client.search(username)
 
-                        match response[0]:
+                        match response:
                             case "search-success":
-                                print("{} is logged in -> {} : ".format(username, response[1], response[2]))
+                                print("{} is logged in -> {} : {}".format(username, address[0], address[1]))
                             case "search-user-not-online":
                                 print("{} is not online.".format(username))
                             case "search-user-not-found":
@@ -244,14 +1103,9 @@ class peerMain:
 
                     # list of online users
                     case "3":
-                        message = "USERS-LIST"
-                        self.tcpClientSocket.send(message.encode())
-                        response = self.tcpClientSocket.recv(1024).decode().split()
-
-                        if response[0] == "users-list-success":
-                            print("List of online users:")
-                            for user in response[1:]:
-                                print("\n\t" + user)
+                        print("List of online users:")
+                        for user in self.client.listPages("USERS-LIST", " "):
+                            print("\n\t" + user)
 
                     # join chatroom
                     case "4":
@@ -260,14 +1114,9 @@ class peerMain:
 
                     # preview available chatrooms
                     case "5":
-                        message = "CHATROOM-LIST"
-                        self.tcpClientSocket.send(message.encode())
-                        response = self.tcpClientSocket.recv(1024).decode().split("\n")
-
-                        if response[0] == "chatroom-list-success":
-                            print("Currently available chat rooms:")
-                            for chatroom in response[1:]:
-                                print("\n\t" + chatroom + " users connected")
+                        print("Currently available chat rooms:")
+                        for chatroom, count in self.client.chatrooms():
+                            print("\n\t{} : {} users connected".format(chatroom, count))
 
                     # chatroom created
                     case "6":
@@ -276,11 +1125,7 @@ class peerMain:
                             if len(name) < 5:
                                 print("Chatroom name must be at least 5 characters long")
                             else:
-                                message = "CHATROOM-CREATE\n{}".format(name)
-                                self.tcpClientSocket.send(message.encode())
-                                response = self.tcpClientSocket.recv(1024).decode()
-
-                                match response:
+                                match self.client.createChatroom(name):
                                     case "chatroom-exists":
                                         print("There already exists a chatroom with such name.")
                                     case "chatroom-creation-success":
@@ -289,46 +1134,51 @@ class peerMain:
                             break
                     case "7":
                         username = input("username: ")
-                        message = "PRIVATE-CHATROOM\n{}".format(username)
-                        self.tcpClientSocket.send(message.encode())
-                        response = self.tcpClientSocket.recv(1024).decode()
-
-                        splitResponse = response.split()
-                        match splitResponse[0]:
-                            case "user does not exist":
-                                print("user does not exist")
-                                break
-                        
-                        self.chatroomJoin(splitResponse[1])
+                        response, name = self.client.privateChatroom(username)
+                        if name is None:
+                            print(response)
+                        elif self.client.search(username)[0] == "search-user-not-online":
+                            # the registry keeps the message until the user logs in
+                            match self.client.privateMessage(username, input("{} is offline, message: ".format(username))):
+                                case "private-message-queued":
+                                    print("{} gets the message once logged in.".format(username))
+                                case "private-message-delivered":
+                                    print("Message sent.")
+                                case "private-message-queue-full":
+                                    print("{} has too many messages waiting.".format(username))
+                                case "private-message-too-long":
+                                    print("The message is too long.")
+                        else:
+                            self.chatroomJoin(name)
 
                     case _:
                         print("Something went wrong, please try again")
 
+    # joins the chatroom and reads the messages to send until the user quits it
     def chatroomJoin(self, name):
         print(name)
-        message = "CHATROOM-JOIN {}".format(name)
-        self.tcpClientSocket.send(message.encode())
-        response = self.tcpClientSocket.recv(1024).decode().split("\n")
-
-        match response[0]:
+        # a room this peer was in shows what was missed since, another one its last messages
+        history = roomHistory(self.client.roomOffsets, name) or ("last", HISTORY_ON_JOIN)
+        response = self.client.joinRoom(name, history)
+        match response:
             case "chatroom-not-found":
                 print("No chatroom exists with such name.")
-            case "chatroom-join-success":
-                if len(response) == 1:
-                    self.peerClient = PeerClient(self.username, name, self.peerServer)
-                else:
-                    self.peerClient = PeerClient(self.username, name, self.peerServer, response[1:])
-                self.peerClient.start()
-                self.peerClient.join()
+            case "chatroom-join-success" | "chatroom-join-relay":
+                peerClient = self.client.peerClient
+                # the room is only served by the relay
+                if response == "chatroom-join-relay" and peerClient.relaySocket is None:
+                    print("The relay of the chatroom could not be reached.")
+                    self.client.leaveRoom()
+                    return
+                if peerClient.unreachable:
+                    print("{} members could not be reached: {}".format(
+                        len(peerClient.unreachable), " ".join(peerClient.unreachable)))
+                peerClient.start()
+                peerClient.join()
 
                 # This section will only run after user quits the chatroom
-                self.tcpClientSocket.send("chatroom-leave-request".encode())
-
-    def sendHelloMessage(self):
-        message = "HELLO {}".format(self.username)
-        self.udpClientSocket.sendto(message.encode(), (self.registryName, self.registryUDPPort))
-        self.timer = threading.Timer(1, self.sendHelloMessage)
-        self.timer.start()
+                self.client.leaveRoom()
 
 
-peerMain()
+if __name__ == "__main__":
+    peerMain()
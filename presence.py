@@ -0,0 +1,168 @@
+# In-process presence index of the registry
+import bisect
+import logging
+import queue
+import threading
+
+# entries of a users or chatroom list page, when the peer does not ask for a size, and at most
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+log = logging.getLogger("registry.presence")
+
+
+# parses the limit=, after= and prefix= options of a list request
+def pageOptions(options):
+    values = dict(option.split("=", 1) for option in options if "=" in option)
+    try:
+        limit = min(max(int(values.get("limit", DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        limit = DEFAULT_PAGE_SIZE
+    return limit, values.get("after"), values.get("prefix", "")
+
+
+# returns up to limit names of a sorted list that come after the cursor and
+# start with the prefix, and the cursor of the next page or None at the end
+def sortedPage(names, limit, after=None, prefix=""):
+    start = bisect.bisect_left(names, prefix)
+    if after is not None and after >= prefix:
+        start = bisect.bisect_right(names, after)
+    page = []
+    for index in range(start, len(names)):
+        name = names[index]
+        if not name.startswith(prefix):
+            return page, None
+        if len(page) == limit:
+            return page, page[-1]
+        page.append(name)
+    return page, None
+
+
+# Authoritative record of the online peers, answers online, search and list
+# queries from memory. Every change is also handed to the write-behind queue,
+# which mirrors it to db.online_peers without blocking the caller, and to the
+# feed of the users list subscribers.
+class PresenceIndex:
+    def __init__(self, writeBehind=None, feed=None):
+        # username -> (host, port, session)
+        self.peers = {}
+        # usernames in order, for pages and prefix searches of the users list
+        self.sortedNames = []
+        self.lock = threading.RLock()
+        self.writeBehind = writeBehind
+        self.feed = feed
+
+    # marks the user online, returns False if the user is already online
+    def login(self, username, host, port, session=None):
+        with self.lock:
+            if username in self.peers:
+                return False
+            self.peers[username] = (host, port, session)
+            bisect.insort(self.sortedNames, username)
+            # queued under the lock, so the database sees the changes of a user in order
+            if self.writeBehind is not None:
+                self.writeBehind.login(username, host, port)
+            if self.feed is not None:
+                self.feed.publish(username, True)
+        return True
+
+    # marks the user offline and returns its session, or None if it was not online;
+    # when a session is given the user is only logged out if it belongs to that session
+    def logout(self, username, session=None):
+        with self.lock:
+            entry = self.peers.get(username)
+            if entry is None or (session is not None and entry[2] is not session):
+                return None
+            del self.peers[username]
+            del self.sortedNames[bisect.bisect_left(self.sortedNames, username)]
+            if self.writeBehind is not None:
+                self.writeBehind.logout(username)
+            if self.feed is not None:
+                self.feed.publish(username, False)
+        return entry[2]
+
+    def isOnline(self, username):
+        return username in self.peers
+
+    # returns (host, port) of an online user, or None
+    def address(self, username):
+        entry = self.peers.get(username)
+        if entry is None:
+            return None
+        return entry[0], entry[1]
+
+    # returns the session of an online user, or None
+    def session(self, username):
+        entry = self.peers.get(username)
+        if entry is None:
+            return None
+        return entry[2]
+
+    # returns the usernames of the online users
+    def usernames(self):
+        with self.lock:
+            return list(self.peers)
+
+    # returns a page of the online usernames in order and the cursor of the next page
+    def page(self, limit, after=None, prefix=""):
+        with self.lock:
+            return sortedPage(self.sortedNames, limit, after, prefix)
+
+    def __contains__(self, username):
+        return username in self.peers
+
+    def __len__(self):
+        return len(self.peers)
+
+
+# Applies presence changes to the database on a background thread. Changes
+# queued while a batch is written are coalesced, only the latest state of
+# every user is written.
+class WriteBehindQueue(threading.Thread):
+    def __init__(self, database, batchSize=512):
+        threading.Thread.__init__(self, daemon=True)
+        self.database = database
+        self.batchSize = batchSize
+        self.queue = queue.Queue()
+
+    def login(self, username, host, port):
+        self.queue.put((username, (host, port)))
+
+    def logout(self, username):
+        self.queue.put((username, None))
+
+    def run(self):
+        # records left by an earlier run are stale, the presence index starts empty
+        try:
+            self.database.clear_online_peers()
+        except Exception as err:
+            log.error("Clearing online peers failed: %s", err)
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batchSize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.write(batch)
+            for _ in batch:
+                self.queue.task_done()
+
+    # writes the final state of every user in the batch, all logouts with one
+    # round trip and all logins with another
+    def write(self, batch):
+        final = {}
+        for username, address in batch:
+            final[username] = address
+        # logins upsert, so a login that follows a logout in the batch replaces the old record
+        logouts = [username for username, address in final.items() if address is None]
+        logins = [(username, address[0], address[1]) for username, address in final.items() if address is not None]
+        try:
+            self.database.bulk_logout(logouts)
+            self.database.bulk_login(logins)
+        except Exception as err:
+            log.error("Write-behind of %d changes failed: %s", len(batch), err)
+
+    # waits until every queued change is written
+    def flush(self):
+        self.queue.join()
@@ -0,0 +1,345 @@
+# Framed wire protocol shared by the registry and the peers
+#
+# A framed connection starts with a handshake, the client sends HANDSHAKE_MAGIC
+# followed by the highest protocol version it speaks, and the server answers
+# the same way with the version both sides will use. After the handshake every
+# message is a frame: a 4 byte big endian payload length, then the utf-8 text
+# of the message. Connections that do not start with the magic are legacy text
+# connections, where every recv is taken as one message.
+#
+# From version 2 a frame may also hold a binary chat message instead of text:
+# a type tag byte below any printable character, a byte with the length of
+# the sender's username, the username, then the body up to the end of the
+# frame, zlib compressed under COMPRESSED_CHAT_MESSAGE.
+import select
+import struct
+import zlib
+from socket import timeout as socketTimeout
+
+HANDSHAKE_MAGIC = b"P2PF"
+PROTOCOL_VERSION = 2
+# highest version of connections that only carry text, like those to the registry
+TEXT_VERSION = 1
+# first version with binary chat messages
+CHAT_VERSION = 2
+HANDSHAKE_SIZE = len(HANDSHAKE_MAGIC) + 1
+# frames above this size are treated as a protocol error instead of being buffered
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# size of a single recv on framed or negotiating connections
+RECV_SIZE = 65536
+# environment variable holding the secret a shard router and its registry
+# shards share, the router sends it with SHARD-AUTH on every shard connection
+SHARD_SECRET_ENV = "P2P_SHARD_SECRET"
+
+LEGACY = "legacy"
+FRAMED = "framed"
+# encoding of a connection that takes binary chat messages, a framed one of CHAT_VERSION
+BINARY = "binary"
+
+# type tags of the binary messages
+CHAT_MESSAGE = 1
+COMPRESSED_CHAT_MESSAGE = 2
+# chat bodies of at least this many bytes are compressed, when it makes them smaller
+COMPRESSION_THRESHOLD = 512
+
+frameHeader = struct.Struct("!I")
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# returns the handshake announcing the given version
+def handshake(version=PROTOCOL_VERSION):
+    return HANDSHAKE_MAGIC + bytes([version])
+
+
+# encodes a single message into a frame
+def encodeFrame(message):
+    payload = message.encode("utf-8") if isinstance(message, str) else message
+    return frameHeader.pack(len(payload)) + payload
+
+
+# encodes several messages into one buffer, so they can go out with one send
+def encodeFrames(messages):
+    return b"".join([encodeFrame(message) for message in messages])
+
+
+# A chat message; it is encoded at most once per encoding of the connections
+# it is sent on, and one received in binary keeps its payload, so a relay
+# forwards it without encoding it again
+class ChatMessage:
+    __slots__ = ("sender", "content", "payload", "threshold", "encoded")
+
+    def __init__(self, sender, content, payload=None, threshold=COMPRESSION_THRESHOLD):
+        self.sender = sender
+        self.content = content
+        self.payload = payload
+        self.threshold = threshold
+        # encoding -> bytes to send
+        self.encoded = {}
+
+    # the message as the split fields of its text form
+    def fields(self):
+        return ["chat-message", self.sender, self.content]
+
+    def text(self):
+        return "chat-message\n{}\n{}".format(self.sender, self.content)
+
+    # the binary payload of the message, compressed above the threshold
+    def binary(self):
+        if self.payload is None:
+            self.payload = encodeChatMessage(self.sender, self.content, self.threshold)
+        return self.payload
+
+    # the bytes of the message for a connection of the given encoding
+    def encode(self, encoding):
+        data = self.encoded.get(encoding)
+        if data is None:
+            if encoding == BINARY:
+                data = encodeFrame(self.binary())
+            elif encoding == FRAMED:
+                data = encodeFrame(self.text())
+            else:
+                data = self.text().encode()
+            self.encoded[encoding] = data
+        return data
+
+
+# encodes the binary payload of a chat message
+def encodeChatMessage(sender, content, threshold=COMPRESSION_THRESHOLD):
+    name = sender.encode("utf-8")
+    if len(name) > 255:
+        raise ProtocolError("username of {} bytes is too long".format(len(name)))
+    body = content.encode("utf-8")
+    tag = CHAT_MESSAGE
+    if threshold is not None and len(body) >= threshold:
+        compressed = zlib.compress(body, 1)
+        if len(compressed) < len(body):
+            tag = COMPRESSED_CHAT_MESSAGE
+            body = compressed
+    return bytes((tag, len(name))) + name + body
+
+
+# decodes utf-8 text received from the other side, bytes that are not utf-8 are a protocol error
+def decodeText(data):
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError as err:
+        raise ProtocolError("message is not utf-8: {}".format(err))
+
+
+# decodes a binary chat message, the usernames are interned in names so a
+# sender's messages share one string
+def decodeChatMessage(payload, names, maxSize=MAX_FRAME_SIZE):
+    if len(payload) < 2 or len(payload) < 2 + payload[1]:
+        raise ProtocolError("truncated chat message")
+    end = 2 + payload[1]
+    key = payload[2:end]
+    sender = names.get(key)
+    if sender is None:
+        sender = names[key] = decodeText(key)
+    body = payload[end:]
+    if payload[0] == COMPRESSED_CHAT_MESSAGE:
+        decompressor = zlib.decompressobj()
+        try:
+            body = decompressor.decompress(body, maxSize)
+        except zlib.error as err:
+            raise ProtocolError("corrupt chat message: {}".format(err))
+        if decompressor.unconsumed_tail:
+            raise ProtocolError("chat message exceeds the limit")
+    elif payload[0] != CHAT_MESSAGE:
+        raise ProtocolError("unknown message type {}".format(payload[0]))
+    return ChatMessage(sender, decodeText(body), payload)
+
+
+# returns the fields of a received message, text split on its lines
+def messageFields(message):
+    if isinstance(message, ChatMessage):
+        return message.fields()
+    return message.split("\n")
+
+
+# Incremental decoder of frames, partial frames stay in the buffer until the
+# rest of them arrives, and a read holding several frames yields all of them
+class FrameDecoder:
+    def __init__(self, maxFrameSize=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.maxFrameSize = maxFrameSize
+
+    # adds received bytes to the buffer and returns the payloads of the completed frames
+    def feed(self, data):
+        self.buffer += data
+        payloads = []
+        offset = 0
+        size = len(self.buffer)
+        while size - offset >= frameHeader.size:
+            (length,) = frameHeader.unpack_from(self.buffer, offset)
+            if length > self.maxFrameSize:
+                raise ProtocolError("frame of {} bytes exceeds the limit".format(length))
+            end = offset + frameHeader.size + length
+            if end > size:
+                break
+            payloads.append(bytes(self.buffer[offset + frameHeader.size:end]))
+            offset = end
+        if offset:
+            del self.buffer[:offset]
+        return payloads
+
+
+# Codec of one connection, it detects whether the other side speaks the
+# framed protocol or legacy text, decodes incoming bytes into messages,
+# and encodes outgoing messages in the format of the connection
+class MessageCodec:
+    # mode is None on the accepting side, where it is negotiated from the first
+    # bytes; there version is the highest one the accepting side speaks
+    def __init__(self, mode=None, version=PROTOCOL_VERSION):
+        self.mode = mode
+        self.version = version
+        self.pending = b""
+        self.decoder = FrameDecoder()
+        # username bytes -> username, of the senders of binary chat messages
+        self.names = {}
+        # handshake that has to be sent back once the other side asked for framing
+        self.handshakeReply = b""
+
+    # decodes received bytes into a list of message texts
+    def feed(self, data):
+        if self.mode is None:
+            data = self.pending + data
+            if len(data) < HANDSHAKE_SIZE and HANDSHAKE_MAGIC.startswith(data[:len(HANDSHAKE_MAGIC)]):
+                # could still be the start of a handshake, wait for the rest of it
+                self.pending = data
+                return []
+            self.pending = b""
+            if data.startswith(HANDSHAKE_MAGIC):
+                self.mode = FRAMED
+                self.version = min(data[len(HANDSHAKE_MAGIC)], self.version)
+                self.handshakeReply = handshake(self.version)
+                data = data[HANDSHAKE_SIZE:]
+            else:
+                self.mode = LEGACY
+        if self.mode == LEGACY:
+            return [decodeText(data)] if data else []
+        messages = []
+        for payload in self.decoder.feed(data):
+            # text starts with a printable character, a binary message with its tag
+            if payload and payload[0] < 0x20 and self.version >= CHAT_VERSION:
+                messages.append(decodeChatMessage(payload, self.names))
+            else:
+                messages.append(decodeText(payload))
+        return messages
+
+    # encoding of the messages sent on this connection
+    @property
+    def encoding(self):
+        if self.mode == FRAMED and self.version >= CHAT_VERSION:
+            return BINARY
+        return self.mode
+
+    # returns the handshake reply once, if one is due
+    def takeHandshakeReply(self):
+        reply = self.handshakeReply
+        self.handshakeReply = b""
+        return reply
+
+    # encodes messages to be sent together, text or chat messages
+    def encode(self, messages):
+        if len(messages) == 1:
+            if isinstance(messages[0], ChatMessage):
+                return messages[0].encode(self.encoding)
+        elif any(isinstance(message, ChatMessage) for message in messages):
+            return b"".join([self.encode([message]) for message in messages])
+        if self.mode == FRAMED:
+            return encodeFrames(messages)
+        return "".join(messages).encode()
+
+
+# Sends the handshake on a connected socket and waits for the answer of the
+# other side. A side that does not answer in time is a legacy one, so a
+# legacy codec is returned and the connection keeps working as plain text.
+def clientHandshake(sock, timeout=2):
+    sock.sendall(handshake())
+    previousTimeout = sock.gettimeout()
+    sock.settimeout(timeout)
+    reply = b""
+    try:
+        while len(reply) < HANDSHAKE_SIZE:
+            chunk = sock.recv(HANDSHAKE_SIZE - len(reply))
+            if not chunk:
+                break
+            reply += chunk
+    except socketTimeout:
+        pass
+    finally:
+        sock.settimeout(previousTimeout)
+    if len(reply) == HANDSHAKE_SIZE and reply.startswith(HANDSHAKE_MAGIC):
+        return MessageCodec(FRAMED, reply[len(HANDSHAKE_MAGIC)])
+    return MessageCodec(LEGACY)
+
+
+# Blocking message connection over a socket, used by the threaded registry and the peers
+class MessageSocket:
+    def __init__(self, sock, codec):
+        self.sock = sock
+        self.codec = codec
+        # messages decoded by an earlier recv, waiting to be returned
+        self.received = []
+
+    # connects as the client side and negotiates the protocol
+    @classmethod
+    def connect(cls, sock, timeout=2):
+        return cls(sock, clientHandshake(sock, timeout))
+
+    # wraps an accepted socket, the protocol is negotiated from its first bytes
+    @classmethod
+    def accept(cls, sock, version=PROTOCOL_VERSION):
+        return cls(sock, MessageCodec(version=version))
+
+    # returns the messages available after one recv, an empty list means the connection closed
+    def receiveMany(self):
+        if self.received:
+            messages = self.received
+            self.received = []
+            return messages
+        while True:
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                return []
+            messages = self.codec.feed(data)
+            reply = self.codec.takeHandshakeReply()
+            if reply:
+                self.sock.sendall(reply)
+            if messages:
+                return messages
+
+    # returns the messages received so far, the decoded ones and those the
+    # socket holds, without waiting for more
+    def receiveWaiting(self):
+        messages = self.received
+        self.received = []
+        while select.select([self.sock], [], [], 0)[0]:
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                break
+            messages += self.codec.feed(data)
+        return messages
+
+    # returns the next message, or None when the connection closed
+    def receive(self):
+        if not self.received:
+            self.received = self.receiveMany()
+            if not self.received:
+                return None
+        return self.received.pop(0)
+
+    def send(self, message):
+        self.sock.sendall(self.codec.encode([message]))
+
+    # sends several messages with one send
+    def sendMany(self, messages):
+        if messages:
+            self.sock.sendall(self.codec.encode(messages))
+
+    def close(self):
+        self.sock.close()
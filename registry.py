@@ -1,314 +1,1141 @@
 from socket import *
 import threading
-import select
+import selectors
 import logging
+import argparse
+import hmac
+import os
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
 import db
-import bcrypt
+from db import create_backend, AsyncDB, MONGO_DATABASE
+import protocol
+from presence import PresenceIndex, WriteBehindQueue, pageOptions
+from passwords import PasswordHasher, ServerBusy, DEFAULT_ROUNDS
+from relay import RelayServer
+from history import MessageHistory, RETENTION_SECONDS
+from tokens import SessionTokens, TOKEN_TTL, RESUME_WINDOW
+from offline import OfflineQueue, formatPrivateMessages, MAX_MESSAGES_PER_USER, MESSAGE_TTL, MAX_MESSAGE_LENGTH
+from rooms import RoomRegistry
+from subscriptions import DeltaFeed, formatUsersDelta, formatRoomsDelta
+from metrics import Metrics, LatencyHistogram, startMetricsServer
+from logs import setupLogging, CATEGORY_RATES, LOG_MAX_BYTES, LOG_BACKUPS
 import colorama
 from colorama import *
 
 colorama.init(autoreset=True)
 
+# records of the registry, written by the listener thread of the logging pipeline
+log = logging.getLogger("registry")
 
-# This class is used to process the peer messages sent to registry
-# for each peer connected to registry, a new client thread is created
-class ClientThread(threading.Thread):
-    # initializations for client thread
-    def __init__(self, ip, port, tcpClientSocket):
-        threading.Thread.__init__(self)
+# seconds without a hello message after which a peer is logged out
+HELLO_TIMEOUT = 3
+# seconds between two sweeps of the liveness tracker
+LIVENESS_TICK = 0.5
+# largest hello datagram read, and the datagrams read at most per wakeup of the udp socket
+HELLO_DATAGRAM_SIZE = 1024
+HELLO_BATCH_SIZE = 256
+HELLO_PREFIX = b"HELLO "
+
+# commands that wait for bcrypt or database writes, in asyncio mode these
+# are handed to a bounded worker pool so they do not stall the event loop
+BLOCKING_COMMANDS = {"JOIN", "LOGIN"}
+# commands that create or delete chatrooms, they write to the database and
+# block like the commands above when the rooms are persisted
+ROOM_WRITE_COMMANDS = {"CHATROOM-CREATE", "PRIVATE-CHATROOM", "ROOM-CREATE", "ROOMS-IMPORT", "ROOMS-DELETE"}
+# commands that only look up the account named by their first argument, in
+# asyncio mode the lookup is awaited first and the command then runs on the loop
+ACCOUNT_LOOKUP_COMMANDS = {"SEARCH", "PRIVATE-CHATROOM", "PRIVATE-MESSAGE"}
+# members from which a chatroom is served by the relay instead of a full mesh
+RELAY_THRESHOLD = 8
+# commands the shard router sends to the registry processes of a sharded registry
+SHARD_COMMANDS = {
+    "PEER-ADDRESS", "ROOM-JOIN", "ROOM-LEAVE", "ROOM-EXISTS", "ROOM-CREATE", "ADDRESSES",
+    "ACCOUNTS-EXPORT", "ACCOUNTS-IMPORT", "ACCOUNTS-DELETE", "ROOMS-EXPORT", "ROOMS-IMPORT", "ROOMS-DELETE",
+    "PRIVATE-MESSAGE-FROM", "STORAGE",
+}
+# commands whose last argument is free text, split only into this many words before it
+FREE_TEXT_COMMANDS = {"PRIVATE-MESSAGE": 2, "PRIVATE-MESSAGE-FROM": 3}
+# commands timed under their own name in the metrics, anything else a peer
+# sends is counted as "other" so peers cannot add labels
+METRIC_COMMANDS = {
+    "JOIN", "LOGIN", "LOGOUT", "SEARCH", "USERS-LIST", "CHATROOM-LIST", "SUBSCRIBE", "UNSUBSCRIBE",
+    "CHATROOM-CREATE", "PRIVATE-CHATROOM", "CHATROOM-JOIN", "chatroom-leave-request", "PRIVATE-MESSAGE", "RESUME",
+} | SHARD_COMMANDS
+
+
+# A command in the log, its text is only built if the record is written;
+# passwords, password hashes, secrets, session tokens and private messages are left out
+class LoggedCommand:
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        message = self.message
+        if message[0] in ("JOIN", "LOGIN", "RESUME") and len(message) > 2:
+            message = message[:2] + ["***"] + message[3:]
+        elif message[0] == "ACCOUNTS-IMPORT":
+            message = [message[0], "({} accounts)".format(len(message) // 2)]
+        elif message[0] == "SHARD-AUTH":
+            message = [message[0], "***"]
+        elif message[0] in FREE_TEXT_COMMANDS and len(message) > FREE_TEXT_COMMANDS[message[0]]:
+            message = message[:-1] + ["({} characters)".format(len(message[-1]))]
+        return " ".join(message)
+
+
+# checks whether any of the messages is a command that blocks on the database or bcrypt
+def needsWorker(texts):
+    persistedRooms = chatrooms.database is not None
+    for text in texts:
+        command = text.split(None, 1)[:1]
+        if command and (command[0] in BLOCKING_COMMANDS or (persistedRooms and command[0] in ROOM_WRITE_COMMANDS)):
+            return True
+    return False
+
+
+# This class holds the state of one peer connected to the registry
+# and processes the protocol messages it sends, independent of how
+# the connection itself is served (thread per connection or asyncio)
+class ClientSession:
+    # initializations for client session
+    def __init__(self, ip, port):
         # ip of the connected peer
         self.ip = ip
         # port number of the connected peer
         self.port = port
-        # socket of the peer
-        self.tcpClientSocket = tcpClientSocket
-        # username, online status and udp server initializations
+        # username, online status and chatroom initializations
         self.username = None
         self.isOnline = True
-        self.udpServer = None
-        print("New thread started for " + ip + ":" + str(port))
+        self.chatroom = None
+        # feeds of the lists this peer subscribed to
+        self.subscriptions = set()
+        # whether the connection is the router's, proven with SHARD-AUTH
+        self.isRouter = False
+        # set by the router for a peer whose own connection to it is legacy text
+        self.legacyPeer = False
 
-    # main of the thread
-    def run(self):
-        # locks for thread which will be used for thread synchronization
-        self.lock = threading.Lock()
-        print("Connection from: " + self.ip + ":" + str(port))
-        print("IP Connected: " + self.ip)
+    # sends a message to the peer outside of a request, such as a pushed delta;
+    # may be called from any thread, implemented by the connection type
+    def sendResponse(self, response):
+        raise NotImplementedError
 
-        while True:
-            try:
-                # waits for incoming messages from peers
-                message = self.tcpClientSocket.recv(1024).decode().split()
-                logging.info("Received from " + self.ip + ":" + str(self.port) + " -> " + " ".join(message))
-                #   JOIN    #
-                if message[0] == "JOIN":
-                    # join-exist is sent to peer,
-                    # if an account with this username already exists
-                    if db.is_account_exist(message[1]):
-                        response = "join-exist"
-                        print("From-> " + self.ip + ":" + str(self.port) + " " + response)
-                        logging.info("Send to " + self.ip + ":" + str(self.port) + " -> " + response)
-                        self.tcpClientSocket.send(response.encode())
-                    # join-success is sent to peer,
-                    # if an account with this username is not exist, and the account is created
-                    else:
-                        hashed_password = bcrypt.hashpw(message[2].encode("utf-8"), bcrypt.gensalt())
-                        db.register(message[1], hashed_password)
+    # whether the peer reads messages pushed apart from its responses, a legacy
+    # text connection does not separate them; narrowed by the connection type
+    def readsPushes(self):
+        return not self.legacyPeer
+
+    # ends the subscriptions of the peer, called when its connection ends
+    def unsubscribeAll(self):
+        for feed in self.subscriptions:
+            feed.unsubscribe(self)
+        self.subscriptions.clear()
+
+    # closes the connection of the peer, implemented by the connection type
+    def closeConnection(self):
+        raise NotImplementedError
+
+    # processes the messages decoded from one read of the peer's connection
+    # and returns their responses, so they can be sent back together
+    def handleMessages(self, texts):
+        responses = []
+        for text in texts:
+            message = text.split()
+            if not message:
+                continue
+            if message[0] in FREE_TEXT_COMMANDS:
+                message = text.split(None, FREE_TEXT_COMMANDS[message[0]])
+            if metrics is None:
+                response = self.handleMessage(message)
+            else:
+                response = self.handleTimedMessage(message)
+            if response is not None:
+                responses.append(response)
+            # the private messages queued while the user was offline follow its
+            # login-success, a legacy peer leaves them queued
+            if response is not None and response.startswith(("login-success", "resume-success")) and self.readsPushes():
+                push = takeOfflineMessages(self.username)
+                if push is not None:
+                    responses.append(push)
+            if not self.isOnline:
+                break
+        return responses
+
+    # handleMessage, recording its time and the kind of its response in the metrics
+    def handleTimedMessage(self, message):
+        start = time.perf_counter()
+        response = self.handleMessage(message)
+        command = message[0] if message[0] in METRIC_COMMANDS else "other"
+        metrics.observe("command_seconds", command, time.perf_counter() - start)
+        if response is not None:
+            metrics.increment("responses_total", response.split(None, 1)[0])
+        return response
+
+    # processes a single message received from the peer and returns the response
+    # to be sent, or None; isOnline is set to False when the connection should end
+    def handleMessage(self, message):
+        log.info("Received from %s:%s -> %s", self.ip, self.port, LoggedCommand(message),
+                 extra={"peer": self.ip, "command": message[0]})
+        response = None
+        #   JOIN    #
+        if message[0] == "JOIN":
+            # join-exist is sent to peer,
+            # if an account with this username already exists
+            if db.is_account_exist(message[1]):
+                response = "join-exist"
+            # join-success is sent to peer,
+            # if an account with this username is not exist, and the account is created
+            # server-busy is sent to peer, if the password pool is full
+            else:
+                try:
+                    hashed_password = passwordHasher.hash(message[2])
+                    # the unique index refuses the account if another peer took the username meanwhile
+                    if db.register(message[1], hashed_password):
                         response = "join-success"
-                        logging.info("Send to " + self.ip + ":" + str(self.port) + " -> " + response)
-                        self.tcpClientSocket.send(response.encode())
-                #   LOGIN    #
-                elif message[0] == "LOGIN":
-                    # login-account-not-exist is sent to peer,
-                    # if an account with the username does not exist
-                    if not db.is_account_exist(message[1]):
-                        response = "login-account-not-exist"
-                        logging.info("Send to " + self.ip + ":" + str(self.port) + " -> " + response)
-                        self.tcpClientSocket.send(response.encode())
-                    # login-online is sent to peer,
-                    # if an account with the username already online
-                    elif db.is_account_online(message[1]):
-                        response = "login-online"
-                        logging.info("Send to " + self.ip + ":" + str(self.port) + " -> " + response)
-                        self.tcpClientSocket.send(response.encode())
-                    # login-success is sent to peer,
-                    # if an account with the username exists and not online
-                    else:
-                        # retrieves the account's password, and checks if the one entered by the user is correct
-                        retrievedPass = db.get_password(message[1])
-                        # if password is correct, then peer's thread is added to threads list
-                        # peer is added to db with its username, port number, and ip address
-                        if bcrypt.checkpw(message[2].encode("utf-8"), retrievedPass):
-                            self.username = message[1]
-                            self.lock.acquire()
-                            try:
-                                tcpThreads[self.username] = self
-                            finally:
-                                self.lock.release()
-
-                            db.user_login(message[1], self.ip, message[3])
-                            onlinePeers[message[1]] = {"host": self.ip, "port": message[3]}
-                            # login-success is sent to peer,
-                            # and a udp server thread is created for this peer, and thread is started
-                            # timer thread of the udp server is started
-                            response = "login-success"
-                            logging.info("Send to " + self.ip + ":" + str(self.port) + " -> " + response)
-                            self.tcpClientSocket.send(response.encode())
-                            self.udpServer = UDPServer(self.username, self.tcpClientSocket)
-                            self.udpServer.start()
-                            self.udpServer.timer.start()
-                        # if password not matches and then login-wrong-password response is sent
-                        else:
-                            response = "login-wrong-password"
-                            logging.info("Send to " + self.ip + ":" + str(self.port) + " -> " + response)
-                            self.tcpClientSocket.send(response.encode())
-                #   LOGOUT  #
-                elif message[0] == "LOGOUT":
-                    # if user is online,
-                    # removes the user from onlinePeers list
-                    # and removes the thread for this user from tcpThreads
-                    # socket is closed and timer thread of the udp for this
-                    # user is cancelled
-                    if len(message) > 1 and message[1] is not None and db.is_account_online(message[1]):
-                        db.user_logout(message[1])
-                        if self.username in onlinePeers:
-                            del onlinePeers[self.username]
-                        self.lock.acquire()
-                        try:
-                            if message[1] in tcpThreads:
-                                del tcpThreads[message[1]]
-                        finally:
-                            self.lock.release()
-                        print(self.ip + ":" + str(self.port) + " is logged out")
-                        self.tcpClientSocket.close()
-                        self.udpServer.timer.cancel()
-                        break
                     else:
-                        self.tcpClientSocket.close()
-                        break
-                #   SEARCH  #
-                elif message[0] == "SEARCH":
-                    # checks if an account with the username exists
-                    if db.is_account_exist(message[1]):
-                        # checks if the account is online
-                        # and sends the related response to peer
-                        if db.is_account_online(message[1]):
-                            peer_info = db.get_peer_ip_port(message[1])
-                            response = "search-success " + peer_info[0] + ":" + peer_info[1]
-                            logging.info("Send to " + self.ip + ":" + str(self.port) + " -> " + response)
-                            self.tcpClientSocket.send(response.encode())
+                        response = "join-exist"
+                except ServerBusy:
+                    response = "server-busy"
+        #   LOGIN    #
+        elif message[0] == "LOGIN":
+            # login-account-not-exist is sent to peer,
+            # if an account with the username does not exist
+            if not db.is_account_exist(message[1]):
+                response = "login-account-not-exist"
+            # login-online is sent to peer,
+            # if an account with the username already online
+            elif presence.isOnline(message[1]):
+                response = "login-online"
+            # login-success is sent to peer,
+            # if an account with the username exists and not online
+            else:
+                # retrieves the account's password, and checks if the one entered by the user is correct
+                retrievedPass = db.get_password(message[1])
+                # if password is correct, then peer is added to the presence index
+                # with its username, port number, ip address and session,
+                # the database is updated in the background
+                try:
+                    passwordMatches = passwordHasher.check(message[2], retrievedPass)
+                except ServerBusy:
+                    passwordMatches = None
+                    response = "server-busy"
+                if passwordMatches:
+                    # another session may have logged in meanwhile, login is atomic
+                    if presence.login(message[1], self.ip, message[3], self):
+                        self.username = message[1]
+                        # login-success is sent to peer, followed by a session
+                        # token if the peer asked for one with a last "token",
+                        # and the peer is tracked for hello messages
+                        if len(message) > 4 and message[4] == "token":
+                            response = "login-success " + tokens.issue(self.username)
                         else:
-                            response = "search-user-not-online"
-                            logging.info("Send to " + self.ip + ":" + str(self.port) + " -> " + response)
-                            self.tcpClientSocket.send(response.encode())
-                    # enters if username does not exist
-                    else:
-                        response = "search-user-not-found"
-                        logging.info("Send to " + self.ip + ":" + str(self.port) + " -> " + response)
-                        self.tcpClientSocket.send(response.encode())
-
-                elif message[0] == "USERS-LIST":
-                    users = " ".join(onlinePeers.keys())
-                    response = "users-list-success " + users
-                    self.tcpClientSocket.send(response.encode())
-
-                elif message[0] == "CHATROOM-LIST":
-                    response = "chatroom-list-success"
-                    for key in chatrooms.keys():
-                        response = "{}\n{} : {}".format(response, key, len(chatrooms[key]))
-                    self.tcpClientSocket.send(response.encode())
-
-                elif message[0] == "CHATROOM-CREATE":
-                    if message[1] in chatrooms.keys():
-                        response = "chatroom-exists"
-                    elif message[1][0] == '#':
-                        response = "chatroom name cannot begin with #"
-                    else:
-                        chatrooms[message[1]] = []
-                        response = "chatroom-creation-success"
-                    self.tcpClientSocket.send(response.encode())
-
-                elif message[0] == "PRIVATE-CHATROOM":
-                    print(message)
-                    username1 = message[1]
-                    if not db.is_account_exist(username1):
-                        response = "user does not exist"
-                    # if not db.is_account_online(username1):
-                    #     response = "user not online"
-
-                    elif "#" + self.username + "#" + username1 in chatrooms.keys():
-                        response = "chatroom-exists\n" + "#" + self.username + "#" + username1
-                    elif "#" + username1 + "#" + self.username in chatrooms.keys():
-                        response = "chatroom-exists\n" + "#" + username1 + "#" + self.username
+                            tokens.revoke(self.username)
+                            response = "login-success"
+                        liveness.touch(self.username)
                     else:
-                        chatrooms["#" + self.username + "#" + username1] = []
-                        response = "success\n" + "#" + self.username + "#" + username1
+                        response = "login-online"
+                # if password not matches and then login-wrong-password response is sent
+                elif passwordMatches is not None:
+                    response = "login-wrong-password"
+        #   LOGOUT  #
+        elif message[0] == "LOGOUT":
+            # if user is online through this session,
+            # removes the user from the presence index,
+            # connection is closed and this user is no longer
+            # tracked for hello messages
+            username = message[1] if len(message) > 1 else self.username
+            if username is not None and presence.logout(username, self) is not None:
+                liveness.remove(username)
+                leaveRooms(username)
+                tokens.revoke(username)
+                log.info("%s:%s is logged out", self.ip, self.port, extra={"user": username})
+            self.isOnline = False
+        #   RESUME  #
+        # RESUME username token port, a peer whose session timed out or whose
+        # connection dropped takes it up again without its password; the token
+        # replaces bcrypt, and the peer is put back in its chatroom, its
+        # connections to the other members are still there
+        elif message[0] == "RESUME":
+            if len(message) < 4:
+                response = "resume-invalid"
+            else:
+                response = self.resume(message[1], message[2], message[3])
+        #   SEARCH  #
+        elif message[0] == "SEARCH":
+            # an online user has an account, only offline ones are looked up;
+            # on a shard this also finds the users that logged in before a
+            # rebalance moved their account away
+            peer_info = presence.address(message[1])
+            if peer_info is not None:
+                response = "search-success " + peer_info[0] + ":" + peer_info[1]
+            # checks if an account with the username exists
+            elif db.is_account_exist(message[1]):
+                response = "search-user-not-online"
+            # enters if username does not exist
+            else:
+                response = "search-user-not-found"
 
-                    self.tcpClientSocket.send(response.encode())
+        # without options the whole list is sent, with limit=, after= and prefix=
+        # a page of it in order, headed by the cursor of the next page or -
+        elif message[0] == "USERS-LIST":
+            if len(message) == 1:
+                users = " ".join(presence.usernames())
+                response = "users-list-success " + users
+            else:
+                users, cursor = presence.page(*pageOptions(message[1:]))
+                response = " ".join(["users-list-page", cursor or "-"] + users)
 
-                elif message[0] == "CHATROOM-JOIN":
-                    if message[1] not in chatrooms.keys():
-                        response = "chatroom-not-found"
-                    else:
-                        response = "chatroom-join-success"
-                        for user in chatrooms[message[1]]:
-                            response = "{}\n{},{}".format(
-                                response, onlinePeers[user]["host"], onlinePeers[user]["port"]
-                            )
-                        chatrooms[message[1]].append(self.username)
-                        self.chatroom = message[1]
-                    self.tcpClientSocket.send(response.encode())
+        elif message[0] == "CHATROOM-LIST":
+            if len(message) == 1:
+                response = chatrooms.listing()
+            else:
+                lines, cursor = chatrooms.page(*pageOptions(message[1:]))
+                response = "\n".join(["chatroom-list-page " + (cursor or "-")] + lines)
 
-            except OSError as oErr:
-                logging.error("OSError: {0}".format(oErr))
+        # pushes the changes of the users or the chatroom list to the peer
+        # from now on, as users-delta and rooms-delta messages
+        elif message[0] == "SUBSCRIBE" or message[0] == "UNSUBSCRIBE":
+            feed = feeds.get(message[1]) if len(message) > 1 else None
+            if feed is None:
+                response = "subscribe-unknown-list"
+            elif message[0] == "SUBSCRIBE":
+                feed.subscribe(self)
+                self.subscriptions.add(feed)
+                response = "subscribe-success " + message[1]
+            else:
+                feed.unsubscribe(self)
+                self.subscriptions.discard(feed)
+                response = "unsubscribe-success " + message[1]
 
-                # function for resettin the timeout for the udp timer thread
+        elif message[0] == "CHATROOM-CREATE":
+            if message[1] in chatrooms:
+                response = "chatroom-exists"
+            elif message[1][0] == '#':
+                response = "chatroom name cannot begin with #"
+            elif chatrooms.create(message[1]):
+                response = "chatroom-creation-success"
+            else:
+                response = "chatroom-exists"
 
-    def resetTimeout(self):
-        self.udpServer.resetTimer()
+        elif message[0] == "PRIVATE-CHATROOM":
+            username1 = message[1]
+            # an offline user gets the private messages sent meanwhile once it logs in
+            if not db.is_account_exist(username1):
+                response = "user does not exist"
+            elif "#" + self.username + "#" + username1 in chatrooms:
+                response = "chatroom-exists\n" + "#" + self.username + "#" + username1
+            elif "#" + username1 + "#" + self.username in chatrooms:
+                response = "chatroom-exists\n" + "#" + username1 + "#" + self.username
+            else:
+                chatrooms.create("#" + self.username + "#" + username1)
+                response = "success\n" + "#" + self.username + "#" + username1
 
+        elif message[0] == "CHATROOM-JOIN":
+            # a peer is in one chatroom at a time
+            if self.chatroom is not None and self.chatroom != message[1]:
+                leaveRoom(self.chatroom, self.username)
+                self.chatroom = None
+            others = chatrooms.join(message[1], self.username)
+            if others is None:
+                response = "chatroom-not-found"
+            elif useRelay(message[1], others):
+                # the room is too big for a mesh, the peer only connects to the relay
+                response = "chatroom-join-relay\n{},{}".format(relay.host, relay.port)
+                self.chatroom = message[1]
+            else:
+                response = "chatroom-join-success"
+                for user in others:
+                    peer_info = presence.address(user)
+                    if peer_info is not None:
+                        response = "{}\n{},{}".format(response, peer_info[0], peer_info[1])
+                self.chatroom = message[1]
 
-# implementation of the udp server thread for clients
-class UDPServer(threading.Thread):
-    # udp server thread initializations
-    def __init__(self, username, clientSocket):
-        threading.Thread.__init__(self)
+        # pushed to the recipient if it is online, queued until it logs in otherwise
+        elif message[0] == "PRIVATE-MESSAGE":
+            if self.username is None or len(message) < 3:
+                response = "private-message-invalid"
+            else:
+                response = privateMessage(self.username, message[1], message[2])
+
+        # sent by the peer once it quit its chatroom, no response
+        elif message[0] == "chatroom-leave-request":
+            if self.chatroom is not None:
+                leaveRoom(self.chatroom, self.username)
+                self.chatroom = None
+
+        # the router sends the secret it shares with its shards first, no response
+        elif message[0] == "SHARD-AUTH" and shardMode:
+            self.isRouter = len(message) > 1 and hmac.compare_digest(message[1].encode(), shardSecret)
+            if not self.isRouter:
+                log.warning("%s:%s sent a wrong shard secret", self.ip, self.port, extra={"peer": self.ip})
+        # only the router of a sharded registry sends these, see shards.py
+        elif message[0] in SHARD_COMMANDS and shardMode:
+            if self.isRouter:
+                response = self.handleShardCommand(message)
+            else:
+                response = "shard-unauthorized"
+
+        if response is not None:
+            log.debug("Send to %s:%s -> %s", self.ip, self.port, response, extra={"peer": self.ip})
+        return response
+
+    # answers resume-success with the next token, and the chatroom on a second
+    # line if the peer was put back in one, or resume-invalid
+    def resume(self, username, token, port):
+        # a session logged in as another user cannot take this one up
+        if self.username is not None and self.username != username:
+            return "resume-invalid"
+        # the token is only used up once the login succeeded
+        valid, room = tokens.check(username, token)
+        if not valid:
+            return "resume-invalid"
+        # the connection of the session may have dropped before its hellos stopped
+        previous = presence.session(username)
+        if previous is not None and previous is not self:
+            presence.logout(username, previous)
+            room = previous.chatroom
+            previous.chatroom = None
+            previous.isOnline = False
+            previous.closeConnection()
+        if not presence.login(username, self.ip, port, self):
+            return "login-online"
+        # another resume with the same token may have won meanwhile
+        if not tokens.resume(username, token)[0]:
+            presence.logout(username, self)
+            return "resume-invalid"
         self.username = username
-        # timer thread for the udp server is initialized
-        self.timer = threading.Timer(3, self.waitHelloMessage)
-        self.tcpClientSocket = clientSocket
-
-    # if hello message is not received before timeout
-    # then peer is disconnected
-    def waitHelloMessage(self):
-        if self.username is not None:
-            db.user_logout(self.username)
-            if self.username in tcpThreads:
-                del tcpThreads[self.username]
+        liveness.touch(username)
+        response = "resume-success " + tokens.issue(username)
+        # a shard does not know the rooms of its users, the router joins them
+        if room is not None and not shardMode and chatrooms.join(room, username) is not None:
+            self.chatroom = room
+            response += "\n" + room
+        log.info("%s:%s resumed its session", self.ip, self.port, extra={"user": username})
+        return response
+
+    # processes a command of the shard router; the router places every user
+    # and every chatroom on one shard, and combines the answers of the shards
+    def handleShardCommand(self, message):
+        response = None
+        # address of the peer behind the router, used by its LOGIN, no response
+        if message[0] == "PEER-ADDRESS":
+            self.ip = message[1]
+            self.legacyPeer = len(message) > 2 and message[2] == "legacy"
+        # joins a user of any shard to a room of this shard, answers the other members
+        elif message[0] == "ROOM-JOIN":
+            others = chatrooms.join(message[1], message[2])
+            if others is None:
+                response = "chatroom-not-found"
+            else:
+                response = " ".join(["room-join-success"] + others)
+        elif message[0] == "ROOM-LEAVE":
+            leaveRoom(message[1], message[2])
+            response = "room-leave-success"
+        elif message[0] == "ROOM-EXISTS":
+            response = "room-exists" if message[1] in chatrooms else "room-not-found"
+        # creates any room, private ones included
+        elif message[0] == "ROOM-CREATE":
+            response = "room-create-success" if chatrooms.create(message[1]) else "chatroom-exists"
+        # answers username,host,port of the online ones among the usernames
+        elif message[0] == "ADDRESSES":
+            response = "addresses"
+            for username in message[1:]:
+                peer_info = presence.address(username)
+                if peer_info is not None:
+                    response = "{} {},{},{}".format(response, username, peer_info[0], peer_info[1])
+        # a page of the accounts in order, "username password" lines after the cursor line
+        elif message[0] == "ACCOUNTS-EXPORT":
+            limit, after, prefix = pageOptions(message[1:])
+            accounts = db.export_accounts(after, limit)
+            cursor = accounts[-1][0] if len(accounts) == limit else "-"
+            response = "\n".join(
+                ["accounts-page " + cursor] + ["{} {}".format(username, password.decode()) for username, password in accounts]
+            )
+        # takes username password pairs
+        elif message[0] == "ACCOUNTS-IMPORT":
+            accounts = [(message[i], message[i + 1].encode()) for i in range(1, len(message) - 1, 2)]
+            response = "accounts-import-success {}".format(db.bulk_register(accounts))
+        elif message[0] == "ACCOUNTS-DELETE":
+            response = "accounts-delete-success {}".format(db.delete_accounts(message[1:]))
+        # every room with its members, one "room member..." line each
+        elif message[0] == "ROOMS-EXPORT":
+            response = "\n".join(
+                ["rooms-export"] + [" ".join([room] + chatrooms.roomMembers(room)) for room in list(chatrooms.members)]
+            )
+        elif message[0] == "ROOMS-IMPORT":
+            chatrooms.create(message[1])
+            for username in message[2:]:
+                chatrooms.join(message[1], username)
+            response = "rooms-import-success"
+        elif message[0] == "ROOMS-DELETE":
+            chatrooms.delete(message[1])
+            with relayLock:
+                relayRooms.discard(message[1])
+            response = "rooms-delete-success"
+        # the storage of the accounts, the router only moves accounts between shards of different storages
+        elif message[0] == "STORAGE":
+            response = "storage " + db.storage_location()
+        # a PRIVATE-MESSAGE of a user that logged in on another shard
+        elif message[0] == "PRIVATE-MESSAGE-FROM":
+            response = privateMessage(message[1], message[2], message[3]) if len(message) == 4 else "private-message-invalid"
+        return response
+
+
+# decides if a peer that joined the room, whose other members are given, goes
+# through the relay; a room switches from mesh to relay once it reaches
+# relayThreshold members, the relay is then bridged to the peers already in
+# the mesh so both halves see every message
+def useRelay(room, others):
+    if relay is None:
+        return False
+    with relayLock:
+        if room in relayRooms:
+            return True
+        if len(others) + 1 < relayThreshold:
+            return False
+        relayRooms.add(room)
+    addresses = [address for address in map(presence.address, others) if address is not None]
+    relay.bridge(room, addresses)
+    return True
+
+
+# removes the user from the room, a room left empty goes back to a mesh
+def leaveRoom(room, username):
+    if chatrooms.leave(room, username) == 0:
+        with relayLock:
+            relayRooms.discard(room)
+
+
+# removes a user that logged out or timed out from all of its rooms
+def leaveRooms(username):
+    for room, remaining in chatrooms.leaveAll(username):
+        if remaining == 0:
+            with relayLock:
+                relayRooms.discard(room)
+
+
+# pushes a private message to the online recipient, or queues it until the
+# recipient logs in, or is online on a connection that reads pushes; answers
+# private-message-delivered, -queued, -queue-full, -user-not-found or -too-long
+def privateMessage(sender, recipient, content):
+    if len(content) > MAX_MESSAGE_LENGTH:
+        return "private-message-too-long"
+    session = presence.session(recipient)
+    if session is not None and session.readsPushes():
+        try:
+            session.sendResponse(formatPrivateMessages([(sender, content, time.time())]))
+            return "private-message-delivered"
+        except OSError:
+            # the recipient is going offline, its connection is closed
+            pass
+    elif session is None and not db.is_account_exist(recipient):
+        return "private-message-user-not-found"
+    if offline.put(recipient, sender, content):
+        return "private-message-queued"
+    return "private-message-queue-full"
+
+
+# takes the messages queued for the user as one private-messages push, None if there are none
+def takeOfflineMessages(username):
+    if username not in offline:
+        return None
+    messages = offline.take(username)
+    return formatPrivateMessages(messages) if messages else None
+
+
+# This class is used to process the peer messages sent to registry
+# for each peer connected to registry, a new client thread is created
+class ClientThread(ClientSession, threading.Thread):
+    # initializations for client thread
+    def __init__(self, ip, port, tcpClientSocket):
+        threading.Thread.__init__(self)
+        ClientSession.__init__(self, ip, port)
+        # socket of the peer
+        self.tcpClientSocket = tcpClientSocket
+        # responses of this thread and pushed deltas of the feeds are sent one at a time
+        self.sendLock = threading.Lock()
+
+    # main of the thread
+    def run(self):
+        log.info("Connection from %s:%s", self.ip, self.port, extra={"peer": self.ip})
+
+        # framed or legacy text protocol is negotiated from the first bytes of the
+        # peer, binary chat messages are only sent between peers
+        self.connection = protocol.MessageSocket.accept(self.tcpClientSocket, protocol.TEXT_VERSION)
+        while self.isOnline:
+            try:
+                # waits for incoming messages from peers, one read may hold several of them
+                texts = self.connection.receiveMany()
+                if not texts:
+                    break
+                responses = self.handleMessages(texts)
+                with self.sendLock:
+                    self.connection.sendMany(responses)
+            except OSError as oErr:
+                log.error("OSError: %s", oErr, extra={"peer": self.ip})
+                break
+            except protocol.ProtocolError as pErr:
+                log.error("ProtocolError: %s", pErr, extra={"peer": self.ip})
+                break
+        self.unsubscribeAll()
+        self.closeConnection()
+
+    def sendResponse(self, response):
+        with self.sendLock:
+            self.connection.send(response)
+
+    def readsPushes(self):
+        return self.connection.codec.mode == protocol.FRAMED and ClientSession.readsPushes(self)
+
+    # may be called from the liveness thread while this thread waits in recv,
+    # shutdown wakes it up before the socket is closed
+    def closeConnection(self):
+        try:
+            self.tcpClientSocket.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
         self.tcpClientSocket.close()
-        print("Removed " + self.username + " from online peers")
-        
 
-    # resets the timer for udp server
-    def resetTimer(self):
-        self.timer.cancel()
-        self.timer = threading.Timer(3, self.waitHelloMessage)
-        self.timer.start()
 
+# Session of a peer served by the asyncio registry, all sessions share
+# one event loop
+class AsyncClientSession(ClientSession):
+    # initializations for asyncio client session
+    def __init__(self, ip, port, reader, writer, loop):
+        ClientSession.__init__(self, ip, port)
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        # framed or legacy text protocol is negotiated from the first bytes of the
+        # peer, binary chat messages are only sent between peers
+        self.codec = protocol.MessageCodec(version=protocol.TEXT_VERSION)
+
+    # main of the session, reads and processes messages until the peer leaves
+    async def run(self):
+        log.info("Connection from %s:%s", self.ip, self.port, extra={"peer": self.ip})
+        while self.isOnline:
+            try:
+                data = await self.reader.read(protocol.RECV_SIZE)
+                if not data:
+                    break
+                texts = self.codec.feed(data)
+                reply = self.codec.takeHandshakeReply()
+                if reply:
+                    self.writer.write(reply)
+                # database and bcrypt work is done on the worker pool
+                if needsWorker(texts):
+                    responses = await self.loop.run_in_executor(blockingExecutor, self.handleMessages, texts)
+                else:
+                    await self.prefetchAccounts(texts)
+                    responses = self.handleMessages(texts)
+                if responses:
+                    self.writer.write(self.codec.encode(responses))
+                await self.writer.drain()
+            except OSError as oErr:
+                log.error("OSError: %s", oErr, extra={"peer": self.ip})
+                break
+            except protocol.ProtocolError as pErr:
+                log.error("ProtocolError: %s", pErr, extra={"peer": self.ip})
+                break
+        self.unsubscribeAll()
+        self.closeConnection()
+
+    # loads the accounts the messages look up into the account cache without
+    # blocking the loop, so handling the messages finds them in memory
+    async def prefetchAccounts(self, texts):
+        for text in texts:
+            message = text.split()
+            if len(message) > 1 and message[0] in ACCOUNT_LOOKUP_COMMANDS:
+                await asyncDb.find_account(message[1])
+
+    # the write is done on the loop, the feeds push from their own threads
+    def sendResponse(self, response):
+        self.loop.call_soon_threadsafe(self._write, self.codec.encode([response]))
+
+    def readsPushes(self):
+        return self.codec.mode == protocol.FRAMED and ClientSession.readsPushes(self)
+
+    def _write(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    # may be called from a worker thread when the hello timeout expires
+    def closeConnection(self):
+        self.loop.call_soon_threadsafe(self._closeWriter)
+
+    def _closeWriter(self):
+        if not self.writer.is_closing():
+            self.writer.close()
+
+
+# Tracks the last hello of every logged in peer on a hashed timer wheel.
+# A peer sits in the slot of the tick its deadline falls in; a hello moves it
+# to a later slot, so touching a peer is O(1) and creates no timers or threads.
+# A single sweeper empties the slots whose tick has passed and returns the
+# peers that expired there as one batch.
+class LivenessTracker:
+    def __init__(self, timeout=HELLO_TIMEOUT, tick=LIVENESS_TICK):
+        self.timeout = timeout
+        self.tick = tick
+        # a few slots more than the timeout spans, so a deadline never wraps onto the slot being swept
+        self.slotCount = int(timeout / tick) + 3
+        self.slots = [set() for _ in range(self.slotCount)]
+        # username -> (last seen time, tick of its deadline)
+        self.peers = {}
+        self.lastSweptTick = None
+        self.lock = threading.Lock()
+
+    # records a hello (or a login) of the peer
+    def touch(self, username, now=None):
+        if now is None:
+            now = time.monotonic()
+        deadlineTick = int((now + self.timeout) / self.tick) + 1
+        with self.lock:
+            previous = self.peers.get(username)
+            if previous is not None:
+                self.slots[previous[1] % self.slotCount].discard(username)
+            self.peers[username] = (now, deadlineTick)
+            self.slots[deadlineTick % self.slotCount].add(username)
+            if self.lastSweptTick is None:
+                self.lastSweptTick = int(now / self.tick)
+
+    # records the hellos of a batch of peers with one clock read and one lock
+    def touchMany(self, usernames, now=None):
+        if now is None:
+            now = time.monotonic()
+        deadlineTick = int((now + self.timeout) / self.tick) + 1
+        deadlineSlot = self.slots[deadlineTick % self.slotCount]
+        entry = (now, deadlineTick)
+        with self.lock:
+            for username in usernames:
+                previous = self.peers.get(username)
+                if previous is not None:
+                    self.slots[previous[1] % self.slotCount].discard(username)
+                self.peers[username] = entry
+                deadlineSlot.add(username)
+            if self.lastSweptTick is None:
+                self.lastSweptTick = int(now / self.tick)
+
+    # stops tracking the peer, used when it logs out
+    def remove(self, username):
+        with self.lock:
+            previous = self.peers.pop(username, None)
+            if previous is not None:
+                self.slots[previous[1] % self.slotCount].discard(username)
+
+    def __contains__(self, username):
+        return username in self.peers
+
+    def __len__(self):
+        return len(self.peers)
+
+    # empties every slot whose tick has passed, returns the expired usernames
+    def sweep(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        currentTick = int(now / self.tick)
+        expired = []
+        with self.lock:
+            if self.lastSweptTick is None:
+                self.lastSweptTick = currentTick
+                return expired
+            # after a long stall every slot is due, one pass over the wheel is enough
+            firstTick = max(self.lastSweptTick + 1, currentTick - self.slotCount + 1)
+            for tick in range(firstTick, currentTick + 1):
+                slot = self.slots[tick % self.slotCount]
+                due = [username for username in slot if self.peers[username][1] <= currentTick]
+                for username in due:
+                    slot.discard(username)
+                    del self.peers[username]
+                expired.extend(due)
+            self.lastSweptTick = currentTick
+        return expired
+
+
+# logs out the peers whose hello messages stopped, and closes their connections
+def expireSessions(usernames):
+    for username in usernames:
+        session = presence.logout(username)
+        leaveRooms(username)
+        if session is not None:
+            # a peer that only lost its link for a moment may resume with its token
+            tokens.suspend(username, session.chatroom)
+            session.closeConnection()
+        log.info("Removed %s from online peers", username, extra={"user": username})
+
+
+# sweeper of the threaded registry, the only thread used for hello timeouts
+class LivenessThread(threading.Thread):
+    def __init__(self, tracker):
+        threading.Thread.__init__(self, daemon=True)
+        self.tracker = tracker
+
+    def run(self):
+        while True:
+            time.sleep(self.tracker.tick)
+            expired = self.tracker.sweep()
+            if expired:
+                expireSessions(expired)
+
+
+# sweeper of the asyncio registry
+async def sweepLiveness(tracker):
+    while True:
+        await asyncio.sleep(tracker.tick)
+        expired = tracker.sweep()
+        if expired:
+            expireSessions(expired)
 
-# tcp and udp server port initializations
-print(f"{Fore.RED}Registry started...{Fore.RESET}")
-port = 16600
-portUDP = 16500
 
-# db initialization
-db = db.DB()
+# Reads the hello datagrams of the udp socket in batches: every wakeup drains
+# the datagrams waiting on the non-blocking socket into one reusable buffer,
+# and the online senders are marked alive with one update of the tracker.
+# Usernames are decoded once and then found by their bytes.
+class HelloReceiver:
+    def __init__(self, batchSize=HELLO_BATCH_SIZE):
+        self.batchSize = batchSize
+        self.buffer = bytearray(HELLO_DATAGRAM_SIZE)
+        self.view = memoryview(self.buffer)
+        # username bytes -> username, of online peers that sent a hello
+        self.names = {}
+        self.datagrams = 0
+
+    # reads the waiting datagrams, up to a batch, returns how many were read;
+    # failed reads count toward the batch, so a broken socket cannot spin here
+    def drain(self, udpSocket):
+        start = time.perf_counter()
+        usernames = set()
+        count = 0
+        errors = 0
+        while count + errors < self.batchSize:
+            try:
+                size, clientAddress = udpSocket.recvfrom_into(self.buffer)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as err:
+                # an icmp error of an earlier send, the next datagram is still there
+                log.debug("Receiving a hello failed: %s", err)
+                errors += 1
+                continue
+            count += 1
+            username = self.parse(size)
+            if username is not None:
+                usernames.add(username)
+        self.datagrams += count
+        if usernames:
+            liveness.touchMany(usernames)
+            # a message queued while its recipient was logging in is delivered with the next hello
+            for username in usernames:
+                if username in offline:
+                    self.deliver(username)
+            log.info("Hello is received from %d peers", len(usernames),
+                     extra={"category": "hello", "datagrams": count})
+        if metrics is not None and count:
+            metrics.observe("command_seconds", "HELLO", time.perf_counter() - start)
+        return count
+
+    def deliver(self, username):
+        session = presence.session(username)
+        push = takeOfflineMessages(username) if session is not None and session.readsPushes() else None
+        if push is not None:
+            try:
+                session.sendResponse(push)
+            except OSError as err:
+                log.error("Delivering the private messages of %s failed: %s", username, err)
+
+    # returns the online user a datagram of the buffer is the hello of, or None
+    def parse(self, size):
+        if size <= len(HELLO_PREFIX) or not self.buffer.startswith(HELLO_PREFIX):
+            return None
+        key = bytes(self.view[len(HELLO_PREFIX):size]).strip()
+        username = self.names.get(key)
+        if username is None:
+            fields = key.split()
+            if not fields:
+                return None
+            try:
+                username = fields[0].decode()
+            except UnicodeDecodeError:
+                return None
+            if username not in presence:
+                return None
+            # names of peers that logged out stay until the cache outgrows the online peers
+            if len(self.names) > 2 * len(presence) + 1024:
+                self.names.clear()
+            self.names[key] = username
+        elif username not in presence:
+            return None
+        return username
+
+
+# binds the non-blocking udp socket the hello messages are received on
+def helloSocket(host, portUDP):
+    udpSocket = socket(AF_INET, SOCK_DGRAM)
+    udpSocket.bind((host, portUDP))
+    udpSocket.setblocking(False)
+    return udpSocket
+
+
+# accepts a tcp connection of a peer and starts its client thread
+def acceptClientThread(tcpSocket):
+    tcpClientSocket, addr = tcpSocket.accept()
+    newThread = ClientThread(addr[0], addr[1], tcpClientSocket)
+    newThread.start()
+
+
+# serves the registry with one thread per tcp connection
+def runThreaded(host, port, portUDP):
+    # tcp and udp socket initializations
+    tcpSocket = socket(AF_INET, SOCK_STREAM)
+    tcpSocket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    tcpSocket.bind((host, port))
+    udpSocket = helloSocket(host, portUDP)
+    tcpSocket.listen(5)
+
+    # sockets that are listened, each registered with its handler
+    selector = selectors.DefaultSelector()
+    selector.register(tcpSocket, selectors.EVENT_READ, acceptClientThread)
+    selector.register(udpSocket, selectors.EVENT_READ, helloReceiver.drain)
+
+    LivenessThread(liveness).start()
+    if relay is not None:
+        relay.startInThread()
+
+    print(f"{Fore.RED} Listening for incoming connections... {Fore.RESET}")
+    # as long as at least a socket exists to listen registry runs
+    while selector.get_map():
+        # monitors for the incoming connections and hello messages
+        for key, events in selector.select():
+            key.data(key.fileobj)
+
+    # registry tcp socket is closed
+    tcpSocket.close()
+
+
+# serves the registry, tcp sessions and udp hello messages, from a single event loop
+async def runAsync(host, port, portUDP, backlog):
+    loop = asyncio.get_running_loop()
+
+    async def acceptClient(reader, writer):
+        addr = writer.get_extra_info("peername")
+        session = AsyncClientSession(addr[0], addr[1], reader, writer, loop)
+        await session.run()
+
+    server = await asyncio.start_server(acceptClient, host, port, backlog=backlog, reuse_address=True)
+    udpSocket = helloSocket(host, portUDP)
+    loop.add_reader(udpSocket, helloReceiver.drain, udpSocket)
+    sweeper = asyncio.create_task(sweepLiveness(liveness))
+    if relay is not None:
+        await relay.start()
+    print(f"{Fore.RED} Listening for incoming connections (asyncio)... {Fore.RESET}")
+    async with server:
+        await server.serve_forever()
+
 
 # gets the ip address of this peer
 # first checks to get it for windows devices
 # if the device that runs this application is not windows
 # it checks to get it for macos devices
-hostname = gethostname()
-try:
-    host = gethostbyname(hostname)
-except gaierror:
-    import netifaces as ni
+def getHostAddress():
+    hostname = gethostname()
+    try:
+        return gethostbyname(hostname)
+    except gaierror:
+        import netifaces as ni
+
+        return ni.ifaddresses("en0")[ni.AF_INET][0]["addr"]
 
-    host = ni.ifaddresses("en0")[ni.AF_INET][0]["addr"]
 
-print(f"{Fore.RED}Registry IP address: {Fore.RESET}" + f" {host}{Fore.RESET}")
-print(f"{Fore.RED}Registry port number: {Fore.RESET}" + f"{str(port)}{Fore.RESET}")
+# db initialization, in memory until main sets the backend chosen with --db,
+# so the registry runs without pymongo when mongo is not chosen
+db = db.DB("memory")
 
-# onlinePeers list for online account
-onlinePeers = {}
-# chatrooms list for available chatrooms
-chatrooms = {}
+# write-behind of presence changes to db.online_peers, and the
+# in-memory presence index of online accounts and their sessions
+writeBehind = WriteBehindQueue(db)
+# changes of the users and the chatroom list pushed to the subscribed peers
+userFeed = DeltaFeed(formatUsersDelta)
+roomFeed = DeltaFeed(formatRoomsDelta)
+feeds = {"users": userFeed, "rooms": roomFeed}
+presence = PresenceIndex(writeBehind, userFeed)
+# available chatrooms and their members
+chatrooms = RoomRegistry(feed=roomFeed)
 # accounts list for accounts
 accounts = {}
-# tcpThreads list for online client's thread
-tcpThreads = {}
+# last hello of every online peer
+liveness = LivenessTracker()
+# reads the hello datagrams of the udp socket
+helloReceiver = HelloReceiver()
+# private messages waiting for their offline recipients, replaced by the configured one in main
+offline = OfflineQueue()
+# tokens of the sessions peers may resume, replaced by the configured one in main
+tokens = SessionTokens()
 
-# tcp and udp socket initializations
-tcpSocket = socket(AF_INET, SOCK_STREAM)
-udpSocket = socket(AF_INET, SOCK_DGRAM)
-tcpSocket.bind((host, port))
-udpSocket.bind((host, portUDP))
-tcpSocket.listen(5)
+# pool that hashes and checks passwords, replaced by the configured one in main
+passwordHasher = PasswordHasher()
+# worker pool of the asyncio registry for database and bcrypt work
+blockingExecutor = None
+# awaitable database front of the asyncio registry
+asyncDb = None
+# chatroom relay, None keeps every room a full mesh of peer connections
+relay = None
+# rooms of at least this many members are served by the relay
+relayThreshold = RELAY_THRESHOLD
+# rooms that switched from mesh to relay
+relayRooms = set()
+relayLock = threading.Lock()
+# set when this process is a shard of a sharded registry, behind shards.py
+shardMode = False
+# secret of the router, set with --shard
+shardSecret = None
+# counters, histograms and gauges of the metrics endpoint, None when it is off
+metrics = None
 
-# input sockets that are listened
-inputs = [tcpSocket, udpSocket]
 
-# log file initialization
-logging.basicConfig(filename="registry.log", level=logging.INFO)
+# exposes the command latencies, response counts and the state of this
+# registry on http://host:port/metrics in the Prometheus text format
+def startMetrics(host, port):
+    global metrics
+    registryMetrics = Metrics("registry")
+    registryMetrics.histogram("command_seconds", "Time to process a command or a batch of HELLO datagrams, by command", "command")
+    registryMetrics.counter("responses_total", "Responses sent, by their first word", "response")
+    registryMetrics.histogram("db_operation_seconds", "Time of a storage operation, by operation", "operation",
+                              db.latency_histograms)
+    passwordHasher.histograms = {"hash": LatencyHistogram(), "check": LatencyHistogram()}
+    registryMetrics.histogram("bcrypt_seconds", "Time of a bcrypt hash or check, waiting for a worker included",
+                              "operation", passwordHasher.histograms)
+    registryMetrics.gauge("online_peers", "Peers logged in", lambda: len(presence))
+    registryMetrics.gauge("liveness_tracked_peers", "Peers with a hello deadline on the timer wheel",
+                          lambda: len(liveness))
+    registryMetrics.gauge("hello_datagrams_total", "Hello datagrams received", lambda: helloReceiver.datagrams,
+                          kind="counter")
+    registryMetrics.gauge("threads", "Threads of the registry process", threading.active_count)
+    registryMetrics.gauge("chatrooms", "Chatrooms", lambda: len(chatrooms))
+    registryMetrics.gauge("session_tokens", "Session tokens a peer may resume its session with", lambda: len(tokens))
+    registryMetrics.gauge("offline_messages", "Private messages waiting for their recipients", lambda: len(offline))
+    registryMetrics.gauge("write_behind_pending", "Presence changes not yet written to the database",
+                          lambda: writeBehind.queue.qsize())
+    registryMetrics.gauge("account_cache_lookups_total", "Account cache lookups, by result",
+                          lambda: {"hit": db.cache_stats()["hits"], "miss": db.cache_stats()["misses"]},
+                          "result", "counter")
+    startMetricsServer(registryMetrics, host, port)
+    metrics = registryMetrics
 
-# as long as at least a socket exists to listen registry runs
-while inputs:
-    print(f"{Fore.RED} Listening for incoming connections... {Fore.RESET}")
-    # monitors for the incoming connections
-    readable, writable, exceptional = select.select(inputs, [], [])
-    for s in readable:
-        # if the message received comes to the tcp socket
-        # the connection is accepted and a thread is created for it, and that thread is started
-        if s is tcpSocket:
-            tcpClientSocket, addr = tcpSocket.accept()
-            newThread = ClientThread(addr[0], addr[1], tcpClientSocket)
-            newThread.start()
-        # if the message received comes to the udp socket
-        elif s is udpSocket:
-            # received the incoming udp message and parses it
-            message, clientAddress = s.recvfrom(1024)
-            message = message.decode().split()
-            # checks if it is a hello message
-            if message[0] == "HELLO":
-                # checks if the account that this hello message
-                # is sent from is online
-                if message[1] in tcpThreads:
-                    # resets the timeout for that peer since the hello message is received
-                    tcpThreads[message[1]].resetTimeout()
-                    print("Hello is received from " + message[1])
-                    logging.info(
-                        "Received from " + clientAddress[0] + ":" + str(clientAddress[1]) + " -> " + " ".join(message)
-                    )
-
-# registry tcp socket is closed
-tcpSocket.close()
+
+def main():
+    global blockingExecutor, passwordHasher, asyncDb, relay, relayThreshold, chatrooms, shardMode, shardSecret, offline, tokens
+
+    parser = argparse.ArgumentParser(description="P2P chat registry")
+    parser.add_argument("--mode", choices=["thread", "asyncio"], default="thread",
+                        help="serve each peer with its own thread, or all peers from one event loop")
+    parser.add_argument("--host", default=None, help="address to bind, defaults to the address of this host")
+    parser.add_argument("--port", type=int, default=16600)
+    parser.add_argument("--udp-port", type=int, default=16500)
+    parser.add_argument("--workers", type=int, default=8,
+                        help="worker threads for database and bcrypt work in asyncio mode")
+    parser.add_argument("--backlog", type=int, default=1024)
+    parser.add_argument("--db", choices=["mongo", "sqlite", "memory"], default=None,
+                        help="storage backend, defaults to $P2P_DB_BACKEND or mongo")
+    parser.add_argument("--db-path", default=None, help="database file of the sqlite backend")
+    parser.add_argument("--db-name", default=MONGO_DATABASE, help="database of the mongo backend")
+    parser.add_argument("--db-pool-size", type=int, default=100, help="connections of the mongo pool")
+    parser.add_argument("--db-timeout-ms", type=int, default=5000,
+                        help="server selection, connect, socket and pool wait timeout of mongo")
+    parser.add_argument("--db-write-concern", default=None, help='mongo write concern, e.g. 1 or "majority"')
+    parser.add_argument("--db-read-preference", default=None, help="mongo read preference, e.g. secondaryPreferred")
+    parser.add_argument("--hash-workers", type=int, default=4, help="size of the bcrypt pool")
+    parser.add_argument("--hash-queue", type=int, default=64,
+                        help="bcrypt jobs queued or running before server-busy is replied")
+    parser.add_argument("--hash-processes", action="store_true", help="run bcrypt in processes instead of threads")
+    parser.add_argument("--bcrypt-rounds", type=int, default=DEFAULT_ROUNDS, help="bcrypt cost factor of new accounts")
+    parser.add_argument("--shard", action="store_true",
+                        help="run as a shard behind the router of shards.py; only connections that send "
+                             "the router's secret, $" + protocol.SHARD_SECRET_ENV + ", may use its shard commands")
+    parser.add_argument("--persist-rooms", action="store_true",
+                        help="save the chatrooms in the database, so they are back after a restart")
+    parser.add_argument("--relay-port", type=int, default=None,
+                        help="serve big chatrooms through a relay on this port, rooms stay a full mesh without it")
+    parser.add_argument("--relay-threshold", type=int, default=RELAY_THRESHOLD,
+                        help="members from which a chatroom switches from mesh to relay")
+    parser.add_argument("--history-dir", default=None,
+                        help="keep the messages of the rooms served by the relay in logs under this directory, "
+                             "--relay-threshold 1 serves every room by the relay")
+    parser.add_argument("--history-retention", type=float, default=RETENTION_SECONDS,
+                        help="seconds the messages of the history are kept")
+    parser.add_argument("--offline-max-messages", type=int, default=MAX_MESSAGES_PER_USER,
+                        help="private messages queued for an offline user, more are refused")
+    parser.add_argument("--offline-ttl", type=float, default=MESSAGE_TTL,
+                        help="seconds a private message waits for its offline recipient")
+    parser.add_argument("--token-ttl", type=int, default=TOKEN_TTL,
+                        help="seconds a session token is valid, the secret is $P2P_SESSION_SECRET or random")
+    parser.add_argument("--resume-window", type=float, default=RESUME_WINDOW,
+                        help="seconds after a hello timeout during which a peer may resume its session")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics on this port, nothing is measured without it")
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="address of the metrics endpoint")
+    parser.add_argument("--log-file", default="registry.log", help="JSON lines log, rotated by size")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="DEBUG also logs every response")
+    parser.add_argument("--log-max-bytes", type=int, default=LOG_MAX_BYTES, help="size at which the log is rotated")
+    parser.add_argument("--log-backups", type=int, default=LOG_BACKUPS, help="rotated logs kept")
+    parser.add_argument("--hello-log-rate", type=float, default=CATEGORY_RATES["hello"],
+                        help="hello records logged per second, the others are counted in the next one")
+    parser.add_argument("--log-console", action="store_true", help="also print the log records on the terminal")
+    args = parser.parse_args()
+
+    # tcp and udp server port initializations
+    print(f"{Fore.RED}Registry started...{Fore.RESET}")
+    host = args.host if args.host is not None else getHostAddress()
+
+    print(f"{Fore.RED}Registry IP address: {Fore.RESET}" + f" {host}{Fore.RESET}")
+    print(f"{Fore.RED}Registry port number: {Fore.RESET}" + f"{str(args.port)}{Fore.RESET}")
+
+    # log file initialization, records are written by a listener thread
+    setupLogging(args.log_file, args.log_level, args.log_console, {"hello": args.hello_log_rate},
+                 args.log_max_bytes, args.log_backups)
+
+    passwordHasher = PasswordHasher(args.hash_workers, args.hash_queue, args.bcrypt_rounds, args.hash_processes)
+    backendName = args.db if args.db is not None else os.environ.get("P2P_DB_BACKEND", "mongo")
+    if backendName == "mongo":
+        db.set_backend(create_backend(
+            "mongo", database=args.db_name, pool_size=args.db_pool_size, timeout_ms=args.db_timeout_ms,
+            write_concern=args.db_write_concern, read_preference=args.db_read_preference,
+        ))
+    else:
+        db.set_backend(create_backend(backendName, args.db_path))
+    shardMode = args.shard
+    if shardMode:
+        secret = os.environ.get(protocol.SHARD_SECRET_ENV)
+        if not secret:
+            parser.error("--shard needs the secret of the router in ${}".format(protocol.SHARD_SECRET_ENV))
+        shardSecret = secret.encode()
+    db.ensure_indexes()
+    writeBehind.start()
+    offline = OfflineQueue(db, args.offline_max_messages, args.offline_ttl)
+    secret = os.environ.get("P2P_SESSION_SECRET")
+    tokens = SessionTokens(secret.encode() if secret else None, args.token_ttl, args.resume_window)
+    offline.load()
+    if args.persist_rooms:
+        chatrooms = RoomRegistry(db, roomFeed)
+        chatrooms.load()
+    userFeed.start()
+    roomFeed.start()
+    if args.relay_port is not None:
+        history = None
+        if args.history_dir is not None:
+            history = MessageHistory(args.history_dir, args.history_retention)
+        relay = RelayServer(host, args.relay_port, history=history)
+        relayThreshold = args.relay_threshold
+    if args.metrics_port is not None:
+        startMetrics(args.metrics_host, args.metrics_port)
+
+    if args.mode == "asyncio":
+        blockingExecutor = ThreadPoolExecutor(max_workers=args.workers)
+        asyncDb = AsyncDB(db, blockingExecutor)
+        asyncio.run(runAsync(host, args.port, args.udp_port, args.backlog))
+    else:
+        runThreaded(host, args.port, args.udp_port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+# Chatroom relay, fans the messages of a room out to its members so a peer
+# sends every message once instead of once per member
+import argparse
+import asyncio
+import logging
+import threading
+import protocol
+from history import MessageHistory, RETENTION_SECONDS
+from logs import setupLogging
+
+# outgoing bytes buffered for a member before it is disconnected as too slow
+HIGH_WATER_MARK = 1024 * 1024
+# seconds to connect and negotiate with a mesh peer that is bridged to the relay
+BRIDGE_TIMEOUT = 5
+# seconds between two passes of the history retention
+HISTORY_EXPIRE_INTERVAL = 60
+
+log = logging.getLogger("relay")
+
+
+# A connection of the relay, either a member that joined the room through
+# the relay, or a bridge to a peer that is still connected to the room mesh
+class RelayConnection:
+    def __init__(self, relay, reader, writer, codec, room=None, isBridge=False):
+        self.relay = relay
+        self.reader = reader
+        self.writer = writer
+        self.codec = codec
+        self.room = room
+        self.isBridge = isBridge
+        self.username = None
+
+    # reads and relays messages until the connection closes
+    async def run(self):
+        try:
+            while True:
+                data = await self.reader.read(protocol.RECV_SIZE)
+                if not data:
+                    break
+                messages = self.codec.feed(data)
+                reply = self.codec.takeHandshakeReply()
+                if reply:
+                    self.writer.write(reply)
+                for message in messages:
+                    if not self.handleMessage(message):
+                        return
+        except (OSError, protocol.ProtocolError) as err:
+            log.error("Relay connection failed: %s", err)
+        finally:
+            self.relay.removeConnection(self)
+            self.close()
+
+    # processes a message of the connection, returns False if it left; chat
+    # messages are fanned out as they came, binary ones without decoding again
+    def handleMessage(self, message):
+        fields = protocol.messageFields(message)
+        if fields[0] == "relay-join" and len(fields) > 2 and not self.isBridge:
+            self.room = fields[1]
+            self.username = fields[2]
+            self.relay.addConnection(self)
+            self.send("welcome")
+            self.relay.fanOut(self, "chatroom-join\n" + self.username)
+        elif fields[0] == "chat-message" and self.room is not None:
+            offset = self.relay.record(self.room, message)
+            self.relay.fanOut(self, message)
+            # a member is not sent its own message back, only the offset after
+            # it, a legacy one would read it together with the next message
+            if offset is not None and not self.isBridge and self.codec.mode == protocol.FRAMED:
+                self.send("relay-offset\n{}".format(offset + 1))
+        elif fields[0] == "relay-history" and len(fields) > 2 and self.room is not None and not self.isBridge:
+            self.sendHistory(fields[1], fields[2])
+        elif fields[0] == "chatroom-leave" and self.room is not None:
+            # a mesh peer parks its connections when it leaves, the members of
+            # the relay keep theirs, so only the leave itself is fanned out; a
+            # mesh peer would drop its bridge on the leave, it is not told
+            self.relay.fanOut(self, "\n".join(fields[:2]), bridges=False)
+            return False
+        return True
+
+    def send(self, message):
+        self.writeEncoded({}, message)
+
+    # sends the "last" count messages of the room or those "since" an offset,
+    # then relay-history-end with the offset of the next message of the room
+    def sendHistory(self, mode, value):
+        history = self.relay.history
+        try:
+            value = int(value)
+        except ValueError:
+            mode = None
+        if history is None or mode not in ("last", "since"):
+            self.send("relay-history-end\n-")
+            return
+        if mode == "last":
+            records, nextOffset = history.last(self.room, value)
+        else:
+            records, nextOffset = history.since(self.room, value)
+        names = {}
+        for offset, created, payload in records:
+            self.send(protocol.decodeChatMessage(payload, names))
+        self.send("relay-history-end\n{}".format(nextOffset))
+
+    # writes a message encoded for this connection, encodings are shared
+    # through the given dict so a fan-out encodes once per encoding
+    def writeEncoded(self, encodings, message):
+        data = encodings.get(self.codec.encoding)
+        if data is None:
+            data = self.codec.encode([message])
+            encodings[self.codec.encoding] = data
+        self.writer.write(data)
+        # a member that does not read its messages is disconnected instead of buffered forever
+        if self.writer.transport.get_write_buffer_size() > HIGH_WATER_MARK:
+            log.error("Relay disconnects slow member %s", self.username, extra={"user": self.username})
+            self.relay.removeConnection(self)
+            self.close()
+
+    def close(self):
+        if not self.writer.is_closing():
+            self.writer.close()
+
+
+# Relay of the chatrooms, run inside the registry or as its own process.
+# Writes never block, they are buffered by the transport of each member.
+# With a history, the chat messages of every room are also appended to its
+# log, in the order they are fanned out.
+class RelayServer:
+    def __init__(self, host, port, name="relay", history=None):
+        self.host = host
+        self.port = port
+        self.name = name
+        self.history = history
+        # room -> set of connections
+        self.rooms = {}
+        self.loop = None
+        self.server = None
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.acceptClient, self.host, self.port, reuse_address=True)
+        if self.history is not None:
+            self.loop.create_task(self.expireHistory())
+
+    # applies the retention of the history now and then
+    async def expireHistory(self):
+        while True:
+            try:
+                self.history.expire()
+            except OSError as err:
+                log.error("Relay history retention failed: %s", err)
+            await asyncio.sleep(HISTORY_EXPIRE_INTERVAL)
+
+    # appends a chat message to the log of the room, returns its offset or None
+    def record(self, room, message):
+        if self.history is None:
+            return None
+        if not isinstance(message, protocol.ChatMessage):
+            fields = protocol.messageFields(message)
+            message = protocol.ChatMessage(fields[1], "\n".join(fields[2:]))
+        try:
+            return self.history.append(room, message.binary())
+        except (OSError, protocol.ProtocolError) as err:
+            log.error("Relay could not record a message of %s: %s", room, err, extra={"room": room})
+            return None
+
+    async def serveForever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    # runs the relay on its own event loop thread, for the threaded registry
+    def startInThread(self):
+        started = threading.Event()
+
+        async def serve():
+            await self.start()
+            started.set()
+            await self.server.serve_forever()
+
+        threading.Thread(target=asyncio.run, args=(serve(),), daemon=True).start()
+        started.wait()
+
+    async def acceptClient(self, reader, writer):
+        connection = RelayConnection(self, reader, writer, protocol.MessageCodec())
+        await connection.run()
+
+    def addConnection(self, connection):
+        self.rooms.setdefault(connection.room, set()).add(connection)
+
+    def removeConnection(self, connection):
+        members = self.rooms.get(connection.room)
+        if members is not None:
+            members.discard(connection)
+            if not members:
+                del self.rooms[connection.room]
+
+    # sends a message of the sender to the rest of the room; a message that came
+    # over a bridge already reached the other mesh peers, so only members get
+    # it, and bridges=False keeps it from the mesh peers as well
+    def fanOut(self, sender, message, bridges=True):
+        encodings = {}
+        for connection in list(self.rooms.get(sender.room, ())):
+            if connection is sender or (connection.isBridge and (sender.isBridge or not bridges)):
+                continue
+            connection.writeEncoded(encodings, message)
+
+    # connects the relay to the peers of a room that is switched from mesh to
+    # relay, the relay joins their mesh as one more peer; safe to call from any thread
+    def bridge(self, room, addresses):
+        asyncio.run_coroutine_threadsafe(self.openBridges(room, addresses), self.loop)
+
+    async def openBridges(self, room, addresses):
+        await asyncio.gather(*[self.openBridge(room, host, port) for host, port in addresses])
+
+    async def openBridge(self, room, host, port):
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, int(port)), BRIDGE_TIMEOUT)
+            writer.write(protocol.handshake())
+            try:
+                reply = await asyncio.wait_for(reader.readexactly(protocol.HANDSHAKE_SIZE), BRIDGE_TIMEOUT)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                reply = b""
+            if len(reply) == protocol.HANDSHAKE_SIZE and reply.startswith(protocol.HANDSHAKE_MAGIC):
+                codec = protocol.MessageCodec(protocol.FRAMED, reply[len(protocol.HANDSHAKE_MAGIC)])
+            else:
+                codec = protocol.MessageCodec(protocol.LEGACY)
+        except (OSError, asyncio.TimeoutError) as err:
+            log.error("Relay could not bridge %s:%s: %s", host, port, err)
+            return
+        connection = RelayConnection(self, reader, writer, codec, room, isBridge=True)
+        connection.username = "{}:{}".format(host, port)
+        self.addConnection(connection)
+        connection.send("chatroom-join\n" + self.name)
+        await connection.run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="P2P chat relay")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=16700)
+    parser.add_argument("--history-dir", default=None, help="keep the messages of every room in logs under this directory")
+    parser.add_argument("--history-retention", type=float, default=RETENTION_SECONDS,
+                        help="seconds the messages of the history are kept")
+    args = parser.parse_args()
+    setupLogging("relay.log")
+    history = None
+    if args.history_dir is not None:
+        history = MessageHistory(args.history_dir, args.history_retention)
+    print("Relay listening on {}:{}".format(args.host, args.port))
+    asyncio.run(RelayServer(args.host, args.port, history=history).serveForever())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+# Chatroom registry of the registry
+import bisect
+import threading
+from presence import sortedPage
+
+
+# Members of every chatroom as sets, with the reverse index of the rooms of
+# every user, so a join or a leave is O(1) and a logout only visits the rooms
+# of that user. The CHATROOM-LIST response is built once and reused until a
+# room or a member count changes. Given a database, the rooms are saved when
+# created and loaded again when the registry starts. Member count changes go
+# to the feed of the chatroom list subscribers.
+class RoomRegistry:
+    def __init__(self, database=None, feed=None):
+        # room -> set of usernames
+        self.members = {}
+        # room names in order, for pages and prefix searches of the chatroom list
+        self.sortedRooms = []
+        # username -> set of rooms
+        self.userRooms = {}
+        self.lock = threading.RLock()
+        self.database = database
+        self.feed = feed
+        # cached CHATROOM-LIST response, None after a change
+        self.listingText = None
+
+    # loads the rooms saved in the database, their members are not kept
+    def load(self):
+        if self.database is None:
+            return
+        with self.lock:
+            for room in self.database.get_chatrooms():
+                if room not in self.members:
+                    self.members[room] = set()
+                    bisect.insort(self.sortedRooms, room)
+            self.listingText = None
+
+    # creates the room, returns False if it already exists
+    def create(self, room):
+        with self.lock:
+            if room in self.members:
+                return False
+            self.members[room] = set()
+            bisect.insort(self.sortedRooms, room)
+            self.changed(room, 0)
+        if self.database is not None:
+            self.database.create_chatroom(room)
+        return True
+
+    # deletes the room and returns its members, or None if it does not exist
+    def delete(self, room):
+        with self.lock:
+            members = self.members.pop(room, None)
+            if members is None:
+                return None
+            del self.sortedRooms[bisect.bisect_left(self.sortedRooms, room)]
+            for username in members:
+                rooms = self.userRooms.get(username)
+                if rooms is not None:
+                    rooms.discard(room)
+                    if not rooms:
+                        del self.userRooms[username]
+            self.listingText = None
+        if self.database is not None:
+            self.database.delete_chatroom(room)
+        return list(members)
+
+    # adds the user to the room and returns the other members,
+    # or None if the room does not exist
+    def join(self, room, username):
+        with self.lock:
+            members = self.members.get(room)
+            if members is None:
+                return None
+            others = [member for member in members if member != username]
+            if username not in members:
+                members.add(username)
+                self.userRooms.setdefault(username, set()).add(room)
+                self.changed(room, len(members))
+            return others
+
+    # removes the user from the room and returns the number of members left,
+    # or None if the user was not a member
+    def leave(self, room, username):
+        with self.lock:
+            members = self.members.get(room)
+            if members is None or username not in members:
+                return None
+            members.discard(username)
+            rooms = self.userRooms.get(username)
+            if rooms is not None:
+                rooms.discard(room)
+                if not rooms:
+                    del self.userRooms[username]
+            self.changed(room, len(members))
+            return len(members)
+
+    # removes the user from all of its rooms, used on logout and hello timeout,
+    # returns (room, members left) of every room the user left
+    def leaveAll(self, username):
+        with self.lock:
+            rooms = self.userRooms.pop(username, ())
+            left = []
+            for room in rooms:
+                members = self.members[room]
+                members.discard(username)
+                left.append((room, len(members)))
+                self.changed(room, len(members))
+            return left
+
+    # called under the lock when the member count of a room changed
+    def changed(self, room, count):
+        self.listingText = None
+        if self.feed is not None:
+            self.feed.publish(room, count)
+
+    # returns the members of the room
+    def roomMembers(self, room):
+        with self.lock:
+            return list(self.members.get(room, ()))
+
+    # returns the rooms the user is a member of
+    def roomsOf(self, username):
+        with self.lock:
+            return list(self.userRooms.get(username, ()))
+
+    def count(self, room):
+        members = self.members.get(room)
+        return 0 if members is None else len(members)
+
+    # returns the CHATROOM-LIST response, with the member count of every room
+    def listing(self):
+        text = self.listingText
+        if text is None:
+            with self.lock:
+                text = "chatroom-list-success" + "".join(
+                    ["\n{} : {}".format(room, len(members)) for room, members in self.members.items()]
+                )
+                self.listingText = text
+        return text
+
+    # returns a page of the rooms in order as "room : count" lines, and the cursor of the next page
+    def page(self, limit, after=None, prefix=""):
+        with self.lock:
+            rooms, cursor = sortedPage(self.sortedRooms, limit, after, prefix)
+            return ["{} : {}".format(room, len(self.members[room])) for room in rooms], cursor
+
+    def __contains__(self, room):
+        return room in self.members
+
+    def __len__(self):
+        return len(self.members)
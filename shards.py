@@ -0,0 +1,610 @@
+# Sharded deployment of the registry
+#
+# Several registry.py processes, started with --shard, each own a part of the
+# usernames and of the chatrooms, placed on them by consistent hashing. The
+# router below is what the peers connect to: it speaks the registry protocol,
+# sends every command to the shard that owns its username or chatroom, and
+# combines the answers of several shards where a command needs them (lists,
+# chatroom joins whose members live on other shards). HELLO datagrams are
+# forwarded to the shard of their user. A shard added to a running router
+# takes over its part of the accounts and chatrooms from the other shards, so
+# every shard keeps its accounts in a storage of its own.
+# The router proves itself to the shards with a secret they share, passed to
+# the shards in $P2P_SHARD_SECRET.
+import argparse
+import asyncio
+import bisect
+import collections
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import protocol
+from presence import pageOptions
+from logs import setupLogging
+
+# points of every shard on the ring, more points spread the keys more evenly
+VIRTUAL_NODES = 64
+# accounts moved per request while rebalancing
+REBALANCE_BATCH = 500
+# seconds the router waits for a shard to accept its connection
+CONNECT_TIMEOUT = 5
+# arguments the router reads of a command, one sent with fewer is answered <command>-invalid
+REQUIRED_ARGUMENTS = {"SEARCH": 1, "JOIN": 2, "LOGIN": 3, "CHATROOM-CREATE": 1, "PRIVATE-CHATROOM": 1,
+                      "CHATROOM-JOIN": 1, "SHARD-ADD": 1}
+# sqlite file, mongo database and log of a shard started by serve, by its port
+SHARD_DB_PATH = "registry-{}.db"
+SHARD_DB_NAME = "p2p-chat-phase-3-{}"
+SHARD_LOG_FILE = "registry-{}.log"
+# answers of an owner that, while a rebalance moves keys, are asked again of the previous owner
+MISSING_ANSWERS = {"search-user-not-found", "search-user-not-online", "login-account-not-exist", "chatroom-not-found",
+                   "private-message-user-not-found"}
+
+log = logging.getLogger("router")
+
+
+# A registry process of the sharded registry
+class Shard:
+    def __init__(self, host, port, portUDP):
+        self.host = host
+        self.port = int(port)
+        self.portUDP = int(portUDP)
+        self.name = "{}:{}".format(host, port)
+
+    # parses host:port:udpPort
+    @classmethod
+    def parse(cls, text):
+        host, port, portUDP = text.rsplit(":", 2)
+        return cls(host, port, portUDP)
+
+    def __repr__(self):
+        return "Shard({}:{})".format(self.name, self.portUDP)
+
+
+def hashKey(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+# Consistent hash ring of the shards, a key belongs to the first point at or
+# after its hash. Adding a shard only moves the keys of the points it takes.
+class HashRing:
+    def __init__(self, shards, virtualNodes=VIRTUAL_NODES):
+        self.shards = list(shards)
+        self.virtualNodes = virtualNodes
+        points = sorted(
+            (hashKey("{}#{}".format(shard.name, i)), index)
+            for index, shard in enumerate(self.shards)
+            for i in range(virtualNodes)
+        )
+        self.hashes = [point[0] for point in points]
+        self.owners = [self.shards[point[1]] for point in points]
+
+    def shardFor(self, key):
+        index = bisect.bisect_left(self.hashes, hashKey(key))
+        return self.owners[index % len(self.owners)]
+
+    # returns the ring with one more shard
+    def withShard(self, shard):
+        return HashRing(self.shards + [shard], self.virtualNodes)
+
+
+# Framed connection of the router to a shard. Answers come back in the order
+# of the requests; pushed deltas of subscriptions are handed to onPush.
+class ShardConnection:
+    def __init__(self, reader, writer, codec, onPush=None):
+        self.reader = reader
+        self.writer = writer
+        self.codec = codec
+        self.onPush = onPush
+        self.pending = collections.deque()
+        self.readTask = asyncio.create_task(self.readAnswers())
+
+    # connects and sends the secret of the router, which the shard does not answer
+    @classmethod
+    async def open(cls, shard, secret, onPush=None):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(shard.host, shard.port), CONNECT_TIMEOUT)
+        writer.write(protocol.handshake())
+        reply = await asyncio.wait_for(reader.readexactly(protocol.HANDSHAKE_SIZE), CONNECT_TIMEOUT)
+        if not reply.startswith(protocol.HANDSHAKE_MAGIC):
+            raise protocol.ProtocolError("shard {} did not answer the handshake".format(shard.name))
+        connection = cls(reader, writer, protocol.MessageCodec(protocol.FRAMED, reply[len(protocol.HANDSHAKE_MAGIC)]), onPush)
+        connection.send("SHARD-AUTH " + secret)
+        return connection
+
+    async def readAnswers(self):
+        try:
+            while True:
+                data = await self.reader.read(protocol.RECV_SIZE)
+                if not data:
+                    break
+                for message in self.codec.feed(data):
+                    if message.startswith(("users-delta", "rooms-delta", "private-messages")):
+                        if self.onPush is not None:
+                            self.onPush(message)
+                    elif self.pending:
+                        self.pending.popleft().set_result(message)
+        except (OSError, protocol.ProtocolError) as err:
+            log.error("Shard connection failed: %s", err)
+        finally:
+            while self.pending:
+                self.pending.popleft().set_exception(ConnectionError("shard connection closed"))
+
+    # sends a command and returns its answer
+    async def request(self, message):
+        if self.readTask.done():
+            raise ConnectionError("shard connection closed")
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(future)
+        self.writer.write(self.codec.encode([message]))
+        return await future
+
+    # sends a command the shard does not answer
+    def send(self, message):
+        self.writer.write(self.codec.encode([message]))
+
+    def close(self):
+        self.readTask.cancel()
+        self.writer.close()
+
+
+# Connection of a peer to the router, with one connection to every shard the
+# peer's commands went to, so each shard sees the peer as one session
+class RouterSession:
+    def __init__(self, router, reader, writer):
+        self.router = router
+        self.reader = reader
+        self.writer = writer
+        self.ip = writer.get_extra_info("peername")[0]
+        self.codec = protocol.MessageCodec(version=protocol.TEXT_VERSION)
+        self.upstreams = {}
+        self.username = None
+        self.home = None
+        self.chatroom = None
+        self.isOnline = True
+        # whether the session sent the secret of the shards, which SHARD-ADD needs
+        self.hasSecret = False
+
+    async def run(self):
+        try:
+            while self.isOnline:
+                data = await self.reader.read(protocol.RECV_SIZE)
+                if not data:
+                    break
+                texts = self.codec.feed(data)
+                reply = self.codec.takeHandshakeReply()
+                if reply:
+                    self.writer.write(reply)
+                responses = []
+                for text in texts:
+                    message = text.split()
+                    if message and message[0] == "PRIVATE-MESSAGE":
+                        message = text.split(None, 2)
+                    if message:
+                        response = await self.handleMessage(text, message)
+                        if response is not None:
+                            responses.append(response)
+                    if not self.isOnline:
+                        break
+                if responses:
+                    self.writer.write(self.codec.encode(responses))
+                await self.writer.drain()
+        except (OSError, ConnectionError, protocol.ProtocolError) as err:
+            log.error("Router session failed: %s", err, extra={"peer": self.ip})
+        finally:
+            try:
+                await self.leaveChatroom()
+            except (OSError, ConnectionError) as err:
+                log.error("Router session could not leave its chatroom: %s", err, extra={"peer": self.ip})
+            if self.username is not None and self.router.homes.get(self.username) is self.home:
+                del self.router.homes[self.username]
+            for upstream in self.upstreams.values():
+                upstream.close()
+            self.writer.close()
+
+    # returns the connection of this session to the shard, opened on first use
+    async def upstream(self, shard):
+        connection = self.upstreams.get(shard.name)
+        if connection is None:
+            connection = await ShardConnection.open(shard, self.router.secret, self.push)
+            # a peer of a legacy connection is not pushed private messages, they wait for a framed login
+            connection.send("PEER-ADDRESS " + self.ip + ("" if self.codec.mode == protocol.FRAMED else " legacy"))
+            self.upstreams[shard.name] = connection
+        return connection
+
+    async def request(self, shard, message):
+        return await (await self.upstream(shard)).request(message)
+
+    # asks the owner of the key, and the previous owner if a rebalance may not have moved the key yet
+    async def requestOwner(self, key, message):
+        shard = self.router.ring.shardFor(key)
+        response = await self.request(shard, message)
+        previous = self.router.previousShardFor(key)
+        if response.split("\n")[0] in MISSING_ANSWERS and previous is not None and previous is not shard:
+            retry = await self.request(previous, message)
+            if retry.split("\n")[0] not in MISSING_ANSWERS:
+                return retry
+        return response
+
+    # asks every shard and returns their answers
+    async def requestAll(self, message):
+        return await asyncio.gather(*[self.request(shard, message) for shard in self.router.ring.shards])
+
+    def push(self, message):
+        if not self.writer.is_closing():
+            self.writer.write(self.codec.encode([message]))
+
+    async def handleMessage(self, text, message):
+        command = message[0]
+        if len(message) <= REQUIRED_ARGUMENTS.get(command, 0):
+            return command.lower() + "-invalid"
+        if command == "SEARCH" and message[1] in self.router.homes:
+            # online users are on the shard they logged in on, which a rebalance may have changed since
+            return await self.request(self.router.homes[message[1]], text)
+        elif command == "SEARCH" or (command == "JOIN" and self.router.previousRing is None):
+            return await self.requestOwner(message[1], text)
+        elif command == "JOIN":
+            # an account that is still on its previous shard is taken
+            if await self.requestOwner(message[1], "SEARCH " + message[1]) != "search-user-not-found":
+                return "join-exist"
+            return await self.request(self.router.ring.shardFor(message[1]), text)
+        elif command == "LOGIN":
+            # the user may still be online on its previous shard
+            if message[1] in self.router.homes:
+                return "login-online"
+            shard = self.router.ring.shardFor(message[1])
+            response = await self.request(shard, text)
+            previous = self.router.previousShardFor(message[1])
+            if response == "login-account-not-exist" and previous is not None and previous is not shard:
+                shard = previous
+                response = await self.request(shard, text)
+            if response.startswith("login-success"):
+                self.username = message[1]
+                self.home = shard
+                self.router.homes[self.username] = shard
+            return response
+        elif command == "RESUME":
+            return await self.resume(text, message)
+        elif command == "LOGOUT":
+            await self.leaveChatroom()
+            if self.home is not None:
+                (await self.upstream(self.home)).send(text)
+            self.isOnline = False
+            return None
+        elif command == "USERS-LIST":
+            return mergeLists(await self.requestAll(text), message[1:], " ", "users-list-success", "users-list-page")
+        elif command == "CHATROOM-LIST":
+            return mergeLists(await self.requestAll(text), message[1:], "\n", "chatroom-list-success", "chatroom-list-page")
+        elif command == "CHATROOM-CREATE":
+            return await self.request(self.router.ring.shardFor(message[1]), text)
+        elif command == "PRIVATE-CHATROOM":
+            return await self.privateChatroom(message[1])
+        elif command == "PRIVATE-MESSAGE":
+            return await self.privateMessage(message)
+        elif command == "CHATROOM-JOIN":
+            return await self.joinChatroom(message[1])
+        elif command == "chatroom-leave-request":
+            await self.leaveChatroom()
+            return None
+        elif command in ("SUBSCRIBE", "UNSUBSCRIBE"):
+            return (await self.requestAll(text))[0]
+        # the secret of the shards is sent first, no response
+        elif command == "SHARD-AUTH":
+            self.hasSecret = len(message) > 1 and hmac.compare_digest(message[1].encode(), self.router.secret.encode())
+            if not self.hasSecret:
+                log.warning("Router session sent a wrong shard secret", extra={"peer": self.ip})
+            return None
+        elif command == "SHARD-ADD" and self.ip in ("127.0.0.1", "::1"):
+            if not self.hasSecret:
+                return "shard-unauthorized"
+            moved = await self.router.addShard(Shard.parse(message[1]))
+            if moved is None:
+                return "shard-add-shared-storage"
+            return "shard-add-success {} {}".format(moved[0], moved[1])
+        return None
+
+    # resumes the session on the shard that issued its token; the shards do not
+    # know the rooms of their users, the peer joins its chatroom again itself
+    async def resume(self, text, message):
+        if len(message) < 4:
+            return "resume-invalid"
+        shard = self.router.homes.get(message[1]) or self.router.ring.shardFor(message[1])
+        response = await self.request(shard, text)
+        previous = self.router.previousShardFor(message[1])
+        if response == "resume-invalid" and previous is not None and previous is not shard:
+            shard = previous
+            response = await self.request(shard, text)
+        if response.startswith("resume-success"):
+            self.username = message[1]
+            self.home = shard
+            self.router.homes[self.username] = shard
+        return response
+
+    async def privateChatroom(self, username):
+        if await self.requestOwner(username, "SEARCH " + username) == "search-user-not-found":
+            return "user does not exist"
+        for name in ("#" + self.username + "#" + username, "#" + username + "#" + self.username):
+            if await self.requestOwner(name, "ROOM-EXISTS " + name) == "room-exists":
+                return "chatroom-exists\n" + name
+        name = "#" + self.username + "#" + username
+        await self.request(self.router.ring.shardFor(name), "ROOM-CREATE " + name)
+        return "success\n" + name
+
+    # an online recipient is pushed the message by the shard it logged in on,
+    # an offline one has it queued on the shard of its account
+    async def privateMessage(self, message):
+        if self.username is None or len(message) < 3:
+            return "private-message-invalid"
+        forwarded = "PRIVATE-MESSAGE-FROM {} {} {}".format(self.username, message[1], message[2])
+        if message[1] in self.router.homes:
+            return await self.request(self.router.homes[message[1]], forwarded)
+        return await self.requestOwner(message[1], forwarded)
+
+    # joins the room on its shard, then looks the addresses of its members up on their shards
+    async def joinChatroom(self, room):
+        if self.chatroom is not None and self.chatroom != room:
+            await self.leaveChatroom()
+        response = await self.requestOwner(room, "ROOM-JOIN {} {}".format(room, self.username))
+        if not response.startswith("room-join-success"):
+            return response
+        self.chatroom = room
+        addresses = await self.router.lookupAddresses(self, response.split()[1:])
+        return "chatroom-join-success" + "".join(["\n{},{}".format(host, port) for host, port in addresses])
+
+    async def leaveChatroom(self):
+        if self.chatroom is None or self.username is None:
+            return
+        room = self.chatroom
+        self.chatroom = None
+        for shard in {self.router.ring.shardFor(room), self.router.previousShardFor(room)}:
+            if shard is not None:
+                await self.request(shard, "ROOM-LEAVE {} {}".format(room, self.username))
+
+
+# combines the lists, or the list pages, that every shard answered into one
+# answer; every shard sent its first entries after the cursor, so the first
+# limit entries of them all are the page
+def mergeLists(responses, options, separator, fullHeader, pageHeader):
+    entries = []
+    more = False
+    for response in responses:
+        kind, rest = (response.split(None, 1) + [""])[:2]
+        if kind == pageHeader:
+            cursor, _, rest = rest.partition(separator)
+            more = more or cursor != "-"
+        entries += [entry for entry in rest.split(separator) if entry]
+    if not options:
+        return separator.join([fullHeader] + entries)
+    # chatroom entries are "room : count", the cursor is the room
+    entries.sort(key=lambda entry: entry.split(" : ")[0])
+    limit = pageOptions(options)[0]
+    page = entries[:limit]
+    more = more or len(entries) > limit
+    cursor = page[-1].split(" : ")[0] if more and page else "-"
+    if separator == "\n":
+        return "\n".join([pageHeader + " " + cursor] + page)
+    return " ".join([pageHeader, cursor] + page)
+
+
+# Front of the sharded registry that the peers connect to, secret is the one
+# its shards were started with
+class ShardRouter:
+    def __init__(self, shards, host, port, portUDP, secret):
+        self.ring = HashRing(shards)
+        self.secret = secret
+        # ring before the last added shard, keys it moves are looked up on both
+        self.previousRing = None
+        self.host = host
+        self.port = port
+        self.portUDP = portUDP
+        # username -> shard of the users logged in through this router
+        self.homes = {}
+        self.server = None
+        self.helloTransport = None
+
+    def previousShardFor(self, key):
+        if self.previousRing is None:
+            return None
+        return self.previousRing.shardFor(key)
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.acceptClient, self.host, self.port, reuse_address=True)
+        self.helloTransport, protocol_ = await loop.create_datagram_endpoint(
+            lambda: HelloForwarder(self), local_addr=(self.host, self.portUDP)
+        )
+
+    async def serveForever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def acceptClient(self, reader, writer):
+        await RouterSession(self, reader, writer).run()
+
+    # forwards a hello datagram to the shard its user logged in on
+    def forwardHello(self, data):
+        message = data.decode(errors="replace").split()
+        if len(message) < 2 or message[0] != "HELLO":
+            return
+        shard = self.homes.get(message[1]) or self.ring.shardFor(message[1])
+        self.helloTransport.sendto(data, (shard.host, shard.portUDP))
+
+    # returns the (host, port) of the online ones among the usernames, asking
+    # every shard once for the usernames it owns
+    async def lookupAddresses(self, session, usernames):
+        byShard = {}
+        for username in usernames:
+            shard = self.homes.get(username) or self.ring.shardFor(username)
+            byShard.setdefault(shard.name, (shard, []))[1].append(username)
+        responses = await asyncio.gather(
+            *[session.request(shard, " ".join(["ADDRESSES"] + names)) for shard, names in byShard.values()]
+        )
+        found = {}
+        for response in responses:
+            for entry in response.split()[1:]:
+                username, host, port = entry.split(",")
+                found[username] = (host, port)
+        # users that logged in before a rebalance moved them are still on their previous shard
+        missing = [username for username in usernames if username not in found and self.previousRing is not None]
+        if missing:
+            for username in missing:
+                previous = self.previousShardFor(username)
+                response = await session.request(previous, "ADDRESSES " + username)
+                for entry in response.split()[1:]:
+                    name, host, port = entry.split(",")
+                    found[name] = (host, port)
+        return [found[username] for username in usernames if username in found]
+
+    # adds a shard and moves the accounts and chatrooms it now owns to it,
+    # returns (accounts moved, chatrooms moved); the previous owners are only
+    # asked as well until the move is done, or again if it failed. A shard that
+    # keeps its accounts in the storage of a shard of the ring is not added,
+    # moving the accounts would delete them from that storage, None is returned
+    async def addShard(self, shard):
+        target = await ShardConnection.open(shard, self.secret)
+        try:
+            shared = await self.sharedStorage(target)
+            if shared is not None:
+                log.error("Shard %s shares the storage of shard %s, it is not added", shard.name, shared.name)
+                return None
+            self.previousRing = self.ring
+            self.ring = self.ring.withShard(shard)
+            movedAccounts = 0
+            movedRooms = 0
+            for source in self.previousRing.shards:
+                connection = await ShardConnection.open(source, self.secret)
+                try:
+                    movedAccounts += await self.moveAccounts(connection, target, shard)
+                    movedRooms += await self.moveRooms(connection, target, shard)
+                finally:
+                    connection.close()
+        finally:
+            target.close()
+        self.previousRing = None
+        return movedAccounts, movedRooms
+
+    # returns the shard of the ring whose storage the target shard uses as well, or None
+    async def sharedStorage(self, target):
+        storage = await target.request("STORAGE")
+        for shard in self.ring.shards:
+            connection = await ShardConnection.open(shard, self.secret)
+            try:
+                if await connection.request("STORAGE") == storage:
+                    return shard
+            finally:
+                connection.close()
+        return None
+
+    async def moveAccounts(self, source, target, shard):
+        moved = 0
+        after = None
+        while True:
+            request = "ACCOUNTS-EXPORT limit={}".format(REBALANCE_BATCH)
+            if after is not None:
+                request += " after=" + after
+            lines = (await source.request(request)).split("\n")
+            cursor = lines[0].split()[1]
+            accounts = [line.split(" ", 1) for line in lines[1:] if line]
+            moving = [account for account in accounts if self.ring.shardFor(account[0]) is shard]
+            if moving:
+                await target.request(" ".join(["ACCOUNTS-IMPORT"] + [field for account in moving for field in account]))
+                await source.request(" ".join(["ACCOUNTS-DELETE"] + [account[0] for account in moving]))
+                moved += len(moving)
+            if cursor == "-":
+                return moved
+            after = cursor
+
+    async def moveRooms(self, source, target, shard):
+        moved = 0
+        lines = (await source.request("ROOMS-EXPORT")).split("\n")[1:]
+        for line in lines:
+            room = line.split()
+            if room and self.ring.shardFor(room[0]) is shard:
+                await target.request(" ".join(["ROOMS-IMPORT"] + room))
+                await source.request("ROOMS-DELETE " + room[0])
+                moved += 1
+        return moved
+
+
+# udp endpoint of the router, forwards the hello messages
+class HelloForwarder(asyncio.DatagramProtocol):
+    def __init__(self, router):
+        self.router = router
+
+    def datagram_received(self, data, addr):
+        self.router.forwardHello(data)
+
+
+# starts the registry shards on local ports after the router's ports; every
+# shard has a sqlite file, a mongo database and a log of its own, named after
+# its port, unless extraArgs give one to all of them
+def startShards(count, host, port, portUDP, secret, extraArgs):
+    shards = []
+    processes = []
+    env = dict(os.environ, **{protocol.SHARD_SECRET_ENV: secret})
+    for i in range(count):
+        shard = Shard(host, port + 1 + i, portUDP + 1 + i)
+        args = [sys.executable, "registry.py", "--shard", "--host", host,
+                "--port", str(shard.port), "--udp-port", str(shard.portUDP),
+                "--db-path", SHARD_DB_PATH.format(shard.port), "--db-name", SHARD_DB_NAME.format(shard.port),
+                "--log-file", SHARD_LOG_FILE.format(shard.port)] + list(extraArgs)
+        processes.append(subprocess.Popen(args, cwd=os.path.dirname(os.path.abspath(__file__)), env=env))
+        shards.append(shard)
+    return shards, processes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded P2P chat registry")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve = subparsers.add_parser("serve", help="start the registry shards and the router in front of them")
+    serve.add_argument("--shards", type=int, default=4)
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=16600, help="port of the router, the shards take the next ones")
+    serve.add_argument("--udp-port", type=int, default=16500)
+    serve.add_argument("--connect", nargs="*", default=None, metavar="HOST:PORT:UDP",
+                       help="route to registry shards that are already running instead of starting them")
+
+    add = subparsers.add_parser("add-shard", help="add a running registry shard to a router and rebalance, "
+                                                  "with the secret of the shards in $" + protocol.SHARD_SECRET_ENV)
+    add.add_argument("shard", metavar="HOST:PORT:UDP")
+    add.add_argument("--router", default="127.0.0.1:16600")
+    args, registryArgs = parser.parse_known_args()
+
+    setupLogging("router.log")
+    if args.command == "serve":
+        processes = []
+        secret = os.environ.get(protocol.SHARD_SECRET_ENV)
+        if args.connect:
+            if not secret:
+                parser.error("--connect needs the secret of the shards in ${}".format(protocol.SHARD_SECRET_ENV))
+            shards = [Shard.parse(text) for text in args.connect]
+        else:
+            # shards started here share a random secret unless one is given, add-shard needs it given
+            secret = secret or secrets.token_hex(16)
+            # arguments the router does not know are for the shards, such as --db memory
+            shards, processes = startShards(args.shards, args.host, args.port, args.udp_port, secret, registryArgs)
+        print("Router on {}:{} for {}".format(args.host, args.port, shards))
+        try:
+            asyncio.run(ShardRouter(shards, args.host, args.port, args.udp_port, secret).serveForever())
+        finally:
+            for process in processes:
+                process.kill()
+    else:
+        secret = os.environ.get(protocol.SHARD_SECRET_ENV)
+        if not secret:
+            parser.error("add-shard needs the secret of the shards in ${}".format(protocol.SHARD_SECRET_ENV))
+        host, port = args.router.rsplit(":", 1)
+        connection = protocol.MessageSocket.connect(socket.create_connection((host, int(port))))
+        connection.send("SHARD-AUTH " + secret)
+        connection.send("SHARD-ADD " + args.shard)
+        print(connection.receive())
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# Delta subscriptions of the registry lists
+import threading
+import time
+
+# seconds between two pushes of a feed, changes in between are coalesced
+FEED_INTERVAL = 0.2
+
+
+# Pushes the changes of a list (online users, chatroom counts) to the sessions
+# subscribed to it, so they do not have to poll the whole list. Changes are
+# kept per key until the next push, only the latest value of a key is sent,
+# and nothing is kept while nobody is subscribed.
+class DeltaFeed(threading.Thread):
+    # formatDelta turns a dict of key -> latest value into the pushed message
+    def __init__(self, formatDelta, interval=FEED_INTERVAL):
+        threading.Thread.__init__(self, daemon=True)
+        self.formatDelta = formatDelta
+        self.interval = interval
+        self.subscribers = set()
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, session):
+        with self.lock:
+            self.subscribers.add(session)
+
+    def unsubscribe(self, session):
+        with self.lock:
+            self.subscribers.discard(session)
+
+    # records a change of the key
+    def publish(self, key, value):
+        if not self.subscribers:
+            return
+        with self.lock:
+            self.pending[key] = value
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    # sends the changes since the last push to every subscriber
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            pending = self.pending
+            self.pending = {}
+            subscribers = list(self.subscribers)
+        message = self.formatDelta(pending)
+        for session in subscribers:
+            try:
+                session.sendResponse(message)
+            except OSError:
+                self.unsubscribe(session)
+
+
+# "users-delta +alice -bob", + for a login and - for a logout
+def formatUsersDelta(changes):
+    return "users-delta" + "".join([" " + ("+" if online else "-") + username for username, online in changes.items()])
+
+
+# "rooms-delta\nroom : 3", in the format of the chatroom list
+def formatRoomsDelta(changes):
+    return "rooms-delta" + "".join(["\n{} : {}".format(room, count) for room, count in changes.items()])
@@ -0,0 +1,96 @@
+# Session tokens that let a peer resume its session without a password
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+# seconds a token is signed for, a peer logs in again after that
+TOKEN_TTL = 3600
+# seconds after its session ended, by hello timeout or a lost connection,
+# during which a peer may resume it
+RESUME_WINDOW = 60
+# hex digits of the signature kept in a token
+SIGNATURE_DIGITS = 32
+
+
+# Issues a token "expires.nonce.signature" to every login, signed with HMAC
+# over the username, its expiry and a random nonce. Only the token issued
+# last to a user is accepted and it is used up by a resume, which issues
+# the next one; a logout revokes it. The chatroom of a session that timed
+# out is kept with its token, so a resume puts the peer back in the room.
+class SessionTokens:
+    def __init__(self, secret=None, ttl=TOKEN_TTL, window=RESUME_WINDOW):
+        # a random secret makes the tokens of a previous run invalid
+        self.secret = secret if secret is not None else os.urandom(32)
+        self.ttl = ttl
+        self.window = window
+        # username -> [nonce, expires, time the session ended or None, chatroom]
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.nextSweep = 0
+
+    def sign(self, username, expires, nonce):
+        message = "{} {} {}".format(username, expires, nonce).encode()
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()[:SIGNATURE_DIGITS]
+
+    # returns a new token of the user, the earlier one is no longer accepted
+    def issue(self, username, now=None):
+        now = time.time() if now is None else now
+        expires = int(now + self.ttl)
+        nonce = os.urandom(8).hex()
+        with self.lock:
+            if now >= self.nextSweep:
+                self.sweep(now)
+            self.sessions[username] = [nonce, expires, None, None]
+        return "{}.{}.{}".format(expires, nonce, self.sign(username, expires, nonce))
+
+    # marks the session of the user as ended, it may be resumed within the window
+    def suspend(self, username, room=None, now=None):
+        with self.lock:
+            session = self.sessions.get(username)
+            if session is not None:
+                session[2] = time.time() if now is None else now
+                session[3] = room
+
+    # checks the token, returns (True, chatroom of the ended session or None)
+    # if the session may be resumed, (False, None) otherwise
+    def check(self, username, token, now=None):
+        return self.verify(username, token, False, now)
+
+    # checks the token and uses it up, once the session was taken up again
+    def resume(self, username, token, now=None):
+        return self.verify(username, token, True, now)
+
+    def verify(self, username, token, consume, now):
+        now = time.time() if now is None else now
+        try:
+            expires, nonce, signature = token.split(".")
+            expires = int(expires)
+        except ValueError:
+            return False, None
+        if not hmac.compare_digest(signature, self.sign(username, expires, nonce)) or expires < now:
+            return False, None
+        with self.lock:
+            session = self.sessions.get(username)
+            if session is None or session[0] != nonce:
+                return False, None
+            if session[2] is not None and session[2] + self.window < now:
+                return False, None
+            if consume:
+                del self.sessions[username]
+        return True, session[3]
+
+    def revoke(self, username):
+        with self.lock:
+            self.sessions.pop(username, None)
+
+    # drops expired tokens and sessions past their window, under the lock
+    def sweep(self, now):
+        for username, (nonce, expires, ended, room) in list(self.sessions.items()):
+            if expires < now or (ended is not None and ended + self.window < now):
+                del self.sessions[username]
+        self.nextSweep = now + self.window
+
+    def __len__(self):
+        return len(self.sessions)